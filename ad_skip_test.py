@@ -1,17 +1,269 @@
+import asyncio
 import time
-import win32api
-import win32con
+import threading
+import collections
 import mss.tools
-import concurrent.futures
 import numpy as np
 import cv2
-import pyautogui
 import os
-import pygetwindow as gw
+import sys
+from capture import Frame, CaptureService, ChangeDetector, MssBackend, signatures_differ
+from hotspots import HotspotIndex
+from match_pool import MatchPool
+from metrics import Metrics, export_from_env
+from state_signatures import StateSignatures
+
+# Mouse, keyboard and window control only exist on a Windows desktop. Without them (e.g. replaying a recorded
+# session on Linux) everything else still works, as long as MouseController and KeyboardController are swapped out.
+try:
+    import win32api
+    import win32con
+except ImportError:
+    win32api = win32con = None
+try:
+    import pyautogui
+    import pygetwindow as gw
+    pyautogui.FAILSAFE = False
+except Exception:  # pyautogui raises more than ImportError when there is no display
+    pyautogui = gw = None
 
-pyautogui.FAILSAFE = False
 script_directory = os.path.dirname(__file__)
 
+# Scale of the coarse level used by pyramid matching, and the smallest side a template may have at that scale
+PYRAMID_SCALE = 0.5
+PYRAMID_MIN_SIDE = 20
+# How much lower than the final threshold a coarse level score may be to still be checked at full size
+PYRAMID_COARSE_MARGIN = 0.25
+
+# The HSV range find_arrow counts as the green of the arrow above the chest slots
+ARROW_GREEN_LOWER = np.array([40, 40, 40])
+ARROW_GREEN_UPPER = np.array([70, 255, 255])
+# Part of the capture height the chest bar is in, where find_arrow looks when the arrow is not where it was before
+ARROW_BAND = (0.6, 1.0)
+# Contours with an area (in pixels) outside this range can not be the arrow, and are skipped before approxPolyDP
+ARROW_AREA = (100, 6000)
+# How far around the last arrow to look first
+ARROW_PADDING = 30
+
+
+def build_green_lut():
+    """
+    Works out for every BGR colour, 5 bits per channel, whether it is in the arrow's HSV range.
+
+    Returns:
+    np.array: 32768 entries of 255 (green) or 0, indexed by (b >> 3) << 10 | (g >> 3) << 5 | r >> 3.
+    """
+    levels = np.arange(32, dtype=np.uint8) * 8 + 4  # The middle of every 5 bit step
+    b, g, r = np.meshgrid(levels, levels, levels, indexing='ij')
+    colours = np.stack([b, g, r], axis=-1).reshape(-1, 1, 3)
+    hsv = cv2.cvtColor(colours, cv2.COLOR_BGR2HSV)
+    return cv2.inRange(hsv, ARROW_GREEN_LOWER, ARROW_GREEN_UPPER).ravel()
+
+
+# Looked up instead of converting the screenshot to HSV
+GREEN_LUT = build_green_lut()
+
+# A decoded template image, kept in memory by TemplateLibrary
+Template = collections.namedtuple('Template', ['name', 'path', 'gray', 'width', 'height', 'mtime'])
+
+
+class Match(collections.namedtuple('Match', ['name', 'x', 'y'])):
+    """
+    A template match: (name, x, y) of the match center, plus how confident the match is.
+
+    It still unpacks as name, x, y so it can be used anywhere the plain tuples were used.
+    """
+
+    def __new__(cls, name, x, y, confidence=None):
+        match = super().__new__(cls, name, x, y)
+        match.confidence = confidence
+        return match
+
+    @property
+    def percent(self):
+        return None if self.confidence is None else int(self.confidence * 100)
+
+
+class TemplateLibrary:
+    """
+    Keeps the snip_images templates decoded in memory so each PNG is only read once.
+
+    Templates are stored as grayscale needles together with their size and name. A file is only decoded
+    again when its modification time changes, and a folder is only listed again when the folder itself changes.
+    """
+
+    def __init__(self):
+        self._templates = {}  # path -> Template
+        self._folders = {}  # folder -> (mtime, [paths])
+        self._scaled = {}  # (path, mtime, scale) -> downscaled grayscale needle
+        self._lock = threading.Lock()
+
+    def get(self, image_path):
+        """
+        Returns the template for an image file, decoding it if it is new or has changed on disk.
+
+        Args:
+        image_path (str): The path to the template image.
+
+        Returns:
+        Template: The decoded template.
+        """
+        mtime = os.path.getmtime(image_path)
+        with self._lock:
+            template = self._templates.get(image_path)
+            if template is None or template.mtime != mtime:
+                template = self._load(image_path, mtime)
+                self._templates[image_path] = template
+            return template
+
+    def folder(self, folder):
+        """
+        Returns the templates of all PNG files in a folder, sorted by file name.
+
+        Args:
+        folder (str): The path to the folder containing the images.
+
+        Returns:
+        list: List of Template.
+        """
+        mtime = os.path.getmtime(folder)
+        with self._lock:
+            cached = self._folders.get(folder)
+            if cached is None or cached[0] != mtime:
+                paths = [os.path.join(folder, filename) for filename in sorted(os.listdir(folder))
+                         if filename.endswith(".png")]
+                self._folders[folder] = (mtime, paths)
+            else:
+                paths = cached[1]
+        return [self.get(path) for path in paths]
+
+    def scaled(self, template, scale):
+        """
+        Returns a downscaled copy of a template's grayscale needle, made once and then kept for pyramid matching.
+
+        Args:
+        template (Template): The template.
+        scale (float): The size of the copy compared to the template.
+
+        Returns:
+        np.array: The downscaled needle.
+        """
+        key = (template.path, template.mtime, scale)
+        small = self._scaled.get(key)
+        if small is None:
+            small = cv2.resize(template.gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            with self._lock:
+                self._scaled[key] = small
+        return small
+
+    def clear(self):
+        """
+        Forgets every cached template and folder listing.
+        """
+        with self._lock:
+            self._templates.clear()
+            self._folders.clear()
+            self._scaled.clear()
+
+    @staticmethod
+    def _load(image_path, mtime):
+        needle = cv2.imread(image_path, cv2.IMREAD_COLOR)
+        if needle is None:
+            raise ValueError(f"Could not read template image {image_path}")
+        gray_needle = cv2.cvtColor(needle, cv2.COLOR_BGR2GRAY)
+        name = os.path.splitext(os.path.basename(image_path))[0]
+        return Template(name, image_path, gray_needle, gray_needle.shape[1], gray_needle.shape[0], mtime)
+
+
+# Shared by every ImageFinder call
+templates = TemplateLibrary()
+
+# Where each template has been found before, searched before the full screen
+hotspots = HotspotIndex(os.path.join(script_directory, 'hotspots.json'))
+
+# Matches the templates of a folder in parallel, transforming the frame once for all of them. MATCH_POOL=thread uses
+# plain matchTemplate calls instead, MATCH_POOL=process runs them in worker processes
+match_pool = MatchPool(os.environ.get('MATCH_POOL', 'fft'))
+
+# Thumbnails of the state screens, tried before the state templates
+state_signatures = StateSignatures(os.path.join(script_directory, 'state_signatures.npz'))
+
+# Detector results, reused while the screen does not change
+change_detector = ChangeDetector()
+
+# Timings and counters of the hot paths, exported to disk when METRICS_DIR is set
+metrics = Metrics()
+metrics.gauge('ads_per_hour', lambda: metrics.per_hour('ads_watched_total'))
+
+
+def region_key(cap_region):
+    """
+    Turns a capture region into something hashable, for use in cache keys.
+    """
+    return None if cap_region is None else tuple(sorted(cap_region.items()))
+
+
+def wait_for(predicate, timeout=None, min_interval=0.05, max_interval=1.0, action=None, description=None,
+             raise_on_timeout=True):
+    """
+    Waits until a condition holds, checking quickly at first and backing off the longer nothing happens.
+
+    Replaces fixed sleeps: it returns as soon as the condition holds instead of always waiting the worst case.
+
+    Args:
+    predicate (callable): Called without arguments, the wait is over as soon as it returns something truthy.
+    timeout (float): The longest to wait in seconds, forever if None.
+    min_interval (float): Time between the first checks, and between checks right after an action.
+    max_interval (float): The longest time between checks once things have been idle for a while.
+    action (callable): Called after every failed check, e.g. to close a popup. If it returns something truthy
+        an action was taken, and checking speeds up again.
+    description (str): What is being waited for, used in the timeout message.
+    raise_on_timeout (bool): Raise TimeoutError when the timeout runs out, otherwise print it and return None.
+
+    Returns:
+    The truthy result of predicate, or None if the timeout ran out and raise_on_timeout is False.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    interval = min_interval
+    while True:
+        result = predicate()
+        if result:
+            return result
+        if action is not None and action():
+            interval = min_interval
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            message = f"Timed out after {timeout}s waiting for {description or 'condition'}"
+            if raise_on_timeout:
+                raise TimeoutError(message)
+            print(message)
+            return None
+        time.sleep(interval if remaining is None else min(interval, remaining))
+        interval = min(interval * 1.5, max_interval)
+
+
+# Called with (kind, data) for every mouse move, click and key press, e.g. by the session recorder
+action_listeners = []
+
+
+def notify_action(kind, **data):
+    """
+    Tells every listener in action_listeners about an input action.
+
+    Args:
+    kind (str): "move", "click" or "key".
+    **data: Details of the action, e.g. x and y for a move.
+    """
+    for listener in action_listeners:
+        listener(kind, data)
+
+
+# Set to a capture.CaptureBackend (e.g. AdbBackend or ReplayBackend) to capture from it instead of mss
+capture_backend = None
+
+# Set to a started capture.CaptureService to read frames from it instead of grabbing the screen on every call
+capture_service = None
+
 
 class ImageFinder:
     @staticmethod
@@ -25,83 +277,160 @@ class ImageFinder:
         Returns:
         np.array: Numpy array representing the screenshot image.
         """
-        with mss.mss() as sct:
+        if capture_service is not None:
+            with metrics.timer('capture_seconds', source='service'):
+                frame = capture_service.latest()
+            if frame.covers(cap_region):
+                return frame.crop(cap_region).image
+        if capture_backend is not None:
+            with metrics.timer('capture_seconds', source=type(capture_backend).__name__):
+                return capture_backend.grab(cap_region)
+        with metrics.timer('capture_seconds', source='mss'), mss.mss() as sct:
             sct_img = sct.grab(cap_region)
             # noinspection PyTypeChecker
             screenshot = np.array(sct_img)
             return screenshot
 
     @staticmethod
-    def find_needle(file_path, cap_region):
+    def capture_frame(cap_region):
+        """
+        Captures the screen within the specified region as a Frame that detectors can share.
+
+        Args:
+        region (dict): Dictionary containing the region coordinates.
+
+        Returns:
+        Frame: The captured frame.
+        """
+        if capture_service is not None:
+            with metrics.timer('capture_seconds', source='service'):
+                frame = capture_service.latest()
+            if frame.covers(cap_region):
+                return frame if frame.region == cap_region else frame.crop(cap_region)
+        return Frame(ImageFinder.capture_screen(cap_region), cap_region)
+
+    @staticmethod
+    def wait_for_change(cap_region, frame=None, timeout=None, interval=0.1):
+        """
+        Waits until the screen looks different from the given frame.
+
+        Args:
+        cap_region (dict): Dictionary containing the region coordinates.
+        frame (Frame): The frame to compare against, the screen right now if not given.
+        timeout (float): How long to wait in seconds, forever if None.
+        interval (float): How long to wait between screenshots when there is no capture service.
+
+        Returns:
+        Frame: The first changed frame, or None if the timeout ran out.
+        """
+        if frame is None:
+            frame = ImageFinder.capture_frame(cap_region)
+        reference = frame.signature()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            if capture_service is not None:
+                # Sleep until the capture thread has a newer frame
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                capture_service.wait_for_frame(timeout=remaining)
+            else:
+                time.sleep(interval)
+            new_frame = ImageFinder.capture_frame(cap_region)
+            if signatures_differ(reference, new_frame.signature(), change_detector.tolerance):
+                return new_frame
+        return None
+
+    @staticmethod
+    def find_needle(file_path, cap_region, frame=None, use_cache=True):
         """
         Finds a needle image within a screenshot and returns its name, x, and y coordinates.
 
         Args:
         file_path (str): The file path of the needle image.
+        frame (Frame): Already captured frame to search, a new one is captured if not given.
+        use_cache (bool): Reuse the last result if the screen has not changed since.
 
         Returns:
         tuple: (name, x, y) if needle is found, otherwise (None, None, None).
         """
         # Capture the screen
-        screenshot = ImageFinder.capture_screen(cap_region)
+        if frame is None:
+            frame = ImageFinder.capture_frame(cap_region)
 
-        # Perform template matching
-        match = ImageFinder.template_matching(screenshot, file_path, threshold=0.90)
-
-        # Group similar rectangles
-        match = ImageFinder.group_rectangles(match)
-
-        # Return the name, x, and y coordinates of the first match
-        if match and len(match) > 0:
-            for match_item in match:
-                name = match_item[0]
-                x = match_item[1]
-                y = match_item[2]
-                return name, x, y
-        else:
-            return None, None, None
+        def detect():
+            # Perform template matching, overlapping hits are already merged into one match each
+            match = ImageFinder.template_matching(frame, file_path, threshold=0.90)
+
+            # Return the name, x, and y coordinates of the first match
+            if match:
+                return match[0]
+            else:
+                return None, None, None
+
+        if not use_cache:
+            return detect()
+        return change_detector.cached(('needle', file_path, region_key(frame.region)), frame, detect)
 
     @staticmethod
-    def find_1_of_folder(folder, cap_region, multiple=False):
+    def wait_for_needle(file_path, cap_region, timeout, **kwargs):
+        """
+        Waits until a needle image is on screen.
+
+        Args:
+        file_path (str): The file path of the needle image.
+        timeout (float): The longest to wait in seconds.
+        **kwargs: Passed on to wait_for.
+
+        Returns:
+        tuple: (name, x, y) as soon as the needle is found, (None, None, None) if the timeout ran out.
+        """
+        def found():
+            match = ImageFinder.find_needle(file_path, cap_region)
+            return match if match[1] is not None else None
+
+        if not timeout:
+            return ImageFinder.find_needle(file_path, cap_region)
+        kwargs.setdefault('description', os.path.basename(file_path))
+        kwargs.setdefault('raise_on_timeout', False)
+        return wait_for(found, timeout, **kwargs) or (None, None, None)
+
+    @staticmethod
+    def find_1_of_folder(folder, cap_region, multiple=False, frame=None, pyramid=False, use_cache=True):
         """
         Find the first matching image in the given folder.
 
         Args:
         folder (str): The path to the folder containing the images.
+        frame (Frame): Already captured frame to search, a new one is captured if not given.
+        pyramid (bool): Use coarse to fine matching, see template_matching.
+        use_cache (bool): Reuse the last result if the screen has not changed since.
 
         Returns:
         tuple: The coordinates of the first matching image, or None if no match is found.
         """
 
-        # Get the paths of all PNG files in the folder
-        paths = [os.path.join(folder, filename) for filename in os.listdir(folder) if filename.endswith(".png")]
-
         # Capture a screenshot
-        screenshot = ImageFinder.capture_screen(cap_region)
+        if frame is None:
+            frame = ImageFinder.capture_frame(cap_region)
 
-        def match_template(path):
-            """
-            Match the given image template with the screenshot.
+        if use_cache:
+            key = ('folder', folder, multiple, pyramid, region_key(frame.region))
+            return change_detector.cached(key, frame, lambda: ImageFinder.find_1_of_folder(
+                folder, cap_region, multiple, frame, pyramid, use_cache=False))
 
-            Args:
-            path (str): The path to the image file.
+        # Get the templates of all PNG files in the folder
+        folder_templates = templates.folder(folder)
+        # Convert to grayscale once here instead of once per template
+        _ = frame.gray
+        if pyramid:
+            _ = frame.downscaled(PYRAMID_SCALE)
 
-            Returns:
-            tuple: The coordinates of the matching image, or None if no match is found.
-            """
-            match = ImageFinder.template_matching(screenshot, path)
-            match = ImageFinder.group_rectangles(match)
-            if match and len(match) > 0:
-                return match[0]
-            else:
-                return None
-
-        # Use ThreadPoolExecutor to match templates concurrently
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            matches = list(executor.map(match_template, paths))
+        # Match the templates concurrently on the shared pool, without waiting for the rest once one is found
+        with metrics.timer('folder_scan_seconds', folder=os.path.basename(folder)) as labels:
+            matches = match_pool.match(frame, folder_templates, pyramid=pyramid, first=not multiple)
 
-        # Filter out None matches
-        matches = [match for match in matches if match is not None]
+            # Filter out None matches
+            matches = [match for match in matches if match is not None]
+            labels['found'] = bool(matches)
 
         # Return the first match, or None if no matches are found
         if matches:
@@ -113,47 +442,136 @@ class ImageFinder:
             return None, None, None
 
     @staticmethod
-    def template_matching(haystack, image_path, threshold=0.93):
-        global match_percent
+    def template_matching(haystack, image_path, threshold=0.93, max_matches=10, use_hotspots=True, pyramid=False):
         """
         Perform template matching to find the location of a template image within a larger image.
 
+        If the template has been found before, only the boxes around those hotspots are searched. The full image is
+        only searched when none of them has a match.
+
+        With pyramid=True the full image search is done coarse to fine: half size copies of the image and template
+        are matched first with a relaxed threshold, and only small windows around those candidates are matched
+        again at full size. Whether a match is accepted is still decided by the full size score and threshold.
+        Templates too small to shrink (thin close buttons and the like) are always matched at full size.
+
         Args:
-        - haystack: The larger image to search within.
-        - image_path: The path to the template image.
+        - haystack: The larger image to search within, either a screenshot or a Frame.
+        - image_path: The path to the template image, or a Template from the TemplateLibrary.
+        - max_matches: The most matches to return, the best scoring ones are kept.
+        - use_hotspots: Search around known hotspots first.
+        - pyramid: Use coarse to fine matching for the full image search.
 
         Returns:
-        - matches: A list of tuples containing the name of the template image, and the x and y coordinates of the center of each match.
+        - matches: A list of Match (name, center x, center y and confidence) sorted by x then y. Matches never
+          overlap each other, so there is no need to group them afterwards.
         """
 
-        # Load the template image
-        needle = cv2.imread(image_path, cv2.IMREAD_COLOR)
-        gray_needle = cv2.cvtColor(needle, cv2.COLOR_BGR2GRAY)
-
-        # Convert the haystack image to grayscale
-        gray_haystack = cv2.cvtColor(haystack, cv2.COLOR_BGR2GRAY)
+        started = time.perf_counter()
+        # Get the already decoded template image
+        if isinstance(image_path, Template):
+            needle = image_path
+        else:
+            needle = templates.get(image_path)
+
+        # Convert the haystack image to grayscale, a Frame already has it
+        if not isinstance(haystack, Frame):
+            haystack = Frame(haystack)
+        gray_haystack = haystack.gray
+
+        hotspot_key = HotspotIndex.key(needle, gray_haystack.shape)
+
+        # Search where the template has been seen before first
+        if use_hotspots:
+            boxes = hotspots.regions(hotspot_key, needle.width, needle.height, gray_haystack.shape)
+            peaks = ImageFinder._match_in_boxes(gray_haystack, needle, boxes, threshold, max_matches)
+            if peaks:
+                return ImageFinder._peaks_to_matches(needle, peaks, hotspot_key, 'hotspot', started)
+
+        if pyramid and min(needle.width, needle.height) * PYRAMID_SCALE >= PYRAMID_MIN_SIDE:
+            # Find candidates at the coarse level, then only check windows around them at full size
+            result = cv2.matchTemplate(haystack.downscaled(PYRAMID_SCALE), templates.scaled(needle, PYRAMID_SCALE),
+                                       cv2.TM_CCOEFF_NORMED)
+            small_width, small_height = int(needle.width * PYRAMID_SCALE), int(needle.height * PYRAMID_SCALE)
+            candidates = ImageFinder.find_peaks(result, threshold - PYRAMID_COARSE_MARGIN, small_width, small_height,
+                                                max_matches)
+            margin = int(2 / PYRAMID_SCALE)
+            boxes = []
+            for x, y, _ in candidates:
+                left = max(int(x / PYRAMID_SCALE) - margin, 0)
+                top = max(int(y / PYRAMID_SCALE) - margin, 0)
+                right = min(left + needle.width + 2 * margin, gray_haystack.shape[1])
+                bottom = min(top + needle.height + 2 * margin, gray_haystack.shape[0])
+                boxes.append((left, top, right, bottom))
+            peaks = ImageFinder._match_in_boxes(gray_haystack, needle, boxes, threshold, max_matches)
+            return ImageFinder._peaks_to_matches(needle, peaks, hotspot_key, 'pyramid', started)
 
         # Perform template matching
-        result = cv2.matchTemplate(gray_haystack, gray_needle, cv2.TM_CCOEFF_NORMED)
-
-        # Find the locations where the match exceeds the threshold
-        loc = np.nonzero(result >= threshold)
-
-        # Extract the matches and their coordinates
-        matches = []
-        for pt in zip(*loc[::-1]):
-            x = pt[0]
-            y = pt[1]
-            img_w = needle.shape[1]
-            img_h = needle.shape[0]
-            center_x = x + img_w // 2
-            center_y = y + img_h // 2
-            image_name = os.path.splitext(os.path.basename(image_path))[0]
-            match_percent = int(result[y, x] * 100)
-            matches.append((image_name, center_x, center_y))
+        result = cv2.matchTemplate(gray_haystack, needle.gray, cv2.TM_CCOEFF_NORMED)
+
+        # Find the best, non overlapping locations where the match exceeds the threshold
+        peaks = ImageFinder.find_peaks(result, threshold, needle.width, needle.height, max_matches)
+
+        return ImageFinder._peaks_to_matches(needle, peaks, hotspot_key, 'full', started)
+
+    @staticmethod
+    def _match_in_boxes(gray_haystack, needle, boxes, threshold, max_matches):
+        # Match only inside the given (left, top, right, bottom) boxes, returning (x, y, score) in haystack coordinates
+        matches = {}
+        for left, top, right, bottom in boxes:
+            if right - left < needle.width or bottom - top < needle.height:
+                continue
+            result = cv2.matchTemplate(gray_haystack[top:bottom, left:right], needle.gray, cv2.TM_CCOEFF_NORMED)
+            for x, y, score in ImageFinder.find_peaks(result, threshold, needle.width, needle.height, max_matches):
+                # Boxes can overlap, so the same match may be found twice
+                matches[(left + x, top + y)] = score
+        peaks = [(x, y, score) for (x, y), score in matches.items()]
+        return sorted(peaks, key=lambda p: -p[2])[:max_matches]
 
+    @staticmethod
+    def _peaks_to_matches(needle, peaks, hotspot_key, mode, started):
+        # Turn the top left corners into the centers of the matches and remember where they were
+        matches = [Match(needle.name, x + needle.width // 2, y + needle.height // 2, score) for x, y, score in peaks]
+        for match in matches:
+            hotspots.record(hotspot_key, match.x, match.y)
+        matches.sort(key=lambda m: (m.x, m.y))
+        # mode is how the matches were found: 'hotspot', 'pyramid' or 'full'
+        metrics.observe('template_match_seconds', time.perf_counter() - started, template=needle.name, mode=mode,
+                        found=bool(matches))
         return matches
 
+    @staticmethod
+    def find_peaks(result, threshold, width, height, max_matches=10):
+        """
+        Finds the best scoring, non overlapping matches in a matchTemplate result.
+
+        The best location is taken with minMaxLoc, then everything a needle of the given size would overlap there is
+        blanked out and the next best is taken, until nothing is left above the threshold. The result is only copied
+        if there is at least one match.
+
+        Args:
+        result (np.array): Output of cv2.matchTemplate.
+        threshold (float): Lowest score that counts as a match.
+        width (int): Width of the needle.
+        height (int): Height of the needle.
+        max_matches (int): The most matches to return.
+
+        Returns:
+        list: List of (x, y, score) of the top left corner of each match, best first.
+        """
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if max_val < threshold:
+            return []
+
+        result = result.copy()
+        peaks = []
+        while max_val >= threshold and len(peaks) < max_matches:
+            x, y = max_loc
+            peaks.append((x, y, float(max_val)))
+            # Blank out every location whose rectangle would overlap this one
+            result[max(y - height + 1, 0):y + height, max(x - width + 1, 0):x + width] = -1
+            _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        return peaks
+
     @staticmethod
     def group_rectangles(rectangles, max_distance=5):
         """
@@ -203,17 +621,32 @@ class ImageFinder:
         return grouped_rectangles
 
     @staticmethod
-    def resize_bluestacks_window():
+    def resize_bluestacks_window(title="bluestacks", cap_region=None):
+        """
+        Moves and resizes a Bluestacks window so it fills its capture region.
+
+        Args:
+        title (str): The window title, an exact match is preferred over a window that only contains it.
+        cap_region (dict): Where the window should be, 500x915 at (0, 0) if not given.
+        """
         bluestacks_window = None
-        desired_size = (500, 915)
-        desired_xy = (0, 0)
+        if cap_region is None:
+            cap_region = {'left': 0, 'top': 0, 'width': 500, 'height': 915}
+        desired_size = (cap_region['width'], cap_region['height'])
+        desired_xy = (cap_region['top'], cap_region['left'])
         # Get all windows
 
-        # Find window with name containing "Bluestacks"
+        if gw is None:
+            print("Window control not available, Bluestacks window not resized")
+            return
+
+        # Find window with name containing the title, "Bluestacks App Player" would also find "... Player 2"
         for window in gw.getAllWindows():
-            if "bluestacks" in window.title.lower():
+            if window.title.lower() == title.lower():
                 bluestacks_window = window
                 break
+            if bluestacks_window is None and title.lower() in window.title.lower():
+                bluestacks_window = window
 
         # If Bluestacks window is found
         if bluestacks_window:
@@ -223,7 +656,145 @@ class ImageFinder:
                 print("Bluestacks window Rezized")
                 # Resize the window
                 bluestacks_window.resizeTo(desired_size[0], desired_size[1])
-                bluestacks_window.moveTo(0, 0)  # Move the window to (0, 0) position
+                bluestacks_window.moveTo(cap_region['left'], cap_region['top'])  # Move the window into its region
+
+
+# States that are known to follow each other in automate_ads and game_test, most likely first, used as a starting
+# point before the StateClassifier has seen any transitions. "advert" means no state template matched.
+STATE_TRANSITIONS = {
+    None: [],
+    'advert': ['openchest', 'chest', 'home', 'postgame'],
+    'openchest': ['openchest', 'chest'],
+    'chest': ['chest', 'home', 'openchest'],
+    'home': ['home', 'openchest', 'chest', 'deal', 'free_reward'],
+    'deal': ['deal', 'home'],
+    'free_reward': ['free_reward', 'openchest', 'chest'],
+    'postgame': ['postgame', 'home'],
+    'bluestacks_loading': ['bluestacks_loading', 'android_home'],
+    'android_home': ['android_home', 'deal', 'home'],
+}
+
+
+class StateClassifier:
+    """
+    Works out which screen the game is on, trying the most likely states first.
+
+    First the frame's thumbnail is compared to the learned state_signatures. If it is clearly one state, that is the
+    answer without any template matching, and if a few states are close, their templates are tried nearest first.
+    Otherwise the state templates are ordered by how often they followed the previous state. The few most likely
+    ones are tried one by one and the first confident match wins, so the common case only costs one or two
+    matchTemplate calls. Only if none of them match are the remaining templates matched (concurrently). Every
+    classification is counted as a transition from the previous state, so the ordering keeps improving, and every
+    template match is learned by state_signatures.
+    """
+
+    def __init__(self, folder, transitions=None, fast_candidates=2):
+        """
+        Args:
+        folder (str): The folder containing the state templates.
+        transitions (dict): Known transitions to start from, defaults to STATE_TRANSITIONS.
+        fast_candidates (int): How many likely states to try one by one before matching the rest.
+        """
+        self.folder = folder
+        self.fast_candidates = fast_candidates
+        self.previous = None
+        self.counts = collections.defaultdict(collections.Counter)  # previous state -> Counter of next states
+        # Seed the counts so the first listed state starts out as the most likely one
+        for previous, states in (STATE_TRANSITIONS if transitions is None else transitions).items():
+            for index, state in enumerate(states):
+                self.counts[previous][state] += len(states) - index
+        self._lock = threading.Lock()
+
+    def order(self, previous, folder_templates):
+        """
+        Sorts templates by how often their state followed the previous state, keeping folder order for ties.
+
+        Returns:
+        tuple: (likely, rest) where likely are the templates that have followed previous before, most often first.
+        """
+        with self._lock:
+            counts = dict(self.counts.get(previous, {}))
+        ordered = sorted(folder_templates, key=lambda t: -counts.get(t.name.lower(), 0))
+        likely = [t for t in ordered if counts.get(t.name.lower(), 0) > 0]
+        return likely, ordered[len(likely):]
+
+    def classify(self, frame):
+        """
+        Finds the state template that matches the frame.
+
+        Args:
+        frame (Frame): The frame to classify.
+
+        Returns:
+        str: The name of the matching template, or None if nothing matched (an advert is playing).
+        """
+        folder_templates = templates.folder(self.folder)
+        signatures = state_signatures
+        name, tried = None, []
+        if signatures is not None and len(signatures):
+            name, tried = self.classify_by_signature(frame, folder_templates, signatures)
+            if name:
+                self.record(name.lower())
+                return name
+
+        tried_paths = {template.path for template in tried}
+        likely, rest = self.order(self.previous, [t for t in folder_templates if t.path not in tried_paths])
+        rest = likely[self.fast_candidates:] + rest
+        likely = likely[:self.fast_candidates]
+
+        # Try the most likely states first and stop at the first match
+        for template in likely:
+            if ImageFinder.template_matching(frame, template, pyramid=True):
+                name = template.name
+                break
+
+        if name is None and rest:
+            found = match_pool.match(frame, rest, pyramid=True, first=True)
+            # Keep the most likely one if more than one matched
+            for template, matched in zip(rest, found):
+                if matched:
+                    name = template.name
+                    break
+
+        self.record(name.lower() if name else "advert")
+        if name and signatures is not None:
+            signatures.learn(frame, name.lower())
+        return name
+
+    def classify_by_signature(self, frame, folder_templates, signatures):
+        """
+        Classifies the frame by its thumbnail, confirming with the state templates unless the thumbnail is sure.
+
+        Returns:
+        tuple: (name, tried) where name is the matching template's name or None, and tried the templates matched.
+        """
+        states, sure = signatures.candidates(frame)
+        by_state = {template.name.lower(): template for template in folder_templates}
+        if sure and states[0] in by_state:
+            metrics.increment('state_signature_total', result='sure')
+            return by_state[states[0]].name, []
+
+        # Break the tie between the nearest states with their templates
+        tried = []
+        for state in states[:self.fast_candidates]:
+            template = by_state.get(state)
+            if template is None:
+                continue
+            tried.append(template)
+            if ImageFinder.template_matching(frame, template, pyramid=True):
+                metrics.increment('state_signature_total', result='confirmed')
+                signatures.learn(frame, state)
+                return template.name, tried
+        metrics.increment('state_signature_total', result='miss')
+        return None, tried
+
+    def record(self, state):
+        """
+        Counts a transition from the previous state to state, and makes state the previous state.
+        """
+        with self._lock:
+            self.counts[self.previous][state] += 1
+            self.previous = state
 
 
 class MouseController:
@@ -232,8 +803,11 @@ class MouseController:
         """
         Simulate a left mouse click
         """
-        win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, 0, 0)
-        win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP, 0, 0)
+        notify_action('click')
+        metrics.increment('clicks_total')
+        with metrics.timer('click_seconds'):
+            win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, 0, 0)
+            win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP, 0, 0)
 
     @staticmethod
     def mouse_pos(*args):
@@ -253,63 +827,195 @@ class MouseController:
         else:
             raise ValueError("Expected either a tuple (x, y) or two separate arguments x and y.")
 
+        notify_action('move', x=int(x), y=int(y))
         win32api.SetCursorPos((x, y))
 
 
+class KeyboardController:
+    @staticmethod
+    def press(key):
+        """
+        Press and release a key.
+
+        Args:
+            key (str): The pyautogui name of the key, e.g. 'esc'.
+        """
+        notify_action('key', key=key)
+        pyautogui.press(key)
+
+
+# Only one instance may use the mouse and keyboard at a time, they are shared by every emulator window
+input_lock = threading.RLock()
+
+
+class InputTarget:
+    """
+    Sends clicks and key presses to one emulator window.
+
+    Coordinates are relative to the capture region, as returned by ImageFinder, and are turned into screen coordinates
+    here. A move and its click are done under input_lock, so instances running in parallel never click at a position
+    another instance moved the mouse to.
+    """
+
+    def __init__(self, capture_region, window_title=None):
+        """
+        Args:
+        capture_region (dict): The region the window is captured from.
+        window_title (str): Title of the window, brought to the front before a key press. None for the active window.
+        """
+        self.capture_region = capture_region
+        self.window_title = window_title
+
+    def click(self, x, y):
+        """
+        Moves the mouse to (x, y) inside the capture region and clicks.
+        """
+        with input_lock:
+            MouseController.mouse_pos(self.capture_region['left'] + x, self.capture_region['top'] + y)
+            MouseController.left_click()
+
+    def press(self, key):
+        """
+        Presses a key in the window.
+        """
+        with input_lock:
+            self.focus()
+            KeyboardController.press(key)
+
+    def focus(self):
+        if self.window_title is None or gw is None:
+            return
+        windows = gw.getWindowsWithTitle(self.window_title)
+        if windows and not windows[0].isActive:
+            windows[0].activate()
+
+
 class AdAutomator:
-    def __init__(self, start_no, capture_region):
+    def __init__(self, start_no, capture_region, window_title=None, name="automate_ads"):
+        """
+        Args:
+        start_no (int): The number of ads to watch for the current chest.
+        capture_region (dict): Where the emulator window is on the screen, everything the automator does stays inside.
+        window_title (str): Title of the emulator window, needed when more than one is running.
+        name (str): Name of this automator in the metrics.
+        """
         self.start_no = start_no
         self.capture_region = capture_region
+        self.window_title = window_title
+        self.name = name
+        self.input = InputTarget(capture_region, window_title)
+        self.state_classifier = StateClassifier(os.path.join(script_directory, 'snip_images', 'states'))
+        self.last_arrow = None  # Bounding box of the last arrow find_arrow found, looked at first next time
 
-    def find_arrow(self, game_region, debug=False):
+    def find_arrow(self, game_region, debug=False, frame=None, use_cache=True):
         try:
             # Capture the screen (you may need to install mss)
-            screenshot = ImageFinder.capture_screen(game_region)
-
-            # Preprocess the image (e.g., convert to HSV color space and apply thresholding)
-            hsv = cv2.cvtColor(screenshot, cv2.COLOR_BGR2HSV)
-            lower_green = np.array([40, 40, 40])
-            upper_green = np.array([70, 255, 255])
-            mask = cv2.inRange(hsv, lower_green, upper_green)
-
-            # Find contours of the thresholded image
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-            # Filter contours based on shape (e.g., aspect ratio)
-            arrow_contours = []
-            for contour in contours:
-                # Approximate the contour to reduce the number of points
-                epsilon = 0.02 * cv2.arcLength(contour, True)
-                approx = cv2.approxPolyDP(contour, epsilon, True)
-
-                # Check if the contour has a certain number of vertices (e.g., 3 for a triangle)
-                if len(approx) == 5:
-                    arrow_contours.append(contour)
-
-            # Select the contour with the largest area
-            if arrow_contours:
-                largest_contour = max(arrow_contours, key=cv2.contourArea)
-                # Get the bounding rectangle of the largest contour
-                x, y, w, h = cv2.boundingRect(largest_contour)
-                # Extract coordinates of the arrow
-                arrow_x = x + w // 2
-                arrow_y = y + h // 2
-                if debug:
-                    # Draw a rectangle around the detected arrow (for debugging)
-                    debug_image = cv2.rectangle(screenshot.copy(), (x, y), (x + w, y + h), (0, 255, 0), 2)
-                    return arrow_x, arrow_y, debug_image
-                else:
-                    return arrow_x, arrow_y, None
+            if frame is None:
+                frame = ImageFinder.capture_frame(game_region)
+            screenshot = frame.image
+
+            # Only look again if the screen changed since the last time
+            if use_cache:
+                box = change_detector.cached(('arrow', id(self), region_key(frame.region)), frame,
+                                             lambda: self.locate_arrow(screenshot))
             else:
+                box = self.locate_arrow(screenshot)
+            if box is None:
                 return None, None, None
 
+            x, y, w, h = box
+            # Extract coordinates of the arrow
+            arrow_x = x + w // 2
+            arrow_y = y + h // 2
+            if debug:
+                # Draw a rectangle around the detected arrow (for debugging)
+                debug_image = cv2.rectangle(screenshot.copy(), (x, y), (x + w, y + h), (0, 255, 0), 2)
+                return arrow_x, arrow_y, debug_image
+            else:
+                return arrow_x, arrow_y, None
+
         except (TypeError, ValueError, cv2.error) as e:
             print(f"An error occurred during image processing: {e}")
             return None, None, None
 
-    def find_state(self, should_print=True):
-        states_folder = os.path.join(script_directory, 'snip_images', 'states')
-        name, _, _ = ImageFinder.find_1_of_folder(states_folder, self.capture_region)
+    def locate_arrow(self, screenshot):
+        """
+        Finds the green arrow, first around where it was last time, then in the chest bar, then on the whole screen.
+
+        Args:
+        screenshot (np.array): The BGRA screenshot.
+
+        Returns:
+        tuple: (x, y, w, h) bounding box of the arrow in the screenshot, or None if there is no arrow.
+        """
+        height, width = screenshot.shape[:2]
+        boxes = []
+        if self.last_arrow is not None:
+            x, y, w, h = self.last_arrow
+            boxes.append(('prior', (max(x - ARROW_PADDING, 0), max(y - ARROW_PADDING, 0),
+                                    min(x + w + ARROW_PADDING, width), min(y + h + ARROW_PADDING, height))))
+        boxes.append(('band', (0, int(height * ARROW_BAND[0]), width, int(height * ARROW_BAND[1]))))
+        boxes.append(('full', (0, 0, width, height)))
+
+        for where, (left, top, right, bottom) in boxes:
+            box = self.find_arrow_in(screenshot[top:bottom, left:right])
+            if box is not None:
+                metrics.increment('arrow_search_total', where=where)
+                x, y, w, h = box
+                self.last_arrow = (x + left, y + top, w, h)
+                return self.last_arrow
+        metrics.increment('arrow_search_total', where='miss')
+        return None
+
+    @staticmethod
+    def find_arrow_in(image):
+        """
+        Finds the largest green pentagon in an image.
+
+        Args:
+        image (np.array): Part of a BGR(A) screenshot.
+
+        Returns:
+        tuple: (x, y, w, h) bounding box of the arrow in the image, or None if there is none.
+        """
+        # Look the green pixels up in GREEN_LUT instead of converting to HSV and using inRange
+        steps = image >> 3
+        index = (steps[:, :, 0].astype(np.uint16) << 10) | (steps[:, :, 1].astype(np.uint16) << 5) | steps[:, :, 2]
+        mask = GREEN_LUT.take(index)
+
+        # Find contours of the thresholded image
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        # Filter contours based on shape (e.g., aspect ratio)
+        largest, largest_area = None, 0
+        for contour in contours:
+            # Specks and large green areas can not be the arrow, skip them before the expensive approximation
+            area = cv2.contourArea(contour)
+            if area < ARROW_AREA[0] or area > ARROW_AREA[1] or area <= largest_area:
+                continue
+
+            # Approximate the contour to reduce the number of points
+            epsilon = 0.02 * cv2.arcLength(contour, True)
+            approx = cv2.approxPolyDP(contour, epsilon, True)
+
+            # Check if the contour has a certain number of vertices (e.g., 3 for a triangle)
+            if len(approx) == 5:
+                largest, largest_area = contour, area
+
+        # Select the contour with the largest area
+        if largest is None:
+            return None
+        return cv2.boundingRect(largest)
+
+    def find_state(self, should_print=True, frame=None, use_cache=True):
+        if frame is None:
+            frame = ImageFinder.capture_frame(self.capture_region)
+        # Only classify again if the screen changed since the last time
+        if use_cache:
+            name = change_detector.cached(('state', id(self), region_key(frame.region)), frame,
+                                          lambda: self.state_classifier.classify(frame))
+        else:
+            name = self.state_classifier.classify(frame)
         if name:
             if should_print:
                 print(f"{name} Scene")
@@ -321,80 +1027,17 @@ class AdAutomator:
         """
         This function automates the process of watching ads and opening chests in a game.
         It keeps track of the number of ads watched and opens chests as required.
-        """
 
-        ads_done = 1  # Initialize the number of ads watched
-        ad_no = ads_done  # Initialize the current ad number
-        running = True  # Set the running flag to True
-        ImageFinder.resize_bluestacks_window()
-
-        while running:  # Start a while loop to continue the process until running is False
-            # Print the current ad number and total ads watched
-            print(f"Ad Number: {ad_no}/{self.start_no} Total:{ads_done}")
-            self.watch_first_ad()  # Call the method to watch the first ad
-
-            print("Waiting for Advertising")  # Print a message indicating waiting for advertising
-
-            state = "advert"  # If ad number is not equal to start number, set state to "advert"
-
-            time.sleep(2)  # Pause for 2 seconds
-
-            while state == "advert":  # Start a while loop while state is "advert"
-                state = self.wait_for_ad_to_end()  # Call the method to wait for the ad to end
-
-            while state == "openchest":  # Start a while loop while state is "openchest"
-                img = os.path.join(script_directory, 'snip_images', 'open.png')
-                screenshot = ImageFinder.capture_screen(region)  # Capture the screen
-                match = ImageFinder.template_matching(screenshot, img, threshold=0.9)  # Perform template matching
-                match = ImageFinder.group_rectangles(match)  # Group the matched rectangles
-                if match and len(match) > 0:  # Check if there is a match
-                    ad_no += 1  # Increment the ad number
-                    ads_done += 1  # Increment the total ads watched
-                    print("new ad ready")  # Print a message indicating a new ad is ready
-                    break  # Break the loop
-                if ad_no + 1 > self.start_no:  # Check if the ad number is equal to the start number
-                    ad_no = 1  # Reset the ad number
-                    time.sleep(4)  # Pause for 4 seconds
-                    state = self.open_chest_and_skip()  # Call the method to open the chest and skip
-
-            while state == "home":  # Start a while loop while state is "home"
-                for _ in range(12):
-                    state = self.find_state()
-                    time.sleep(.3)
-                if state == "home":
-                    state = "open_next"
-
-            while state == "chest":  # Start a while loop while state is "chest"
-                ad_no = 1  # Reset the ad number
-                state = self.open_chest_and_skip()  # Call the method to open the chest and skip
-
-            loop_no = 0  # Initialize the loop counter
-            while state == "open_next":  # Start a while loop while state is "open_next"
-                window = self.find_state()
-                if window != "home":
-                    break
+        The states of the flow, their timeouts and the watchdog are declared in async_runtime.AsyncAdSession, this
+        runs them until there are no ads left.
+        """
+        from async_runtime import AsyncAdSession, AsyncRuntime  # It imports this module
 
-                loop_no += 1  # Increment the loop counter
-                chest_folder = os.path.join(script_directory, 'snip_images', 'chests')
-                # Find the chest image in the folder
-                name, x, y = ImageFinder.find_1_of_folder(chest_folder, self.capture_region)
-                if name:  # Check if a chest image is found
-                    print(f"{name} found")  # Print a message indicating the chest image is found
-                    # Call the method to get the amount of ads to watch
-                    self.start_no, state = self.get_amount_ads_to_watch(name, x, y)
-                if loop_no >= 120:  # Check if the loop counter is greater than or equal to 120
-                    state = self.find_state()
-                    if state == "home":
-                        state = ""
-                        # Print a message indicating the loop counter limit is reached
-                        print("loop_no over 120 reached")
-
-            while state == "free_reward":  # Start a while loop while state is "free_reward"
-                state = " "  # Set the state to an empty string
-
-            if state == "":  # Check if state is an empty string
-                running = False  # Set the running flag to False
-                print("No Ads Left")  # Print a message indicating the game is complete
+        runtime = AsyncRuntime(clock=time)  # time is a virtual clock when replaying
+        try:
+            asyncio.run(AsyncAdSession(self, runtime).run())
+        finally:
+            runtime.close()
 
     def watch_first_ad(self):
         """
@@ -414,43 +1057,43 @@ class AdAutomator:
         Clicks on the chest and then proceeds to watch a video ad.
         """
         # Find the arrow position
-        arrow_x, arrow_y, _ = self.find_arrow(region)
+        arrow_x, arrow_y, _ = self.find_arrow(self.capture_region)
 
         # If arrow not found, check ad
         if arrow_x is None or arrow_y is None:
             print("No Arrow Found Checking Ad")
         else:
             # Move the mouse to the arrow position and click
-            MouseController.mouse_pos(arrow_x, arrow_y + 30)
-            MouseController.left_click()
-            time.sleep(0.5)
+            self.input.click(arrow_x, arrow_y + 30)
 
-        # Click on the watch ad button
-        self.click_watch_ad_button()
+        # Click on the watch ad button as soon as it shows up
+        self.click_watch_ad_button(timeout=2)
 
     def watch_ad(self):
         self.click_chest_then_video()  # Corrected function name
 
-    def click_watch_ad_button(self):
+    def click_watch_ad_button(self, timeout=0):
         needle = os.path.join(script_directory, 'snip_images', 'open.png')
-        _, x, y = ImageFinder.find_needle(needle, region)
+        _, x, y = ImageFinder.wait_for_needle(needle, self.capture_region, timeout)
         if x and y:
-            MouseController.mouse_pos(x, y)
-            MouseController.left_click()
+            self.input.click(x, y)
 
     def wait_for_ad_to_end(self):
         """
         Waits for the ad to end and returns the state of the ad.
         """
+        # Take one screenshot for both the state and the close button
+        frame = ImageFinder.capture_frame(self.capture_region)
+
         # Get the state of the ad
-        state = self.find_state()
+        state = self.find_state(frame=frame)
 
         # If state exists, convert it to lowercase
         if state:
             state = state.lower()
 
         # Find and close the ad
-        self.find_close()
+        self.find_close(frame=frame)
 
         # Return the state of the ad
         return state
@@ -466,27 +1109,28 @@ class AdAutomator:
 
         # Loop until the chest is opened and screens are skipped
         while True:
-            # Find the "Skip" button
-            _, x, y = ImageFinder.find_needle(img_skip, self.capture_region)
+            # Wait for the "Skip" button
+            _, x, y = ImageFinder.wait_for_needle(img_skip, self.capture_region, timeout=60, min_interval=0.1,
+                                                  max_interval=0.5)
+            if not x:
+                print("Skip button never showed up")
+                return "open_next"
+
+            # Click the "Skip" button
+            print("Skipping Opening")
+            self.input.click(x, y)
+
+            # Wait for the "Continue" button
+            _, x, y = ImageFinder.wait_for_needle(img_continue, self.capture_region, timeout=5)
             if x:
-                # Click the "Skip" button
-                print("Skipping Opening")
-                MouseController.mouse_pos(x, y)
-                MouseController.left_click()
-                time.sleep(3)
-                # Find the "Continue" button
-                _, x, y = ImageFinder.find_needle(img_continue, self.capture_region)
-                if x:
-                    # Click the "Continue" button
-                    print("Continue")
-                    MouseController.mouse_pos(x, y)
-                    MouseController.left_click()
-                    time.sleep(2)
-                    # Set the state to open the next chest
-                    state = "open_next"
-                    return state
-            else:
-                time.sleep(.5)
+                # Click the "Continue" button
+                print("Continue")
+                self.input.click(x, y)
+                wait_for(lambda: ImageFinder.find_needle(img_continue, self.capture_region)[1] is None, timeout=2,
+                         description="the continue button to go away", raise_on_timeout=False)
+                # Set the state to open the next chest
+                state = "open_next"
+                return state
 
     def get_amount_ads_to_watch(self, name, x, y):
         """
@@ -530,52 +1174,63 @@ class AdAutomator:
         img = os.path.join(script_directory, 'snip_images', 'start.png')
 
         # Move the mouse to the specified coordinates and click
-        MouseController.mouse_pos(x, y)
-        MouseController.left_click()
-        time.sleep(2)
+        self.input.click(x, y)
 
-        # Find the start.png image and click on it if found
-        _, x, y = ImageFinder.find_needle(img, region)
+        # Wait for the start.png image and click on it if found
+        _, x, y = ImageFinder.wait_for_needle(img, self.capture_region, timeout=2)
         if x and y:
-            MouseController.mouse_pos(x, y)
-            MouseController.left_click()
-            time.sleep(2)
+            self.input.click(x, y)
+            wait_for(lambda: ImageFinder.find_needle(img, self.capture_region)[1] is None, timeout=2,
+                     description="the start button to go away", raise_on_timeout=False)
 
     # enables code completion
-    def find_close(self):
+    def find_close(self, frame=None, escape=True):
         """
         Finds and clicks on a close button within a folder.
+
+        Args:
+        frame (Frame): Already captured frame to search, a new one is captured if not given.
+        escape (bool): Press Esc first.
         """
         # Press the escape key
-        pyautogui.press('esc')
+        if escape:
+            self.input.press('esc')
 
         # Define the folder path for close button images
         close_folder = os.path.join(script_directory, 'snip_images', 'close')
-        # Find the first image in the folder
-        name, x, y = ImageFinder.find_1_of_folder(close_folder, self.capture_region)
+        if frame is None:
+            frame = ImageFinder.capture_frame(self.capture_region)
+        # Find the first image in the folder. Not cached: some close buttons are too faint to change the frame
+        # signature when they fade in on a still end card, and a cached miss would never be looked at again
+        match = ImageFinder.find_1_of_folder(close_folder, self.capture_region, frame=frame, use_cache=False)
+        name, x, y = match
 
         # Check if the image is found at the expected position (adjust if you find an x that is different)
         if x and x > 10 and y < 700:
             string = f"{name} found"
 
             # Add match percentage to the string if available
-            if match_percent:
-                string += f" with {match_percent}% Confidence"
+            if match.percent:
+                string += f" with {match.percent}% Confidence"
 
             # Print the result string
             print(string)
+            metrics.increment('close_clicks_total', button=name)
 
-            # Move the mouse to the found location
-            MouseController.mouse_pos(x, y)
-
-            # Perform a left click
-            MouseController.left_click()
+            # Move the mouse to the found location and click
+            self.input.click(x, y)
 
-            # Wait for 1 second
-            time.sleep(1)
+            # Wait up to 1 second for the screen to react
+            ImageFinder.wait_for_change(self.capture_region, frame, timeout=1)
 
 
 if __name__ == '__main__':
+    sys.modules['ad_skip_test'] = sys.modules[__name__]  # So modules importing ad_skip_test share this one
     region = {'left': 0, 'top': 0, 'width': 500, 'height': 915}  # Adjust as needed
+    capture_backend = MssBackend(region)
+    from recorder import record_from_env
+    record_from_env(region, sys.modules[__name__])
+    export_from_env(metrics)
+    capture_service = CaptureService(capture_backend, fps=10).start()  # Keeps grabbing in the background
     ads_automator = AdAutomator(8, region)
     ads_automator.automate_ads()
@@ -0,0 +1,298 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+
+import ad_skip_test as askip
+from capture import signatures_differ
+from state_machine import State, StateMachine, Watchdog
+
+# Time limits of the ad session states, in seconds
+AD_TIMEOUT = 180  # Longest an ad is looked at before starting over
+OPENCHEST_TIMEOUT = 60  # Longest to wait for the next ad to be ready
+HOME_SETTLE = 3.6  # How long the home screen has to stay before looking for a chest, 12 looks 0.3 seconds apart
+OPEN_NEXT_TIMEOUT = 40  # Longest to look for a chest to open, about the 120 looks it used to be
+STALL_TIMEOUT = 300  # Longest without watching an ad or opening a chest before the watchdog steps in
+
+# Screens of the game an ad can end on that have no state of their own, the round starts again from them
+OTHER_SCREENS = ("postgame", "shop", "deal", "mail", "rank", "bullet", "gun")
+
+
+class AsyncRuntime:
+    """
+    Runs the automation as coroutines on one event loop.
+
+    Capturing and template matching block (mss, OpenCV), so they run on one shared thread pool and are awaited. Waiting
+    is done with asyncio sleeps and events instead of time.sleep, so a session that is waiting holds no thread, and any
+    number of sessions and reward timer watchers can share one loop and one pool.
+    """
+
+    def __init__(self, max_workers=None, clock=time):
+        """
+        Args:
+        max_workers (int): Size of the thread pool for blocking work, the ThreadPoolExecutor default if None.
+        clock: Where the time comes from, a replay.VirtualClock when replaying.
+        """
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="runtime")
+        self.clock = clock
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs a blocking function on the thread pool and waits for its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    async def sleep(self, seconds):
+        if self.clock is time:
+            await asyncio.sleep(seconds)
+        else:
+            # A virtual clock only moves forward when it is slept on, let other coroutines run in the meantime
+            self.clock.sleep(seconds)
+            await asyncio.sleep(0)
+
+    async def next_frame(self, timeout=None, interval=0.1):
+        """
+        Waits until the capture service publishes a new frame.
+
+        Without a capture service there are no frames to wait for, so it just sleeps for interval. A service that
+        can not call listeners (e.g. a frame_bus.BusReader) is waited on in the thread pool instead.
+
+        Args:
+        timeout (float): The longest to wait, forever if None.
+        interval (float): How long to sleep without a capture service.
+        """
+        service = askip.capture_service
+        if service is None or self.clock is not time:
+            await self.sleep(interval if timeout is None else min(interval, timeout))
+            return
+        if not hasattr(service, 'add_listener'):
+            await self.run(service.wait_for_frame, timeout=timeout)
+            return
+        loop = asyncio.get_running_loop()
+        published = asyncio.Event()
+
+        def listener(_):
+            # Called on the capture thread
+            loop.call_soon_threadsafe(published.set)
+
+        service.add_listener(listener)
+        try:
+            await asyncio.wait_for(published.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            service.remove_listener(listener)
+
+    async def wait_for(self, predicate, timeout=None, min_interval=0.05, max_interval=1.0, action=None,
+                       description=None, raise_on_timeout=True):
+        """
+        The awaitable version of ad_skip_test.wait_for, with the same arguments.
+
+        predicate and action are blocking functions, they run on the thread pool.
+        """
+        deadline = None if timeout is None else self.monotonic() + timeout
+        interval = min_interval
+        while True:
+            result = await self.run(predicate)
+            if result:
+                return result
+            if action is not None and await self.run(action):
+                interval = min_interval
+            remaining = None if deadline is None else deadline - self.monotonic()
+            if remaining is not None and remaining <= 0:
+                message = f"Timed out after {timeout}s waiting for {description or 'condition'}"
+                if raise_on_timeout:
+                    raise TimeoutError(message)
+                print(message)
+                return None
+            await self.sleep(interval if remaining is None else min(interval, remaining))
+            interval = min(interval * 1.5, max_interval)
+
+    async def wait_for_change(self, cap_region, frame, timeout=None):
+        """
+        The awaitable version of ImageFinder.wait_for_change.
+
+        Returns:
+        Frame: The first changed frame, or None if the timeout ran out.
+        """
+        reference = frame.signature()
+        deadline = None if timeout is None else self.monotonic() + timeout
+        while deadline is None or self.monotonic() < deadline:
+            await self.next_frame(None if deadline is None else max(deadline - self.monotonic(), 0))
+            new_frame = await self.run(askip.ImageFinder.capture_frame, cap_region)
+            if signatures_differ(reference, new_frame.signature(), askip.change_detector.tolerance):
+                return new_frame
+        return None
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncAdSession:
+    """
+    AdAutomator.automate_ads as a table of states run by a StateMachine.
+
+    Every state does one step of what automate_ads used to do in its while block. Where the blocks polled a fixed
+    number of times (12 looks at the home screen, 120 looks for the next chest) the states have a timeout instead,
+    and a watchdog presses Esc, closes whatever is open and finally restarts the game if the session goes round
+    without getting anywhere.
+    """
+
+    def __init__(self, automator, runtime, restart=None):
+        """
+        Args:
+        automator (AdAutomator): The instance to drive, it owns the capture region and input target.
+        runtime (AsyncRuntime): The runtime shared with the other sessions.
+        restart (callable): Coroutine function that restarts the game, the last recovery of the watchdog. Without it
+            the session stops with StuckError when Esc and the close buttons did not help.
+        """
+        self.automator = automator
+        self.runtime = runtime
+        self.restart = restart
+        self.ads_done = 1
+        self.ad_no = 1
+
+    def _on_screen(self, name):
+        # Detector for a state that has a screen of its own
+        return lambda: self.automator.find_state(should_print=False) == name
+
+    def machine(self):
+        """
+        Returns:
+        StateMachine: The states of an ad session, ready to run.
+        """
+        rounds = ["start", "openchest", "home", "chest", "open_next", "free_reward"]
+        # Every screen find_state can answer in a round, "advert" if no state template matches
+        screens = rounds + ["advert"] + list(OTHER_SCREENS)
+        states = [
+            State("start", self.start, transitions=["advert"]),
+            # Ads that never end are given up on, the round starts again
+            State("advert", self.advert, transitions=screens, timeout=AD_TIMEOUT, on_timeout="start"),
+            State("openchest", self.openchest, transitions=["start", "open_next"], timeout=OPENCHEST_TIMEOUT,
+                  on_timeout="start", progress=True, detector=self._on_screen("openchest")),
+            State("home", self.home, transitions=screens, timeout=HOME_SETTLE, on_timeout="open_next", progress=True,
+                  detector=self._on_screen("home")),
+            State("chest", self.chest, transitions=["open_next"], progress=True, detector=self._on_screen("chest")),
+            State("open_next", self.open_next, transitions=screens, timeout=OPEN_NEXT_TIMEOUT,
+                  on_timeout="no_chest", progress=True),
+            State("no_chest", self.no_chest, transitions=["start", "done"]),
+            State("free_reward", self.free_reward, transitions=["start"]),
+        ]
+        states += [State(screen, self.other_screen, transitions=["start"]) for screen in OTHER_SCREENS]
+        recoveries = [("esc", self.press_esc), ("close", self.close)]
+        if self.restart is not None:
+            recoveries.append(("restart", self.restart))
+        return StateMachine(self.automator.name, states, "start", self.runtime,
+                            watchdog=Watchdog(STALL_TIMEOUT, recoveries))
+
+    async def run(self):
+        automator = self.automator
+        await self.runtime.run(askip.ImageFinder.resize_bluestacks_window, automator.window_title or "bluestacks",
+                               automator.capture_region)
+        await self.machine().run()
+        print("No Ads Left")
+
+    async def start(self, machine):
+        automator = self.automator
+        print(f"Ad Number: {self.ad_no}/{automator.start_no} Total:{self.ads_done}")
+        await self.runtime.run(automator.watch_first_ad)
+        print("Waiting for Advertising")
+        # Give the ad up to 2 seconds to start
+        await self.runtime.wait_for(lambda: automator.find_state(should_print=False) == "advert", timeout=2,
+                                    description="the ad to start", raise_on_timeout=False)
+        return "advert"
+
+    async def advert(self, machine):
+        # Look for the close button, one screenshot per step, until the ad is over
+        return await self.runtime.run(self.automator.wait_for_ad_to_end)
+
+    async def other_screen(self, machine):
+        # Nothing to do on this screen, start the round again
+        return "start"
+
+    async def openchest(self, machine):
+        automator = self.automator
+        img = os.path.join(askip.script_directory, 'snip_images', 'open.png')
+        frame = await self.runtime.run(askip.ImageFinder.capture_frame, automator.capture_region)
+        match = await self.runtime.run(askip.ImageFinder.template_matching, frame, img, threshold=0.9)
+        if match:
+            self.ad_no += 1
+            self.ads_done += 1
+            askip.metrics.increment('ads_watched_total')
+            print("new ad ready")
+            return "start"
+        if self.ad_no + 1 > automator.start_no:
+            self.ad_no = 1
+            return await self.runtime.run(automator.open_chest_and_skip)
+        await self.runtime.wait_for_change(automator.capture_region, frame, timeout=1)
+        return "openchest"
+
+    async def home(self, machine):
+        # Stay until the home screen settled (the timeout) or the game moved on by itself
+        state = await self.runtime.run(self.automator.find_state)
+        if state == "home":
+            await self.runtime.sleep(.3)
+        return state
+
+    async def chest(self, machine):
+        self.ad_no = 1
+        return await self.runtime.run(self.automator.open_chest_and_skip)
+
+    async def open_next(self, machine):
+        automator = self.automator
+        frame = await self.runtime.run(askip.ImageFinder.capture_frame, automator.capture_region)
+        window = await self.runtime.run(automator.find_state, frame=frame)
+        if window != "home":
+            return "start"
+        chest_folder = os.path.join(askip.script_directory, 'snip_images', 'chests')
+        name, x, y = await self.runtime.run(askip.ImageFinder.find_1_of_folder, chest_folder,
+                                            automator.capture_region, frame=frame)
+        if name:
+            print(f"{name} found")
+            automator.start_no, _ = await self.runtime.run(automator.get_amount_ads_to_watch, name, x, y)
+            return "start"
+        return "open_next"
+
+    async def no_chest(self, machine):
+        # No chest to open for OPEN_NEXT_TIMEOUT seconds, done if the game is still on the home screen
+        if await self.runtime.run(self.automator.find_state) == "home":
+            print(f"No chest found in {OPEN_NEXT_TIMEOUT} seconds")
+            return "done"
+        return "start"
+
+    async def free_reward(self, machine):
+        return "start"
+
+    async def press_esc(self, machine):
+        await self.runtime.run(self.automator.input.press, 'esc')
+
+    async def close(self, machine):
+        await self.runtime.run(self.automator.find_close)
+
+
+async def run_sessions(automators, runtime=None, watchers=()):
+    """
+    Runs several ad sessions, and any other coroutines such as the game_test reward timer watcher, on one loop.
+
+    Args:
+    automators (list): One AdAutomator per emulator window.
+    runtime (AsyncRuntime): The runtime to share, a new one (closed at the end) if None. A runtime that is passed
+        in stays open, its owner closes it.
+    watchers (iterable): More coroutines to run alongside the sessions.
+
+    Returns:
+    list: The result of every session and watcher, or the exception it stopped with.
+    """
+    owned = runtime is None
+    runtime = runtime or AsyncRuntime()
+    sessions = [AsyncAdSession(automator, runtime).run() for automator in automators]
+    try:
+        return await asyncio.gather(*sessions, *watchers, return_exceptions=True)
+    finally:
+        if owned:
+            runtime.close()
@@ -0,0 +1,26 @@
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Opens a temporary file next to path to write, and moves it over path once it is written, so a crash never leaves
+    a half written file and readers only ever see a whole one.
+
+    Args:
+    path (str): The file to write.
+    mode (str): The mode to open the temporary file in, "w" or "wb".
+
+    Returns:
+    file: The open temporary file.
+    """
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, mode) as f:
+            yield f
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
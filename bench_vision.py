@@ -0,0 +1,473 @@
+import argparse
+import atexit
+import glob
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import ad_skip_test as askip
+from capture import ArrayBackend, ChangeDetector, Frame
+from frame_bus import FrameBus
+from hotspots import HotspotIndex
+from match_pool import MODES, MatchPool
+from state_signatures import StateSignatures
+from timer_ocr import DigitRecognizer, TimerReader
+
+script_directory = os.path.dirname(__file__)
+snip_images = os.path.join(script_directory, 'snip_images')
+region = {'left': 0, 'top': 0, 'width': 500, 'height': 915}
+
+DEFAULT_BASELINE = os.path.join(script_directory, 'bench_baseline.json')
+
+# Stands in for adb in check_adb_backend, answering screencap the way a device does. Frame n of a shell has red n
+FAKE_ADB = r"""
+import struct
+import sys
+import time
+
+WIDTH, HEIGHT = 50, 80
+args = sys.argv[1:]
+if args[:1] == ['-s']:
+    args = args[2:]
+
+
+def screencap(n):
+    sys.stdout.buffer.write(struct.pack('<IIII', WIDTH, HEIGHT, 1, 0) + bytes([n % 256, 0, 0, 255]) * WIDTH * HEIGHT)
+    sys.stdout.buffer.flush()
+
+
+if args == ['exec-out', 'screencap']:
+    screencap(0)
+elif args == ['shell', '-T', 'sh']:
+    for n, line in enumerate(sys.stdin.buffer, 1):
+        if line.strip() == b'screencap':
+            screencap(n)
+else:
+    time.sleep(3600)  # E.g. exec-out sh, which never gets the commands written to it
+"""
+
+
+def make_haystack(image_paths, seed=0):
+    """
+    Builds a synthetic 500x915 screenshot with the given snip_images templates pasted onto it.
+
+    The background is a smooth gradient with some noise, so templates do not match it by accident.
+
+    Args:
+    image_paths (list): Paths of the templates to paste, each at a random spot where it does not overlap another.
+    seed (int): Seed for the background and the positions, so every run uses the same haystack.
+
+    Returns:
+    tuple: (BGRA image, {path: (center x, center y)})
+    """
+    rng = np.random.RandomState(seed)
+    height, width = region['height'], region['width']
+    gradient = np.linspace(30, 120, height, dtype=np.float32)[:, None, None]
+    noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    background = cv2.GaussianBlur(np.clip(gradient + noise, 0, 255).astype(np.uint8), (5, 5), 0)
+    haystack = cv2.cvtColor(background, cv2.COLOR_BGR2BGRA)
+
+    taken = np.zeros((height, width), bool)
+    positions = {}
+    for path in image_paths:
+        needle = cv2.imread(path, cv2.IMREAD_COLOR)
+        needle_height, needle_width = needle.shape[:2]
+        for _ in range(100):
+            x = rng.randint(0, width - needle_width)
+            y = rng.randint(0, height - needle_height)
+            if not taken[y:y + needle_height, x:x + needle_width].any():
+                break
+        taken[y:y + needle_height, x:x + needle_width] = True
+        haystack[y:y + needle_height, x:x + needle_width, :3] = needle
+        positions[path] = (x + needle_width // 2, y + needle_height // 2)
+    return haystack, positions
+
+
+def draw_arrow(haystack, x=250, y=760):
+    """
+    Draws a green pentagon like the arrow above the chest slots, centered at (x, y).
+    """
+    points = np.array([[x - 12, y - 14], [x + 12, y - 14], [x + 12, y + 2], [x, y + 14], [x - 12, y + 2]], np.int32)
+    cv2.fillPoly(haystack, [points], (60, 200, 60, 255))
+    return haystack
+
+
+def draw_timer(text="01:23:45"):
+    """
+    Draws a white reward timer on a dark background, the same size as the regions from find_timer_regions.
+    """
+    image = np.full((35, 124, 4), 50, np.uint8)
+    cv2.putText(image, text, (6, 26), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255, 255), 2)
+    return image
+
+
+def measure(function, repeat=50, warmup=3):
+    """
+    Times a function and measures how much memory one call allocates.
+
+    Args:
+    function (callable): Called without arguments.
+    repeat (int): How many timed calls to make.
+    warmup (int): How many untimed calls to make first (fills caches, starts thread pools).
+
+    Returns:
+    dict: Latency percentiles in milliseconds and the peak memory allocated during one call in KiB.
+    """
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    # Allocations are measured separately, tracemalloc slows everything down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    samples = np.array(samples)
+    return {
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'p99': float(np.percentile(samples, 99)),
+        'mean': float(samples.mean()),
+        'alloc_kib': (peak - before) / 1024,
+        'calls': repeat,
+    }
+
+
+def build_benchmarks():
+    """
+    Returns the benchmarks as a list of (name, function) on fixed synthetic haystacks.
+    """
+    states = os.path.join(snip_images, 'states')
+    close = os.path.join(snip_images, 'close')
+    chests = os.path.join(snip_images, 'chests')
+    open_png = os.path.join(snip_images, 'open.png')
+
+    haystack, _ = make_haystack([os.path.join(states, 'Home.png'), os.path.join(close, 'cross3.png'),
+                                 os.path.join(chests, 'silver_chest.png'), open_png])
+    draw_arrow(haystack)
+    empty, _ = make_haystack([], seed=1)
+    rewards, _ = make_haystack([os.path.join(snip_images, 'collect_rewards', name)
+                                for name in ('Free_Chest.png', 'Free_Gems.png', 'Free_Gold_Chest.png')], seed=2)
+
+    def fresh_frame(image):
+        # A new Frame every call, so no cached views are reused between calls
+        return lambda: Frame(image, region)
+
+    frame = fresh_frame(haystack)
+    automator = askip.AdAutomator(8, region)
+    raw_matches = [('cross', x, y) for x in range(100, 112) for y in range(200, 212)]
+
+    learned = StateSignatures()
+    learned.learn(Frame(haystack, region), 'home')
+    # The synthetic screens only differ by a few templates, an inverted one stands in for a different state screen
+    learned.learn(Frame(255 - empty, region), 'shop')
+
+    def classify(signatures):
+        # StateClassifier.classify with or without the thumbnail fast path
+        def run_classify():
+            saved, askip.state_signatures = askip.state_signatures, signatures
+            try:
+                return automator.state_classifier.classify(frame())
+            finally:
+                askip.state_signatures = saved
+        return run_classify
+
+    benchmarks = [
+        ("template_matching open.png (full frame)",
+         lambda: askip.ImageFinder.template_matching(frame(), open_png, use_hotspots=False)),
+        ("template_matching open.png (hotspots)",
+         lambda: askip.ImageFinder.template_matching(frame(), open_png)),
+        ("template_matching open.png (miss)",
+         lambda: askip.ImageFinder.template_matching(fresh_frame(empty)(), open_png, use_hotspots=False)),
+        ("template_matching Free_Gold_Chest.png (pyramid)",
+         lambda: askip.ImageFinder.template_matching(
+             fresh_frame(rewards)(), os.path.join(snip_images, 'collect_rewards', 'Free_Gold_Chest.png'),
+             use_hotspots=False, pyramid=True)),
+        ("find_needle open.png",
+         lambda: askip.ImageFinder.find_needle(open_png, region, frame=frame(), use_cache=False)),
+        ("find_1_of_folder states",
+         lambda: askip.ImageFinder.find_1_of_folder(states, region, frame=frame(), use_cache=False)),
+        ("find_1_of_folder states (pyramid)",
+         lambda: askip.ImageFinder.find_1_of_folder(states, region, frame=frame(), pyramid=True, use_cache=False)),
+        ("find_1_of_folder close",
+         lambda: askip.ImageFinder.find_1_of_folder(close, region, frame=frame(), use_cache=False)),
+        ("find_1_of_folder close (miss)",
+         lambda: askip.ImageFinder.find_1_of_folder(close, region, frame=fresh_frame(empty)(), use_cache=False)),
+        ("find_1_of_folder chests",
+         lambda: askip.ImageFinder.find_1_of_folder(chests, region, frame=frame(), use_cache=False)),
+        ("find_state",
+         lambda: automator.find_state(should_print=False, frame=frame(), use_cache=False)),
+        ("find_state (cached)",
+         lambda: automator.find_state(should_print=False, frame=frame())),
+        ("StateClassifier.classify (templates)", classify(None)),
+        ("StateClassifier.classify (signatures)", classify(learned)),
+        ("StateSignatures.candidates",
+         lambda: learned.candidates(frame())),
+        ("group_rectangles 144 hits",
+         lambda: askip.ImageFinder.group_rectangles(raw_matches)),
+        ("find_arrow",
+         lambda: automator.find_arrow(region, frame=frame(), use_cache=False)),
+        ("find_arrow (cached)",
+         lambda: automator.find_arrow(region, frame=frame())),
+        ("locate_arrow (chest bar)",
+         lambda: (setattr(automator, 'last_arrow', None), automator.locate_arrow(haystack))),
+        ("locate_arrow (last position)",
+         lambda: automator.locate_arrow(haystack)),
+        ("locate_arrow (miss)",
+         lambda: automator.locate_arrow(empty)),
+    ]
+
+    def with_pool(pool, function):
+        # Runs function with another match pool
+        def run_with_pool():
+            saved, askip.match_pool = askip.match_pool, pool
+            try:
+                return function()
+            finally:
+                askip.match_pool = saved
+        return run_with_pool
+
+    def folder_scan(folder, image=haystack, multiple=False):
+        return lambda: askip.ImageFinder.find_1_of_folder(folder, region, multiple=multiple,
+                                                           frame=fresh_frame(image)(), use_cache=False)
+
+    # Throughput of both pool modes
+    for mode in MODES:
+        pool = MatchPool(mode)
+        benchmarks += [
+            (f"find_1_of_folder states ({mode} pool)", with_pool(pool, folder_scan(states))),
+            (f"find_1_of_folder states multiple ({mode} pool)", with_pool(pool, folder_scan(states, multiple=True))),
+            (f"find_1_of_folder close ({mode} pool)", with_pool(pool, folder_scan(close))),
+            (f"find_1_of_folder close miss ({mode} pool)", with_pool(pool, folder_scan(close, empty))),
+        ]
+
+    # Handing a frame to a detector process: copied once into the frame bus and read in place, or pickled the way a
+    # multiprocessing queue sends it
+    bus = FrameBus(create=True, slots=2, readers=1)
+    atexit.register(bus.close)
+    bus_reader = bus.reader(0)
+
+    def through_bus():
+        bus.publish(haystack, region)
+        return bus_reader.read().image
+
+    benchmarks += [
+        ("frame bus publish + read", through_bus),
+        ("pickle frame", lambda: pickle.loads(pickle.dumps(haystack, protocol=pickle.HIGHEST_PROTOCOL))),
+    ]
+
+    try:
+        import game_test
+    except ImportError as e:
+        print(f"Skipping game_test benchmarks: {e}")
+        return benchmarks
+
+    timer = draw_timer()
+    benchmarks.append(("game_test.process_image", lambda: game_test.process_image(timer)))
+    timer_region = {'left': 0, 'top': 0, 'width': 124, 'height': 35}
+    # A reader that knows the glyphs of the drawn timer, so the timer is really read instead of failing every time
+    recognizer = DigitRecognizer()
+    recognizer.learn(game_test.process_image(timer), "01:23:45")
+    reader = TimerReader(game_test.process_image, recognizer)
+
+    def read_timer():
+        # Without the cache, so the recognizer really runs every time
+        saved, game_test.timer_reader = game_test.timer_reader, reader
+        try:
+            reader.clear()
+            return game_test.get_timer_text(timer_region, Frame(timer, timer_region))
+        finally:
+            game_test.timer_reader = saved
+
+    def read_timer_cached():
+        saved, game_test.timer_reader = game_test.timer_reader, reader
+        try:
+            return game_test.get_timer_text(timer_region, Frame(timer, timer_region))
+        finally:
+            game_test.timer_reader = saved
+
+    try:
+        read_timer()
+    except Exception as e:  # Tesseract itself is not installed
+        print(f"Skipping game_test.get_timer_text: {e}")
+    else:
+        benchmarks.append(("game_test.get_timer_text", read_timer))
+        benchmarks.append(("game_test.get_timer_text (cached)", read_timer_cached))
+    return benchmarks
+
+
+def run(repeat=50, name_filter=None):
+    """
+    Runs every benchmark whose name contains name_filter.
+
+    Returns:
+    dict: {benchmark name: measure() result}
+    """
+    # Start from a clean slate, and keep what the benchmark learns out of hotspots.json and state_signatures.npz
+    askip.hotspots = HotspotIndex()
+    askip.state_signatures = StateSignatures()
+    askip.change_detector = ChangeDetector()
+    results = {}
+    for name, function in build_benchmarks():
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(function, repeat)
+        print_result(name, results[name])
+    return results
+
+
+def print_result(name, result, baseline=None):
+    line = (f"{name:<50} p50 {result['p50']:8.3f}ms  p90 {result['p90']:8.3f}ms  p99 {result['p99']:8.3f}ms  "
+            f"{1000 / result['mean']:8.1f}/s  alloc {result['alloc_kib']:9.1f}KiB")
+    if baseline:
+        line += f"  ({result['p50'] / baseline['p50']:.2f}x baseline p50)"
+    print(line)
+
+
+def check_close_buttons():
+    """
+    Checks that find_close finds every close button that appears on a screen that did not change otherwise.
+
+    Every close template is pasted onto a still background of its own border colour, the way a button fades in on
+    an ad's end card, centred on a corner of the 16x16 blocks of the frame signature so it changes them as little as
+    possible. find_close first looks at the empty background, then at the same background with the button, and has
+    to click the button the second time.
+
+    Returns:
+    list: Names of the close templates that were missed, empty if all were found.
+    """
+    from replay import FakeKeyboardController, FakeMouseController
+
+    close = os.path.join(snip_images, 'close')
+    clicks = []
+
+    def listen(kind, data):
+        if kind == 'move':
+            clicks.append((data['x'], data['y']))
+
+    saved = [(name, getattr(askip, name)) for name in ('MouseController', 'KeyboardController', 'capture_backend',
+                                                       'capture_service', 'change_detector', 'hotspots',
+                                                       'state_signatures')]
+    askip.MouseController, askip.KeyboardController = FakeMouseController, FakeKeyboardController
+    askip.capture_service, askip.change_detector = None, ChangeDetector()
+    # Keep the synthetic buttons out of hotspots.json and state_signatures.npz, like run()
+    askip.hotspots, askip.state_signatures = HotspotIndex(), StateSignatures()
+    askip.action_listeners.append(listen)
+    missed = []
+    try:
+        automator = askip.AdAutomator(8, region)
+        for path in sorted(glob.glob(os.path.join(close, '*.png'))):
+            needle = cv2.imread(path, cv2.IMREAD_COLOR)
+            border = np.concatenate([needle[0], needle[-1], needle[:, 0], needle[:, -1]])
+            colours, counts = np.unique(border, axis=0, return_counts=True)
+            background = np.empty((region['height'], region['width'], 4), np.uint8)
+            background[:, :, :3] = colours[np.argmax(counts)]  # The most common border colour
+            background[:, :, 3] = 255
+            with_button = background.copy()
+            top, left = 304 - needle.shape[0] // 2, 208 - needle.shape[1] // 2
+            with_button[top:top + needle.shape[0], left:left + needle.shape[1], :3] = needle
+
+            askip.capture_backend = ArrayBackend([background], region)
+            automator.find_close(frame=Frame(background, region))
+            askip.capture_backend = ArrayBackend([with_button], region)
+            del clicks[:]
+            automator.find_close(frame=Frame(with_button, region))
+            if not any(abs(x - 208) <= 5 and abs(y - 304) <= 5 for x, y in clicks):
+                missed.append(os.path.basename(path))
+    finally:
+        askip.action_listeners.remove(listen)
+        for name, value in saved:
+            setattr(askip, name, value)
+    return missed
+
+
+def check_adb_backend(timeout=10):
+    """
+    Checks that AdbBackend gets frames, with one adb process per frame and through a persistent shell, from a fake
+    adb that answers like a device.
+
+    Returns:
+    list: The modes that did not get the right frames within timeout seconds, empty if both did.
+    """
+    import subprocess
+    import tempfile
+    import threading
+    from capture import AdbBackend
+
+    failed = []
+    with tempfile.TemporaryDirectory() as folder:
+        fake_adb = os.path.join(folder, 'fake_adb.py')
+        with open(fake_adb, 'w') as f:
+            f.write(FAKE_ADB)
+        for persistent, mode, expected in ((False, "per frame", [0, 0, 0]), (True, "persistent", [1, 2, 3])):
+            backend = AdbBackend("emulator-5554", [sys.executable, fake_adb], persistent=persistent)
+            images = []
+
+            def grab_three(adb_backend=backend, grabbed=images, name=mode):
+                try:
+                    adb_backend.open()
+                    grabbed.extend(adb_backend.grab() for _ in range(3))
+                except (OSError, EOFError, ValueError, subprocess.CalledProcessError) as e:
+                    print(f"adb capture ({name}): {e!r}")
+
+            thread = threading.Thread(target=grab_three, daemon=True)
+            thread.start()
+            thread.join(timeout)
+            backend.close()  # Also ends a grab that is stuck, the fake adb goes away
+            if (thread.is_alive() or [int(image[0, 0, 2]) for image in images] != expected
+                    or images[0].shape != (80, 50, 4)):
+                failed.append(mode)
+    return failed
+
+
+def compare(results, baseline):
+    """
+    Prints every result next to its baseline.
+    """
+    print("\nCompared to baseline:")
+    for name, result in results.items():
+        if name in baseline:
+            print_result(name, result, baseline[name])
+        else:
+            print_result(name, result)
+            print("    (not in baseline)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the vision hot paths on synthetic screenshots")
+    parser.add_argument('--repeat', type=int, default=50, help="timed calls per benchmark")
+    parser.add_argument('--filter', help="only run benchmarks whose name contains this")
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE, help="store the results as the baseline")
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, help="compare against a stored baseline")
+    parser.add_argument('--check', action='store_true', help="only check that every close button is found and that "
+                                                                 "the adb backend gets frames")
+    args = parser.parse_args()
+
+    if args.check:
+        missed_buttons = check_close_buttons()
+        print(f"Close buttons missed: {', '.join(missed_buttons)}" if missed_buttons else "Every close button found")
+        failed_modes = check_adb_backend()
+        print(f"adb capture failed: {', '.join(failed_modes)}" if failed_modes else "adb capture works")
+        sys.exit(1 if missed_buttons or failed_modes else 0)
+
+    bench_results = run(args.repeat, args.filter)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(bench_results, json.load(f))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(bench_results, f, indent=1, sort_keys=True)
+        print(f"Baseline saved to {args.save}")
@@ -0,0 +1,650 @@
+import collections
+import os
+import struct
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Frames are compared on a copy this much smaller, one value per 16x16 block
+SIGNATURE_SCALE = 1 / 16
+
+
+class Frame:
+    """
+    A single screenshot, captured once per tick and shared by every detector that looks at it.
+
+    The grayscale, HSV and downscaled views are only worked out the first time something asks for them,
+    and are then kept so the next detector gets them for free.
+    """
+
+    def __init__(self, image, region=None, timestamp=None, seq=None):
+        """
+        Args:
+        image (np.array): The BGRA (or BGR) screenshot.
+        region (dict): The screen region the screenshot was taken from.
+        timestamp (float): When the screenshot was taken, defaults to now.
+        seq (int): Sequence number given by the CaptureService that published the frame.
+        """
+        self.image = image
+        self.region = region
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.seq = seq
+        self._gray = None
+        self._hsv = None
+        self._downscaled = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    @property
+    def width(self):
+        return self.image.shape[1]
+
+    @property
+    def height(self):
+        return self.image.shape[0]
+
+    @property
+    def gray(self):
+        """
+        np.array: The grayscale view of the screenshot.
+        """
+        if self._gray is None:
+            with self._lock:
+                if self._gray is None:
+                    if self.image.ndim == 2:
+                        self._gray = self.image
+                    else:
+                        self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        return self._gray
+
+    @property
+    def hsv(self):
+        """
+        np.array: The HSV view of the screenshot.
+        """
+        if self._hsv is None:
+            with self._lock:
+                if self._hsv is None:
+                    self._hsv = cv2.cvtColor(self.image[:, :, :3], cv2.COLOR_BGR2HSV)
+        return self._hsv
+
+    def downscaled(self, scale=0.5, gray=True):
+        """
+        Returns a smaller copy of the screenshot.
+
+        Args:
+        scale (float): The size of the copy compared to the screenshot.
+        gray (bool): Downscale the grayscale view instead of the colour image.
+
+        Returns:
+        np.array: The downscaled image.
+        """
+        key = (scale, gray)
+        small = self._downscaled.get(key)
+        if small is None:
+            source = self.gray if gray else self.image
+            small = cv2.resize(source, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            with self._lock:
+                self._downscaled[key] = small
+        return small
+
+    def derived(self, key, compute):
+        """
+        Returns something other modules work out from the frame (e.g. its FFT), computed the first time it is asked
+        for and then kept with the frame like the views above.
+
+        Args:
+        key (str): Name of the derived view.
+        compute (callable): Works it out, called without arguments.
+
+        Returns:
+        object: What compute returned.
+        """
+        value = self._derived.get(key)
+        if value is None:
+            value = compute()
+            with self._lock:
+                value = self._derived.setdefault(key, value)
+        return value
+
+    def signature(self):
+        """
+        np.array: A tiny grayscale copy of the frame, one average per 16x16 block, used to tell if the screen changed.
+        """
+        return self.downscaled(SIGNATURE_SCALE)
+
+    def crop(self, sub_region):
+        """
+        Cuts a smaller region out of the frame without taking a new screenshot.
+
+        Args:
+        sub_region (dict): Region in screen coordinates, same format as the capture region.
+
+        Returns:
+        Frame: The cropped frame.
+        """
+        image = crop_region(self.image, self.region, sub_region)
+        return Frame(image, sub_region, self.timestamp, self.seq)
+
+    def covers(self, sub_region):
+        """
+        Checks whether a region in screen coordinates lies completely inside this frame.
+
+        Args:
+        sub_region (dict): Region in screen coordinates.
+
+        Returns:
+        bool: True if the region can be cropped out of this frame.
+        """
+        left = self.region['left'] if self.region else 0
+        top = self.region['top'] if self.region else 0
+        return (sub_region['left'] >= left and sub_region['top'] >= top
+                and sub_region['left'] + sub_region['width'] <= left + self.width
+                and sub_region['top'] + sub_region['height'] <= top + self.height)
+
+
+def signatures_differ(signature_a, signature_b, tolerance=6):
+    """
+    Checks whether two frame signatures are different enough to count as a changed screen.
+
+    Every block is compared on its own, so a small button appearing is noticed even though the rest of the
+    screen stayed the same.
+
+    Args:
+    signature_a (np.array): Signature from Frame.signature.
+    signature_b (np.array): Signature from Frame.signature.
+    tolerance (int): How far a block's average may move without counting as a change.
+
+    Returns:
+    bool: True if the screen changed.
+    """
+    if signature_a is None or signature_b is None or signature_a.shape != signature_b.shape:
+        return True
+    return int(cv2.absdiff(signature_a, signature_b).max()) > tolerance
+
+
+class ChangeDetector:
+    """
+    Remembers detector results together with the frame they were worked out on.
+
+    As long as the screen has not changed, the remembered result is returned instead of running the detector again.
+    """
+
+    def __init__(self, tolerance=6):
+        self.tolerance = tolerance
+        self._cache = {}  # key -> (signature, result)
+        self._lock = threading.Lock()
+
+    def changed(self, key, frame):
+        """
+        Checks whether the frame is different from the one the result for key was worked out on.
+        """
+        with self._lock:
+            entry = self._cache.get(key)
+        return entry is None or signatures_differ(entry[0], frame.signature(), self.tolerance)
+
+    def cached(self, key, frame, detect):
+        """
+        Returns the remembered result for key if the screen has not changed, otherwise runs detect and remembers it.
+
+        Args:
+        key: Anything hashable that identifies the detector and its arguments.
+        frame (Frame): The current frame.
+        detect (callable): Works out the result, called without arguments.
+
+        Returns:
+        The result of detect, either remembered or new.
+        """
+        signature = frame.signature()
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None and not signatures_differ(entry[0], signature, self.tolerance):
+            return entry[1]
+        result = detect()
+        with self._lock:
+            self._cache[key] = (signature, result)
+        return result
+
+    def forget(self, key=None):
+        """
+        Drops the remembered result for key, or every result if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+
+def crop_region(image, image_region, sub_region):
+    """
+    Cuts a region in screen coordinates out of an image that was taken of image_region.
+
+    Args:
+    image (np.array): The full image.
+    image_region (dict): The region the image shows, None if it starts at (0, 0).
+    sub_region (dict): The region to cut out, None for the whole image.
+
+    Returns:
+    np.array: The cropped image (a view, not a copy).
+    """
+    if sub_region is None or sub_region == image_region:
+        return image
+    left = sub_region['left'] - (image_region['left'] if image_region else 0)
+    top = sub_region['top'] - (image_region['top'] if image_region else 0)
+    left, top = max(left, 0), max(top, 0)
+    return image[top:top + sub_region['height'], left:left + sub_region['width']]
+
+
+def union_region(regions):
+    """
+    Returns the smallest region that contains every given region, so one grab can serve all of them.
+    """
+    left = min(r['left'] for r in regions)
+    top = min(r['top'] for r in regions)
+    right = max(r['left'] + r['width'] for r in regions)
+    bottom = max(r['top'] + r['height'] for r in regions)
+    return {'left': left, 'top': top, 'width': right - left, 'height': bottom - top}
+
+
+class CaptureBackend:
+    """
+    Where screenshots come from. ImageFinder.capture_screen and CaptureService only talk to this interface.
+
+    Subclasses implement grab, and open/close if they hold something open between screenshots.
+    """
+    region = None  # The full region this backend can capture
+
+    def open(self):
+        pass
+
+    def grab(self, region=None):
+        """
+        Takes a screenshot.
+
+        Args:
+        region (dict): The region to capture, defaults to the backend's whole region.
+
+        Returns:
+        np.array: BGRA (or BGR) screenshot.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MssBackend(CaptureBackend):
+    """
+    Grabs a desktop region with mss, keeping one mss instance open per thread instead of one per screenshot.
+    """
+
+    def __init__(self, region):
+        self.region = region
+        self._local = threading.local()
+        self._handles = []
+
+    def _sct(self):
+        sct = getattr(self._local, 'sct', None)
+        if sct is None:
+            # mss handles can not be shared between threads, so every thread gets its own
+            import mss
+            sct = mss.mss()
+            self._local.sct = sct
+            self._handles.append(sct)
+        return sct
+
+    def open(self):
+        self._sct()
+
+    def grab(self, region=None):
+        # noinspection PyTypeChecker
+        return np.array(self._sct().grab(region or self.region))
+
+    def close(self):
+        for sct in self._handles:
+            sct.close()
+        self._handles = []
+        self._local = threading.local()
+
+
+class AdbBackend(CaptureBackend):
+    """
+    Pulls raw frames straight from an Android device or emulator with adb screencap.
+
+    The raw RGBA output is used instead of PNG, so nothing is encoded or decoded, and the emulator window can be
+    covered or moved without breaking capture. With persistent=True one adb shell stays open and every grab only
+    sends it a screencap command, instead of starting a new adb process per frame. That shell is started with
+    "adb shell -T": exec-out does not pass stdin on, and a terminal would mangle the binary output.
+    """
+
+    def __init__(self, serial=None, adb='adb', persistent=True, size=None, region=None):
+        """
+        Args:
+        serial (str): Device serial (e.g. "127.0.0.1:5555" for BlueStacks), None if only one device is connected.
+        adb (str or list): Path to the adb executable, or a command that runs one.
+        persistent (bool): Keep one adb shell open for all grabs.
+        size (tuple): (width, height) to resize device frames to, so they match the snip_images scale.
+        region (dict): Screen coordinates the device frame is placed at, defaults to (0, 0).
+        """
+        self.serial = serial
+        self.adb = adb
+        self.persistent = persistent
+        self.size = size
+        self.region = region
+        self._process = None
+        self._header_size = None
+        self._lock = threading.Lock()
+
+    def _command(self, *args):
+        command = [self.adb] if isinstance(self.adb, str) else list(self.adb)
+        if self.serial:
+            command += ['-s', self.serial]
+        return command + list(args)
+
+    def open(self):
+        # A one off screencap tells us the frame size and which header format the device uses
+        data = subprocess.run(self._command('exec-out', 'screencap'), capture_output=True, check=True).stdout
+        image, self._header_size = AdbBackend.decode(data)
+        if self.region is None:
+            height, width = image.shape[:2] if self.size is None else self.size[::-1]
+            self.region = {'left': 0, 'top': 0, 'width': width, 'height': height}
+        if self.persistent and self._process is None:
+            self._process = subprocess.Popen(self._command('shell', '-T', 'sh'), stdin=subprocess.PIPE,
+                                             stdout=subprocess.PIPE)
+
+    def grab(self, region=None):
+        with self._lock:
+            if self._header_size is None:
+                self.open()
+            if self._process is not None:
+                self._process.stdin.write(b"screencap\n")
+                self._process.stdin.flush()
+                header = AdbBackend._read_exactly(self._process.stdout, self._header_size)
+                width, height = struct.unpack_from('<II', header)
+                data = header + AdbBackend._read_exactly(self._process.stdout, width * height * 4)
+            else:
+                data = subprocess.run(self._command('exec-out', 'screencap'), capture_output=True,
+                                      check=True).stdout
+        image, _ = AdbBackend.decode(data)
+        if self.size is not None and (image.shape[1], image.shape[0]) != tuple(self.size):
+            image = cv2.resize(image, tuple(self.size), interpolation=cv2.INTER_AREA)
+        return crop_region(image, self.region, region)
+
+    def close(self):
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+
+    @staticmethod
+    def decode(data):
+        """
+        Turns raw screencap output into a BGRA image.
+
+        The header is width, height and pixel format as 32 bit little endian ints, followed by a colour space
+        on Android 9 and newer.
+
+        Args:
+        data (bytes): Output of screencap without -p.
+
+        Returns:
+        tuple: (image, header_size)
+        """
+        width, height = struct.unpack_from('<II', data)
+        header_size = len(data) - width * height * 4
+        if header_size not in (12, 16):
+            raise ValueError(f"Unexpected screencap output: {len(data)} bytes for {width}x{height}")
+        rgba = np.frombuffer(data, np.uint8, width * height * 4, header_size).reshape(height, width, 4)
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA), header_size
+
+    @staticmethod
+    def _read_exactly(stream, size):
+        chunks = []
+        while size > 0:
+            chunk = stream.read(size)
+            if not chunk:
+                raise EOFError("adb closed the screencap stream")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+
+class ArrayBackend(CaptureBackend):
+    """
+    Hands out screenshots that are already in memory, so capture works on a machine without a display.
+
+    Once every image has been handed out it starts again from the first one, or keeps returning the last one
+    if loop is False.
+    """
+
+    def __init__(self, images, region=None, loop=True):
+        self.images = list(images)
+        self.region = region
+        self.loop = loop
+        self._index = 0
+        if self.region is None and self.images:
+            self.region = {'left': 0, 'top': 0, 'width': self.images[0].shape[1], 'height': self.images[0].shape[0]}
+
+    def open(self):
+        self._index = 0
+
+    def grab(self, region=None):
+        image = self.images[self._index]
+        if self._index + 1 < len(self.images):
+            self._index += 1
+        elif self.loop:
+            self._index = 0
+        return crop_region(image, self.region, region)
+
+
+class ReplayBackend(ArrayBackend):
+    """
+    Replays screenshots from disk, either a list of image paths or every PNG in a folder in name order.
+    """
+
+    def __init__(self, paths, region=None, loop=True):
+        if isinstance(paths, str):
+            paths = [os.path.join(paths, filename) for filename in sorted(os.listdir(paths))
+                     if filename.endswith(".png")]
+        images = []
+        for path in paths:
+            image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if image is None:
+                raise ValueError(f"Could not read frame image {path}")
+            images.append(image)
+        super().__init__(images, region, loop)
+
+
+class CaptureService:
+    """
+    Keeps one grabber open and captures frames on a background thread at a fixed rate.
+
+    The newest frames are kept in a small ring buffer. Detectors read the latest frame, or wait for one newer
+    than the frame they already looked at, without ever waiting for a grab themselves.
+
+    When grabbing fails (e.g. the window was closed or minimised) the last good frame is only served for
+    stale_after more intervals. After that reading a frame raises TimeoutError, like any other wait that gave up,
+    instead of every detector acting on an old screenshot. After max_failures failed grabs in a row capturing stops.
+    """
+
+    def __init__(self, backend, fps=10, buffer_size=4, stale_after=10, max_failures=50):
+        """
+        Args:
+        backend (CaptureBackend): Where frames come from, e.g. MssBackend, AdbBackend or ReplayBackend.
+        fps (float): How many frames to capture per second.
+        buffer_size (int): How many of the newest frames to keep.
+        stale_after (int): For how many intervals of failed grabs the last good frame is still served.
+        max_failures (int): How many failed grabs in a row stop the capture.
+        """
+        self.backend = backend
+        self.fps = fps
+        self.stale_after = stale_after
+        self.max_failures = max_failures
+        self.frames = collections.deque(maxlen=buffer_size)
+        self._seq = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._opened = threading.Event()
+        self._listeners = []  # Called with every new frame, e.g. to wake up coroutines
+        self.error = None  # The last grab error, None once a grab works again
+        self.failures = 0  # Failed grabs in a row
+        self._failing_since = None
+
+    @property
+    def region(self):
+        return self.backend.region
+
+    def start(self):
+        """
+        Starts the capture thread, waiting until the grabber is open.
+        """
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._opened.clear()
+        self._thread = threading.Thread(target=self._run, name="CaptureService", daemon=True)
+        self._thread.start()
+        self._opened.wait()
+        if self.error:
+            raise self.error
+        return self
+
+    def stop(self):
+        """
+        Stops the capture thread and closes the grabber.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _run(self):
+        # The grabber is opened on the capture thread, mss handles can not be shared between threads
+        try:
+            self.backend.open()
+        except Exception as e:
+            self.error = e
+            self._opened.set()
+            return
+        self._opened.set()
+        interval = 1.0 / self.fps
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                try:
+                    image = self.backend.grab()
+                except Exception as e:
+                    print(f"An error occurred during capture: {e}")
+                    with self._condition:
+                        self.error = e
+                        self.failures += 1
+                        if self._failing_since is None:
+                            self._failing_since = started
+                        self._condition.notify_all()  # Waiters find out the frames went stale
+                    if self.failures >= self.max_failures:
+                        print(f"Capture stopped after {self.failures} failed grabs in a row")
+                        break
+                else:
+                    self.publish(image)
+                self._stop.wait(max(0.0, interval - (time.monotonic() - started)))
+        finally:
+            self.backend.close()
+
+    def publish(self, image, timestamp=None):
+        """
+        Adds a screenshot to the ring buffer and wakes everyone waiting for a new frame.
+
+        Args:
+        image (np.array): The screenshot.
+        timestamp (float): When it was taken, defaults to now.
+
+        Returns:
+        Frame: The published frame.
+        """
+        with self._condition:
+            self.error, self.failures, self._failing_since = None, 0, None
+            self._seq += 1
+            frame = Frame(image, self.region, timestamp, self._seq)
+            self.frames.append(frame)
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(frame)
+            except Exception as e:
+                # A broken listener must not stop the capture thread
+                print(f"A capture listener failed: {e!r}")
+        return frame
+
+    def add_listener(self, listener):
+        """
+        Calls listener with every frame published from now on, on the capture thread. It has to return quickly.
+        """
+        with self._condition:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._condition:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _stale(self):
+        # Called with the condition held
+        if self.error is None:
+            return False
+        return (self.failures >= self.max_failures
+                or time.monotonic() - self._failing_since >= self.stale_after / self.fps)
+
+    def latest(self, timeout=None):
+        """
+        Returns the newest frame, only waiting if nothing has been captured yet.
+
+        Args:
+        timeout (float): How long to wait for the first frame, forever if None.
+
+        Returns:
+        Frame: The newest frame, or None if the timeout ran out.
+        """
+        return self.wait_for_frame(after=0, timeout=timeout)
+
+    def wait_for_frame(self, after=None, timeout=None):
+        """
+        Waits for a frame newer than the one with sequence number after.
+
+        Args:
+        after (int): Sequence number of the last frame seen, defaults to the newest frame right now.
+        timeout (float): How long to wait, forever if None.
+
+        Returns:
+        Frame: The newest frame, or None if the timeout ran out.
+
+        Raises:
+        TimeoutError: Grabbing has been failing for longer than stale_after intervals.
+        """
+        with self._condition:
+            if after is None:
+                after = self._seq
+            if not self._condition.wait_for(lambda: self._seq > after or self._stale(), timeout):
+                return None
+            if self._stale():
+                raise TimeoutError(f"No new frame for {self.failures} grabs, capture is failing: {self.error!r}")
+            return self.frames[-1]
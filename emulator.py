@@ -0,0 +1,232 @@
+import ctypes
+import os
+import signal
+import subprocess
+
+import ad_skip_test as askip
+
+# Boots take minutes, not milliseconds
+BOOT_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+# Keep the emulator running if the next reward is ready within this many seconds
+WARM_WINDOW = 10 * 60
+# Suspend it instead of closing it if the next reward is ready within this many seconds
+SUSPEND_WINDOW = 60 * 60
+# How long a warm or suspended emulator gets to show it is still ready before it is booted again
+RESUME_TIMEOUT = 20
+# How many failed probes in a row before a stage's nudge (e.g. closing a popup) is tried
+NUDGE_AFTER = 5
+
+
+class StateProbe:
+    """
+    A cheap readiness probe: does the screen show one particular state?
+
+    find_state classifies the frame against every state template, a probe only needs a yes or no for one state. It
+    asks the state signatures first, which costs microseconds, and only if they are not sure matches that one
+    state's template. The answer is cached until the screen changes.
+    """
+
+    def __init__(self, state, folder=None):
+        """
+        Args:
+        state (str): Name of the state template, e.g. "Android_Home".
+        folder (str): The folder containing the state templates.
+        """
+        self.state = state
+        self.folder = folder or os.path.join(askip.script_directory, 'snip_images', 'states')
+        self.path = os.path.join(self.folder, state + ".png")
+
+    def __call__(self, frame):
+        """
+        Args:
+        frame (Frame): The frame to look at.
+
+        Returns:
+        bool: True if the frame shows the state.
+        """
+        return askip.change_detector.cached(('probe', self.path, askip.region_key(frame.region)), frame,
+                                            lambda: self._probe(frame))
+
+    def _probe(self, frame):
+        signatures = askip.state_signatures
+        if signatures is not None and len(signatures):
+            states, sure = signatures.candidates(frame)
+            if sure:
+                askip.metrics.increment('probe_total', state=self.state, result='signature')
+                return states[0] == self.state.lower()
+        askip.metrics.increment('probe_total', state=self.state, result='template')
+        return bool(askip.ImageFinder.template_matching(frame, self.path, pyramid=True))
+
+
+class LocalProcess:
+    """
+    Starts, stops, suspends and resumes an emulator that runs as a local process.
+
+    This is the pluggable part of EmulatorLifecycle. Anything with the same methods works, e.g. a fake that only
+    records what it was asked to do.
+    """
+
+    def __init__(self, command, image_name=None):
+        """
+        Args:
+        command (str or list): The command that starts the emulator.
+        image_name (str): On Windows, the executable name to taskkill, so an emulator this script did not start
+            is closed too. None to only stop the process started here.
+        """
+        self.command = command
+        self.image_name = image_name
+        self._process = None
+
+    def launch(self):
+        self._process = subprocess.Popen(self.command)
+
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def stop(self):
+        if os.name == 'nt' and self.image_name:
+            # taskkill only returns once the emulator is gone
+            subprocess.run(f"taskkill /f /im {self.image_name}")
+        elif self.running():
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+    def can_suspend(self):
+        # Only a process started here can be suspended, its id is not known otherwise
+        return self.running()
+
+    def suspend(self):
+        self._signal(True)
+
+    def resume(self):
+        self._signal(False)
+
+    def _signal(self, suspend):
+        if os.name != 'nt':
+            os.kill(self._process.pid, signal.SIGSTOP if suspend else signal.SIGCONT)
+            return
+        handle = ctypes.windll.kernel32.OpenProcess(0x0800, False, self._process.pid)  # PROCESS_SUSPEND_RESUME
+        try:
+            if suspend:
+                ctypes.windll.ntdll.NtSuspendProcess(handle)
+            else:
+                ctypes.windll.ntdll.NtResumeProcess(handle)
+        finally:
+            ctypes.windll.kernel32.CloseHandle(handle)
+
+
+class EmulatorLifecycle:
+    """
+    Boots the emulator, and between reward cycles keeps it running, suspends it or closes it.
+
+    A cold boot waits for the readiness probes one after the other (e.g. the loading screen, then the Android home
+    screen). How long each stage and the whole boot took is recorded in the metrics, the boot as
+    emulator_ready_seconds. When the next reward is ready soon, park keeps the emulator running or suspends it, and
+    the next start only checks that it is still ready instead of booting it again.
+    """
+
+    def __init__(self, process, probes, resume_probe=None, warm_window=WARM_WINDOW, suspend_window=SUSPEND_WINDOW,
+                 resume_timeout=RESUME_TIMEOUT):
+        """
+        Args:
+        process (LocalProcess): Launches, stops, suspends and resumes the emulator.
+        probes (list): (description, blocking function that returns True once ready, timeout) for every stage of a
+            boot, in order, optionally with a fourth item: a blocking function that helps the stage along (e.g.
+            closes a popup), run once every NUDGE_AFTER failed probes.
+        resume_probe (callable): Blocking function that says whether a kept or resumed emulator is ready, None to
+            always boot cold.
+        warm_window (float): Keep the emulator running if it is needed again within this many seconds.
+        suspend_window (float): Suspend it if it is needed again within this many seconds.
+        resume_timeout (float): How long resume_probe gets before the emulator is booted again.
+        """
+        self.process = process
+        self.probes = list(probes)
+        self.resume_probe = resume_probe
+        self.warm_window = warm_window
+        self.suspend_window = suspend_window
+        self.resume_timeout = resume_timeout
+        self.parked = None  # None, "warm" or "suspended"
+        self.last_boot = None  # Seconds the last cold boot took
+
+    async def start(self, runtime):
+        """
+        Makes the emulator ready, resuming it if it was parked.
+
+        Args:
+        runtime (AsyncRuntime): Runs the probes and the waits.
+
+        Returns:
+        str: "cold" if it was booted, "warm" or "suspended" if a parked emulator was still ready.
+        """
+        parked, self.parked = self.parked, None
+        if parked is not None:
+            started = runtime.monotonic()
+            if parked == "suspended":
+                await runtime.run(self.process.resume)
+            ready = await runtime.wait_for(self.resume_probe, timeout=self.resume_timeout, min_interval=0.2,
+                                           max_interval=2, description="the emulator to resume",
+                                           raise_on_timeout=False)
+            if ready:
+                askip.metrics.observe('emulator_ready_seconds', runtime.monotonic() - started, buckets=BOOT_BUCKETS,
+                                      start=parked)
+                askip.metrics.increment('emulator_starts_total', start=parked)
+                print(f"Emulator {parked}, ready in {runtime.monotonic() - started:.1f}s")
+                return parked
+            print(f"The {parked} emulator is not ready, booting it again")
+            await runtime.run(self.process.stop)
+
+        started = runtime.monotonic()
+        await runtime.run(self.process.launch)
+        for description, probe, timeout, *nudge in self.probes:
+            stage_started = runtime.monotonic()
+            action = EmulatorLifecycle._every(nudge[0], NUDGE_AFTER) if nudge else None
+            await runtime.wait_for(probe, timeout=timeout, min_interval=0.5, max_interval=2, action=action,
+                                   description=description)
+            askip.metrics.observe('emulator_stage_seconds', runtime.monotonic() - stage_started,
+                                  buckets=BOOT_BUCKETS, stage=description)
+        self.last_boot = runtime.monotonic() - started
+        askip.metrics.observe('emulator_ready_seconds', self.last_boot, buckets=BOOT_BUCKETS, start="cold")
+        askip.metrics.increment('emulator_starts_total', start="cold")
+        print(f"Emulator booted in {self.last_boot:.1f}s")
+        return "cold"
+
+    @staticmethod
+    def _every(action, failures):
+        # Probes stay cheap and free of side effects, the action only runs once they failed a few times in a row
+        failed = [0]
+
+        def maybe_act():
+            failed[0] += 1
+            if failed[0] % failures:
+                return False
+            return action()
+
+        return maybe_act
+
+    async def park(self, runtime, needed_in):
+        """
+        Puts the emulator away until it is needed again.
+
+        Args:
+        runtime (AsyncRuntime): Runs the blocking calls.
+        needed_in (float): Seconds until the emulator is needed again, None if not known.
+
+        Returns:
+        str: "warm", "suspended" or "stopped".
+        """
+        if self.resume_probe is not None and needed_in is not None:
+            if needed_in <= self.warm_window:
+                self.parked = "warm"
+            elif needed_in <= self.suspend_window and self.process.can_suspend():
+                await runtime.run(self.process.suspend)
+                self.parked = "suspended"
+        if self.parked is None:
+            await self.stop(runtime)
+        askip.metrics.increment('emulator_parks_total', parked=self.parked or "stopped")
+        return self.parked or "stopped"
+
+    async def stop(self, runtime):
+        self.parked = None
+        await runtime.run(self.process.stop)
+        print("Emulator closed.")
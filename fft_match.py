@@ -0,0 +1,137 @@
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# How many padded sizes to keep template spectra for, one per capture region size in practice
+SPECTRA_CACHE_SIZE = 4
+# Windows whose pixels deviate less than this (in gray levels) from their mean count as flat
+FLAT_DEVIATION = 0.1
+
+
+class FftMatcher:
+    """
+    Matches every template of a folder against one frame, sharing the work that only depends on the frame.
+
+    cv2.matchTemplate sets up the correlation against the haystack again for every template. Here the haystack is
+    transformed once per frame, and its window sums and sums of squares come from one pair of integral images. The
+    spectrum of every template is worked out once and kept, so a template only costs a spectrum multiplication, an
+    inverse transform and the normalisation. The scores are the same as TM_CCOEFF_NORMED (within about 1e-4), so the
+    usual thresholds keep working.
+    """
+
+    def __init__(self):
+        self._spectra = collections.OrderedDict()  # (path, mtime, padded shape) -> (spectrum, norm)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _haystack_transform(frame):
+        """
+        Returns:
+        tuple: (spectrum, sums, squares, padded shape) of the frame, worked out once per frame and kept with it, so
+            sessions that take turns matching their own frames do not transform them again.
+        """
+        return frame.derived('fft_haystack', lambda: FftMatcher._transform(frame))
+
+    @staticmethod
+    def _transform(frame):
+        gray = frame.gray
+        padded = (cv2.getOptimalDFTSize(gray.shape[0]), cv2.getOptimalDFTSize(gray.shape[1]))
+        image = np.zeros(padded, np.float32)
+        image[:gray.shape[0], :gray.shape[1]] = gray
+        # Without the mean the sums stay small, which keeps float32 precise enough
+        image[:gray.shape[0], :gray.shape[1]] -= gray.mean()
+        spectrum = cv2.dft(image)
+        sums, squares = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        return spectrum, sums, squares, padded
+
+    def _template_spectrum(self, template, padded):
+        key = (template.path, template.mtime, padded)
+        with self._lock:
+            entry = self._spectra.get(key)
+            if entry is not None:
+                self._spectra.move_to_end(key)
+                return entry
+        zero_mean = template.gray.astype(np.float32) - template.gray.mean()
+        image = np.zeros(padded, np.float32)
+        image[:template.height, :template.width] = zero_mean
+        entry = (cv2.dft(image), float(np.sqrt((zero_mean * zero_mean).sum())))
+        with self._lock:
+            self._spectra[key] = entry
+            # Drop the spectra of region sizes that are not used any more
+            sizes = {k[2] for k in self._spectra}
+            while len(sizes) > SPECTRA_CACHE_SIZE:
+                oldest = next(iter(self._spectra))[2]
+                for k in [k for k in self._spectra if k[2] == oldest]:
+                    del self._spectra[k]
+                sizes.discard(oldest)
+        return entry
+
+    def scores(self, frame, template):
+        """
+        Works out the TM_CCOEFF_NORMED scores of a template everywhere on the frame.
+
+        Args:
+        frame (Frame): The frame to search.
+        template (Template): The template to look for.
+
+        Returns:
+        np.array: The same float32 result as cv2.matchTemplate, or None if the template is larger than the frame.
+        """
+        spectrum, sums, squares, padded = self._haystack_transform(frame)
+        height, width = frame.gray.shape
+        if template.height > height or template.width > width:
+            return None
+        template_spectrum, norm = self._template_spectrum(template, padded)
+
+        # Correlation of the frame with the zero mean template, for every position at once
+        product = cv2.mulSpectrums(spectrum, template_spectrum, 0, conjB=True)
+        correlation = cv2.dft(product, flags=cv2.DFT_INVERSE | cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)
+        rows, cols = height - template.height + 1, width - template.width + 1
+        numerator = correlation[:rows, :cols]
+
+        # Sum and sum of squares of the frame under the template at every position, from the integral images
+        h, w, count = template.height, template.width, template.height * template.width
+        window_sums = cv2.add(cv2.subtract(sums[h:, w:], sums[:-h, w:]), cv2.subtract(sums[:-h, :-w], sums[h:, :-w]))
+        window_squares = cv2.add(cv2.subtract(squares[h:, w:], squares[:-h, w:]),
+                                 cv2.subtract(squares[:-h, :-w], squares[h:, :-w]))
+        # The difference needs float64, the rest is fine in float32
+        variance = cv2.subtract(window_squares, cv2.multiply(window_sums, window_sums, scale=1 / count))
+        deviation = cv2.sqrt(np.maximum(variance.astype(np.float32), 0))
+
+        result = cv2.divide(numerator, deviation, scale=1 / norm)
+        # Flat windows score 0, like matchTemplate, instead of whatever rounding left over divided by almost nothing
+        result[deviation < FLAT_DEVIATION * np.sqrt(count)] = 0
+        return np.clip(result, -1, 1, out=result)
+
+    def prepare(self, frame):
+        """
+        Transforms the frame, so the templates matched against it on other threads can share the transform.
+        """
+        self._haystack_transform(frame)
+
+    def template_matching(self, frame, template, threshold=0.93, max_matches=10, use_hotspots=True):
+        """
+        ImageFinder.template_matching for a Frame and a Template, with the full frame search done here.
+
+        Returns:
+        list: Matches sorted by x then y, see ImageFinder.template_matching.
+        """
+        import ad_skip_test as askip
+
+        started = time.perf_counter()
+        gray = frame.gray
+        hotspot_key = askip.HotspotIndex.key(template, gray.shape)
+        if use_hotspots:
+            boxes = askip.hotspots.regions(hotspot_key, template.width, template.height, gray.shape)
+            peaks = askip.ImageFinder._match_in_boxes(gray, template, boxes, threshold, max_matches)
+            if peaks:
+                return askip.ImageFinder._peaks_to_matches(template, peaks, hotspot_key, 'hotspot', started)
+
+        result = self.scores(frame, template)
+        peaks = []
+        if result is not None:
+            peaks = askip.ImageFinder.find_peaks(result, threshold, template.width, template.height, max_matches)
+        return askip.ImageFinder._peaks_to_matches(template, peaks, hotspot_key, 'fft', started)
@@ -0,0 +1,355 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from capture import Frame
+
+# One Bluestacks window as mss grabs it, (height, width, BGRA)
+FRAME_SHAPE = (915, 500, 4)
+
+_HEADER = np.dtype([('latest', '<i8'), ('slots', '<i4'), ('readers', '<i4'), ('height', '<i4'), ('width', '<i4'),
+                    ('channels', '<i4'), ('pad', '<i4')])
+_SLOT = np.dtype([('seq', '<i8'), ('timestamp', '<f8'), ('region', '<i4', 4), ('shape', '<i4', 3), ('pad', '<i4')])
+
+# Sequence number of a slot while the writer fills it. Published frames are numbered from 1
+WRITING = -1
+# Pin of a reader that holds no frame
+FREE = 0
+
+
+def _align(size, alignment=64):
+    return -(-size // alignment) * alignment
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    block = shared_memory.SharedMemory(name=name)
+    if os.name != 'nt' and multiprocessing.parent_process() is None:
+        # A process that was not started by multiprocessing has a resource tracker of its own, which would remove the
+        # bus when this process exits. The process that created the bus removes it
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+class FrameBus:
+    """
+    A ring of frame slots in shared memory, written by one capture process and read by any number of detector
+    processes.
+
+    Sending screenshots through queues pickles and copies 1.8 MB per frame per process, more than matching it costs.
+    Here the capture process copies every frame once into the next free slot, and readers get it as a read only
+    numpy view of the shared memory, without any copy.
+
+    Every slot carries the sequence number of the frame in it. Every reader has a pin, the sequence number of the
+    frame it is using, and the writer never reuses a slot that is pinned: it marks the slot as being written, then
+    checks the pins, and backs off to the next oldest slot if a reader got there first. A reader pins a frame, then
+    checks the slot still holds it. So a reader's frame is never overwritten under it. There are more slots than
+    readers, so at any moment some slot is free, but readers move their pins while the writer looks, so a single
+    pass can find every slot pinned. The writer then looks again.
+    """
+
+    def __init__(self, name=None, create=False, slots=8, readers=7, shape=FRAME_SHAPE):
+        """
+        Args:
+        name (str): Name of the shared memory block, generated when creating if None.
+        create (bool): Create the bus (the capture process) instead of attaching to an existing one.
+        slots (int): How many frames the ring holds, when creating.
+        readers (int): How many readers can be attached, when creating. Has to be less than slots.
+        shape (tuple): The largest frame (height, width, channels), when creating.
+        """
+        if create:
+            if readers >= slots:
+                raise ValueError(f"A frame bus needs more slots than readers, got {slots} slots for {readers} readers")
+            height, width, channels = shape
+            size = self._layout(slots, readers, shape)[-1]
+            self._block = shared_memory.SharedMemory(name=name, create=True, size=size)
+            header = np.ndarray((), _HEADER, buffer=self._block.buf)
+            header['slots'], header['readers'] = slots, readers
+            header['height'], header['width'], header['channels'] = height, width, channels
+            del header
+        else:
+            self._block = _attach(name)
+        self.created = create
+        self.name = self._block.name
+
+        buf = self._block.buf
+        self.header = np.ndarray((), _HEADER, buffer=buf)
+        self.slots, self.readers = int(self.header['slots']), int(self.header['readers'])
+        self.shape = (int(self.header['height']), int(self.header['width']), int(self.header['channels']))
+        pins, table, data, self._slot_bytes, _ = self._layout(self.slots, self.readers, self.shape)
+        self.pins = np.ndarray((self.readers,), '<i8', buffer=buf, offset=pins)
+        self.table = np.ndarray((self.slots,), _SLOT, buffer=buf, offset=table)
+        self._data = data
+        self._lock = threading.Lock()  # One writer, even if publish is called from several threads
+
+    @staticmethod
+    def _layout(slots, readers, shape):
+        """
+        Returns:
+        tuple: Offsets of the pins, the slot table and the pixels, the size of one slot's pixels and the total size.
+        """
+        pins = _HEADER.itemsize
+        table = pins + 8 * readers
+        data = _align(table + _SLOT.itemsize * slots)
+        slot_bytes = _align(int(np.prod(shape)))
+        return pins, table, data, slot_bytes, data + slot_bytes * slots
+
+    @property
+    def latest(self):
+        # Sequence number of the newest frame, 0 before the first one
+        return int(self.header['latest'])
+
+    def pixels(self, slot, shape):
+        """
+        Returns:
+        np.array: A view of the first pixels of a slot with the given shape.
+        """
+        return np.ndarray(shape, np.uint8, buffer=self._block.buf, offset=self._data + slot * self._slot_bytes)
+
+    def _claim_slot(self):
+        seqs = self.table['seq']
+        while True:
+            # Oldest frame first, so every frame stays readable for as long as possible
+            for slot in np.argsort(seqs, kind='stable'):
+                old = int(seqs[slot])
+                seqs[slot] = WRITING
+                if old <= 0 or old not in self.pins:
+                    return int(slot)
+                seqs[slot] = old  # A reader is using it
+            # Readers moved their pins onto the slots already checked, they only hold one each so look again
+            time.sleep(0)
+
+    def publish(self, image, region=None, timestamp=None):
+        """
+        Copies a screenshot into the ring. Only the process that created the bus may publish.
+
+        Args:
+        image (np.array): The screenshot, BGRA, BGR or grayscale, at most the bus' shape.
+        region (dict): The screen region it was taken from.
+        timestamp (float): When it was taken, defaults to now.
+
+        Returns:
+        int: The frame's sequence number.
+        """
+        shape = image.shape if image.ndim == 3 else image.shape + (1,)
+        if any(size > limit for size, limit in zip(shape, self.shape)):
+            raise ValueError(f"A {shape} frame does not fit the frame bus' {self.shape} slots")
+        region = region or {'left': 0, 'top': 0, 'width': shape[1], 'height': shape[0]}
+        with self._lock:
+            seq = self.latest + 1
+            slot = self._claim_slot()
+            self.pixels(slot, image.shape)[:] = image
+            entry = self.table[slot:slot + 1]
+            entry['timestamp'] = time.time() if timestamp is None else timestamp
+            entry['region'] = (region['left'], region['top'], region['width'], region['height'])
+            entry['shape'] = shape
+            # Set last, readers only take a slot once it has its sequence number
+            entry['seq'] = seq
+            self.header['latest'] = seq
+        return seq
+
+    def publish_frame(self, frame):
+        """
+        Publishes a Frame, e.g. as a CaptureService listener: service.add_listener(bus.publish_frame)
+        """
+        return self.publish(frame.image, frame.region, frame.timestamp)
+
+    def reader(self, index, copy=False):
+        """
+        Args:
+        index (int): Which pin to use, 0 to readers - 1. Every reading process needs its own.
+        copy (bool): Hand out copies of the frames instead of views of the slots, see BusReader.
+
+        Returns:
+        BusReader: A reader of this bus.
+        """
+        return BusReader(self, index, copy)
+
+    def close(self):
+        """
+        Detaches from the bus, and removes it if this process created it.
+        """
+        self.header = self.pins = self.table = None
+        try:
+            self._block.close()
+        except BufferError:
+            pass  # Frames that were handed out keep the memory mapped until they are gone
+        if self.created:
+            self._block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BusReader:
+    """
+    Reads frames from a FrameBus without copying them.
+
+    A reader has a single pin, so a frame stays valid only until the reader reads the next one (or releases it),
+    copy the image to keep it longer. Such a reader is for one thread only: a second thread reading would move the
+    pin off a frame the first one is still using. A reader that falls behind the writer skips to the newest frame, or
+    with in_order to the oldest frame still in the ring, and counts the frames it missed in dropped.
+
+    With copy, every frame is copied out of its slot under a lock and the pin is released straight away, so frames
+    stay valid for as long as they are kept and the reader can be shared by threads. This costs one copy per read.
+
+    Has latest and wait_for_frame like CaptureService, so in a detector process it can stand in for the capture
+    service. It has no listeners, AsyncRuntime.next_frame waits for frames with wait_for_frame instead. Detectors keep frames across reads and run in AsyncRuntime's thread pool, so use a copying reader for
+    that: ad_skip_test.capture_service = bus.reader(index, copy=True).
+    """
+
+    def __init__(self, bus, index, copy=False):
+        """
+        Args:
+        bus (FrameBus): The bus to read.
+        index (int): Which pin to use, every reading process needs its own.
+        copy (bool): Hand out copies of the frames instead of views of the slots.
+        """
+        if not 0 <= index < bus.readers:
+            raise ValueError(f"Reader {index} does not exist, the frame bus has {bus.readers} readers")
+        self.bus = bus
+        self.index = index
+        self.seq = 0  # Sequence number of the last frame read
+        self.dropped = 0  # Frames published after the last one read, but skipped
+        self.frames_read = 0
+        self.copy = copy
+        self._lock = threading.Lock()  # Only taken by copying readers, one thread at a time uses the pin
+
+    @property
+    def lag(self):
+        # How many frames the writer is ahead of this reader
+        return self.bus.latest - self.seq
+
+    def _pin(self, seq):
+        """
+        Returns:
+        Frame: The frame with sequence number seq as a view of its slot, None if it is not in the ring any more.
+        """
+        bus = self.bus
+        bus.pins[self.index] = seq
+        slots = np.flatnonzero(bus.table['seq'] == seq)
+        if not len(slots):
+            bus.pins[self.index] = FREE
+            return None
+        entry = bus.table[int(slots[0])]
+        height, width, channels = (int(size) for size in entry['shape'])
+        image = bus.pixels(int(slots[0]), (height, width) if channels == 1 else (height, width, channels))
+        image.flags.writeable = False
+        left, top, region_width, region_height = (int(value) for value in entry['region'])
+        region = {'left': left, 'top': top, 'width': region_width, 'height': region_height}
+        return Frame(image, region, float(entry['timestamp']), seq)
+
+    def read(self, after=None, in_order=False):
+        """
+        Reads a frame newer than after without waiting.
+
+        Args:
+        after (int): Sequence number of the last frame seen, the last frame this reader read if None.
+        in_order (bool): Read the frame right after after (or the oldest one still in the ring) instead of the
+            newest.
+
+        Returns:
+        Frame: The frame, None if there is nothing newer yet.
+        """
+        if not self.copy:
+            return self._read(after, in_order)
+        with self._lock:
+            frame = self._read(after, in_order)
+            if frame is None:
+                return None
+            frame = Frame(frame.image.copy(), frame.region, frame.timestamp, frame.seq)
+            self.release()
+            return frame
+
+    def _read(self, after, in_order):
+        if after is None:
+            after = self.seq
+        while True:
+            latest = self.bus.latest
+            if latest <= after:
+                return None
+            target = latest
+            if in_order:
+                kept = [int(seq) for seq in self.bus.table['seq'] if seq > after]
+                target = min(kept) if kept else latest
+            frame = self._pin(target)
+            if frame is not None:
+                break
+            # The writer lapped the ring between looking and pinning, look again
+        if frame.seq > self.seq:
+            self.dropped += frame.seq - max(self.seq, after) - 1
+        self.seq = max(self.seq, frame.seq)
+        self.frames_read += 1
+        return frame
+
+    def wait_for_frame(self, after=None, timeout=None, poll=0.002):
+        """
+        Waits for a frame newer than the one with sequence number after.
+
+        The writer is another process, so this polls the newest sequence number, which only reads one integer.
+
+        Args:
+        after (int): Sequence number of the last frame seen, defaults to the newest frame right now.
+        timeout (float): How long to wait, forever if None.
+        poll (float): Seconds between looks.
+
+        Returns:
+        Frame: The newest frame, or None if the timeout ran out.
+        """
+        if after is None:
+            after = self.bus.latest
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frame = self.read(after)
+            if frame is not None:
+                return frame
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll)
+
+    def latest(self, timeout=None):
+        """
+        Returns the newest frame, only waiting if nothing has been published yet.
+        """
+        if self.bus.latest:
+            return self.read(after=self.bus.latest - 1)
+        return self.wait_for_frame(after=0, timeout=timeout)
+
+    def release(self):
+        """
+        Lets the writer reuse the slot of the last frame read.
+        """
+        self.bus.pins[self.index] = FREE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Capture the screen into a shared memory frame bus for detector "
+                                                 "processes")
+    parser.add_argument('--name', default="adskip_frames", help="name of the shared memory block")
+    parser.add_argument('--fps', type=float, default=10, help="how often to grab the screen")
+    parser.add_argument('--slots', type=int, default=8, help="how many frames the ring holds")
+    parser.add_argument('--readers', type=int, default=7, help="how many detector processes can read")
+    args = parser.parse_args()
+
+    from capture import CaptureService, MssBackend
+
+    capture_region = {'left': 0, 'top': 0, 'width': FRAME_SHAPE[1], 'height': FRAME_SHAPE[0]}
+    with FrameBus(args.name, create=True, slots=args.slots, readers=args.readers) as frame_bus, \
+            CaptureService(MssBackend(capture_region), fps=args.fps) as service:
+        service.add_listener(frame_bus.publish_frame)
+        print(f"Publishing frames to {frame_bus.name}, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
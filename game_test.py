@@ -1,20 +1,33 @@
 
 from datetime import timedelta
-from PIL import Image
 import ad_skip_test as askip
+from async_runtime import AD_TIMEOUT, STALL_TIMEOUT, AsyncRuntime
+from capture import CaptureService, MssBackend
+from emulator import EmulatorLifecycle, LocalProcess, StateProbe
+from reward_schedule import RewardSchedule
+from state_machine import State, StateMachine, Watchdog
+from timer_ocr import DigitRecognizer, TimerReader
+import asyncio
 import cv2
 import datetime
-import pyautogui
 import pytesseract
-import subprocess
-import time
 import os
 import ctypes
 script_directory = os.path.dirname(__file__)
-pyautogui.FAILSAFE = False
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 amt_ads_done = 0
 
+# How long to wait before looking again when none of the reward timers could be read
+TIMER_RETRY = timedelta(minutes=5)
+# The longest single sleep. Only there so the wall clock is looked at again if the computer was asleep meanwhile
+SLEEP_CHECK = timedelta(minutes=15)
+
+# When every reward is ready, kept on disk so a restart does not need Bluestacks to read the timers again
+schedule = RewardSchedule(os.path.join(script_directory, 'reward_schedule.json'))
+
+# Reads the timers in process, learning the timer font from what Tesseract reads
+digit_recognizer = DigitRecognizer(os.path.join(script_directory, 'snip_images', 'digits'))
+
 
 def resize_terminal(width, height):
     """Check terminal size and resize if necessary."""
@@ -32,23 +45,25 @@ def resize_terminal(width, height):
         print("Error:", e)
 
 
-def get_timer_text(screen_region):
-    screenshot = askip.ImageFinder.capture_screen(screen_region)
-    screenshot = process_image(screenshot)
-
-    text = pytesseract.image_to_string(Image.fromarray(screenshot), lang='eng',
-                                       config='--psm 10 --oem 3 -c tessedit_char_whitelist=0123456789:').strip()
-    if len(text) == 8:
-        return text
+def get_timer_text(screen_region, frame=None):
+    if frame is None:
+        screenshot = askip.ImageFinder.capture_screen(screen_region)
     else:
+        screenshot = frame.crop(screen_region).image
+
+    # The built in recognizer is tried first, Tesseract only if it is not sure
+    text = timer_reader.read_texts([screenshot])[0]
+    if text is None:
         print("time not correct (8 chars) returning None")
-        return None
+    return text
 
 
-def find_timer_regions():
+def find_timer_regions(frame=None):
     free_folder = os.path.join(script_directory, 'snip_images', 'collect_rewards')
-    images = askip.ImageFinder.find_1_of_folder(free_folder, region, multiple=True)
+    images = askip.ImageFinder.find_1_of_folder(free_folder, region, multiple=True, frame=frame, pyramid=True)
     regions = []
+    if images[0] is None:
+        return regions
     for im in images:
         region2 = {'left': im[1] - 60, 'top': im[2] + 88, 'width': 124, 'height': 35}  # Adjust as needed
         regions.append(region2)
@@ -72,152 +87,154 @@ def process_image(image):
     return thresh
 
 
-def parse_time(time_str):
-    try:
-        # Parse time string to extract hours, minutes, and seconds
-        hours, minutes, seconds = map(int, time_str.split(':'))
-        # Create a timedelta object representing the duration
-        return timedelta(hours=hours, minutes=minutes, seconds=seconds)
-    except ValueError:
-        # Handle parsing errors (e.g., if time_str does not match expected format)
-        print("Error parsing time string assuming update ready")
-        return timedelta(hours=99, minutes=99, seconds=99)
-
-
-def find_shortest_time(time_strs):
-    valid_times = []
-    for time_str, left_value in time_strs:  # Unpack both time_str and left value
-        time_obj = parse_time(time_str)
-        if time_obj:
-            valid_times.append((time_obj, left_value))  # Append tuple of time object and left value
-
-    if valid_times:
-        shortest_time, shortest_left = min(valid_times, key=lambda x: x[0])  # Find the tuple with the shortest time
-        return shortest_time, shortest_left  # Return shortest time and its corresponding left value
-
-    return None, None
-
-
-def get_sleep_time():
-    times = []
-    regis = find_timer_regions()
-    if regis and len(regis) == 3:
-        for reg in regis:
-            txt = get_timer_text(reg)
-            if txt:
-                times.append((txt, reg['left']))  # Append tuple of text and left value
-    shortest_time, shortest_left = find_shortest_time(times)
-    if shortest_time:
-        # Convert timedelta to seconds
-        end_time = datetime.datetime.now() + shortest_time
-        return end_time, shortest_left
-
-
-def iterate_sleep_function(iterations):
-    shortest_time = None
-    left_loc = None
-    for _ in range(iterations):
-        sleep_time, left_loc = get_sleep_time()
-        if shortest_time is None or sleep_time < shortest_time:
-            shortest_time = sleep_time
-    return shortest_time, left_loc
-
-
-def wait_until_time(target_time, left):
-    goal = get_goal(left)
-
-    while datetime.datetime.now() < target_time:
-        clear_console()
-        # Calculate the remaining time until the target time
-        remaining_time = target_time - datetime.datetime.now()
-        formatted_time = str(remaining_time).split(".")[0]
-        formatted_finish_time = target_time.strftime("%I:%M %p")
-
-        print("Goal:", goal)
-        print("Finish time:", formatted_finish_time)
-        print("Waiting for:", formatted_time)
-        print("Total Ads Done:", amt_ads_done)
-        time.sleep(0.99)  # Sleep for 1 second
-
-    print("Time reached:", target_time)
+def get_ready_times():
+    """
+    Works out when every reward is ready.
+
+    All timers are read twice, a couple of seconds apart, and a timer only counts if it counted down in between, so
+    a misread timer can not make the script sleep for the wrong time.
+
+    Returns:
+    dict: {reward: when it is ready} for every timer that could be read. If none could, only "Recheck" at
+    TIMER_RETRY from now.
+    """
+    frame = askip.ImageFinder.capture_frame(region)  # One screenshot for the regions and the first reading
+    regis = find_timer_regions(frame)
+    timers = timer_reader.read_consistent(lambda: askip.ImageFinder.capture_frame(region), regis, frame=frame)
+    now = datetime.datetime.now()
+    ready_times = {}
+    for timer, reg in zip(timers, regis):
+        if timer is not None:
+            ready_times[get_goal(reg['left']) or f"Reward at {reg['left']}"] = now + timer
+    if not ready_times:
+        print(f"No reward timer could be read, looking again in {TIMER_RETRY}")
+        return {"Recheck": now + TIMER_RETRY}
+    return ready_times
+
+
+def show_schedule(now):
+    # Redrawn in place, only when the script wakes up, so there is nothing to do while it sleeps
+    clear_console()
+    entries = schedule.entries()
+    if entries:
+        print("Goal:", entries[0][1])
+    for ready, reward in entries:
+        remaining = str(max(ready - now, timedelta(0))).split(".")[0]
+        print(f"{reward:<13} {ready.strftime('%I:%M %p')}  in {remaining}")
+    print("Total Ads Done:", amt_ads_done, flush=True)
+
+
+async def wait_until_time(runtime):
+    """
+    Sleeps until the first reward in the schedule is ready.
+    """
+    while schedule.next() is not None:
+        target_time, _ = schedule.next()
+        now = datetime.datetime.now()
+        if now >= target_time:
+            print("Time reached:", target_time)
+            return
+        show_schedule(now)
+        # Other sessions keep running meanwhile
+        await runtime.sleep(min(target_time - now, SLEEP_CHECK).total_seconds())
 
 
 def get_goal(left):
     goal = None
     if left:
-        if left == 44:
+        # Slot centers come from find_peaks and can be a pixel or two off
+        if abs(left - 44) <= 5:
             goal = "Silver Chest"
-        elif left == 189:
+        elif abs(left - 189) <= 5:
             goal = "Gems"
-        elif left == 334:
+        elif abs(left - 334) <= 5:
             goal = "Gold Chest"
     return goal
 
 
-def clear_console():
-    # For Windows
+def enable_ansi():
+    # The Windows console only understands the escape codes clear_console uses once they are switched on
     if os.name == 'nt':
-        _ = os.system('cls')
-    # For Unix/Linux/MacOS
-    else:
-        _ = os.system('clear')
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.GetStdHandle(-11)  # Standard output
+        mode = ctypes.c_uint32()
+        if kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            kernel32.SetConsoleMode(handle, mode.value | 0x0004)  # ENABLE_VIRTUAL_TERMINAL_PROCESSING
+
 
+def clear_console():
+    # Move the cursor to the top left and clear the screen, without starting cls or clear every time
+    print("\033[H\033[J", end="")
 
-def open_bluestacks():
-    # Open Bluestacks
-    subprocess.Popen("C:\\Program Files\\BlueStacks_nxt\\HD-Player.exe")
-    while ads_automator.find_state(should_print=False) != "bluestacks_loading":
-        time.sleep(1)  # Adjust the sleep time based on your system's speed
 
-    print("Bluestacks opened.")
-    while True:
-        ads_automator.find_close()
-        if ads_automator.find_state(should_print=False) == "android_home":
-            break
-        else:
-            print("Bluestacks not loaded yet. Waiting...")
-            time.sleep(5)
+# Readiness probes only look for the one screen they wait for, instead of classifying every state
+loading_probe = StateProbe("BlueStacks_Loading")
+android_home_probe = StateProbe("Android_Home")
+home_probe = StateProbe("Home")
+rewards_probe = StateProbe("Free_Reward")
+
+
+def bluestacks_loading():
+    return loading_probe(askip.ImageFinder.capture_frame(region))
+
 
+def android_home():
+    return android_home_probe(askip.ImageFinder.capture_frame(region))
 
-def close_bluestacks():
-    # Close Bluestacks
-    subprocess.Popen("taskkill /f /im HD-Player.exe")
 
-    # Wait for Bluestacks to close
-    time.sleep(2)  # Adjust the sleep time if necessary
-    print("Bluestacks closed.")
+def dismiss_popups():
+    # A popup can hide the Android home screen. No Esc, it would leave the home screen again
+    ads_automator.find_close(escape=False)
+
+
+def game_showing():
+    # A kept or resumed Bluestacks is still in the game, normally on the rewards page it was left on
+    frame = askip.ImageFinder.capture_frame(region)
+    return rewards_probe(frame) or home_probe(frame)
+
+
+emulator = EmulatorLifecycle(
+    LocalProcess("C:\\Program Files\\BlueStacks_nxt\\HD-Player.exe", image_name="HD-Player.exe"),
+    [("the Bluestacks loading screen", bluestacks_loading, 120),
+     ("Bluestacks to load", android_home, 300, dismiss_popups)],
+    resume_probe=game_showing)
 
 
 def open_game():
     image_path = os.path.join(script_directory, 'snip_images', 'game_logo.png')
     _, x, y = askip.ImageFinder.find_needle(image_path, region)
     if x:
-        askip.MouseController.mouse_pos(x, y)
-        askip.MouseController.left_click()
+        ads_automator.input.click(x, y)
 
 
-def goto_rewards_page():
-    while ads_automator.find_state(should_print=False) != "free_reward":
-        image_path = os.path.join(script_directory, 'snip_images', 'rewards.png')
+async def goto_rewards_page(runtime):
+    image_path = os.path.join(script_directory, 'snip_images', 'rewards.png')
+
+    def click_rewards():
         _, x, y = askip.ImageFinder.find_needle(image_path, region)
         if x:
-            askip.MouseController.mouse_pos(x, y)
-            askip.MouseController.left_click()
-            time.sleep(2)
+            ads_automator.input.click(x, y)
+            return True
+        return False
+
+    await runtime.wait_for(lambda: ads_automator.find_state(should_print=False) == "free_reward", timeout=60,
+                           min_interval=0.2, max_interval=2, action=click_rewards, description="the rewards page")
 
 
-def are_rewards_ready():
+async def are_rewards_ready(runtime):
     image_path = os.path.join(script_directory, 'snip_images', 'free.png')
-    _, x, y = askip.ImageFinder.find_needle(image_path, region)
+    frame = await runtime.run(askip.ImageFinder.capture_frame, region)
+    _, x, y = await runtime.run(askip.ImageFinder.find_needle, image_path, region, frame=frame)
     if x:
-        askip.MouseController.mouse_pos(x, y)
-        askip.MouseController.left_click()
-        time.sleep(5)
-        if x == 105:
+        ads_automator.input.click(x, y)
+        # Give the reward up to 5 seconds to open
+        await runtime.wait_for(lambda: ads_automator.find_state(should_print=False) != "free_reward", timeout=5,
+                               description="the reward to open", raise_on_timeout=False)
+        if abs(x - 105) <= 5:
             print(f"Free Chest Ready at {x}, {y}")
             return "free_chest"
 
-        elif x == 231:
+        elif abs(x - 231) <= 5:
             print(f"Free Gems Ready at {x}, {y}")
             return "free_gems"
 
@@ -226,74 +243,189 @@ def are_rewards_ready():
             return "free_gold_chest"
 
     else:
-        if ads_automator.find_state(should_print=False) == "free_reward":
+        if await runtime.run(ads_automator.find_state, should_print=False, frame=frame) == "free_reward":
             print("Rewards not ready")
             return None
 
 
-def load_game():
-    while ads_automator.find_state(should_print=False) != "home":
-        time.sleep(1)
-        state = ads_automator.find_state(should_print=False)
-        if state == "deal":
+async def load_game(runtime):
+    def close_deal():
+        frame = askip.ImageFinder.capture_frame(region)
+        if ads_automator.find_state(should_print=False, frame=frame) == "deal":
             image_path = os.path.join(script_directory, 'snip_images', 'red_cross.png')
-            _, x, y = askip.ImageFinder.find_needle(image_path, region)
+            _, x, y = askip.ImageFinder.find_needle(image_path, region, frame=frame)
             if x:
-                askip.MouseController.mouse_pos(x, y)
-                askip.MouseController.left_click()
-                time.sleep(1)
+                ads_automator.input.click(x, y)
+                return True
+        return False
+
+    await runtime.wait_for(lambda: ads_automator.find_state(should_print=False) == "home", timeout=180,
+                           min_interval=0.2, max_interval=2, action=close_deal, description="the game to load")
+
+
+async def collect(machine):
+    ad = await are_rewards_ready(machine.runtime)
+    if not ad:
+        return "read_timers"
+    askip.metrics.increment('rewards_collected_total', reward=ad)
+    if ad == "free_chest":
+        return "open_chest"
+    elif ad == "free_gems":
+        return "gems_ad"
+    return "gold_ad"
+
+
+async def watch_ad(runtime, after):
+    # One look for the close button, the state to go to once the ad is over
+    if await runtime.run(ads_automator.wait_for_ad_to_end) == "advert":
+        return None
+    askip.metrics.increment('ads_watched_total')
+    return after
+
+
+async def gems_ad(machine):
+    return await watch_ad(machine.runtime, "reward_done") or "gems_ad"
 
 
-def click_ads():
+async def gold_ad(machine):
+    return await watch_ad(machine.runtime, "open_chest") or "gold_ad"
+
+
+async def open_chest(machine):
+    await machine.runtime.run(ads_automator.open_chest_and_skip)
+    return "reward_done"
+
+
+async def reward_done(machine):
     global amt_ads_done
-    ads_clicked = False
-    while not ads_clicked:
-        ad = are_rewards_ready()
-        if ad:
-            if ad == "free_chest":
-                ads_automator.open_chest_and_skip()
-                time.sleep(2)
-                amt_ads_done += 1
-
-            elif ad == "free_gems":
-                handle_ad()
-                time.sleep(2)
-                amt_ads_done += 1
-
-            elif ad == "free_gold_chest":
-                handle_ad()
-                time.sleep(5)
-                ads_automator.open_chest_and_skip()
-                time.sleep(2)
-                amt_ads_done += 1
+    await wait_for_rewards_page(machine.runtime)
+    amt_ads_done += 1
+    return "collect"
+
+
+async def wait_for_rewards_page(runtime, timeout=5):
+    await runtime.wait_for(lambda: ads_automator.find_state(should_print=False) == "free_reward", timeout=timeout,
+                           description="the rewards page", raise_on_timeout=False)
+
+
+async def start_bluestacks(machine):
+    if await emulator.start(machine.runtime) != "cold":
+        return "rewards_page"  # The game is still open
+    await machine.runtime.run(askip.ImageFinder.resize_bluestacks_window)
+    return "load_game"
+
+
+async def start_game(machine):
+    await machine.runtime.run(open_game)
+    await load_game(machine.runtime)
+    return "rewards_page"
+
+
+async def rewards_page(machine):
+    await goto_rewards_page(machine.runtime)
+    # Wait for all three rewards to show up
+    await machine.runtime.wait_for(lambda: len(find_timer_regions()) == 3, timeout=2, description="the rewards",
+                           raise_on_timeout=False)
+    return "collect"
+
+
+async def read_timers(machine):
+    schedule.replace(await machine.runtime.run(get_ready_times))
+    return "close"
 
-        else:
-            ads_clicked = True
 
+async def close(machine):
+    # Keep Bluestacks running or suspend it if the next reward is ready soon, close it otherwise
+    needed_in = None
+    if schedule.next() is not None:
+        needed_in = (schedule.next()[0] - datetime.datetime.now()).total_seconds()
+    await emulator.park(machine.runtime, needed_in)
+    return "sleep"
 
-def handle_ad():
-    state = "advert"
-    while state == "advert":
-        state = ads_automator.wait_for_ad_to_end()
+
+async def sleep(machine):
+    await wait_until_time(machine.runtime)
+    return "open_bluestacks"
+
+
+async def restart_bluestacks(machine):
+    # Whatever Bluestacks or the game got stuck on, start from scratch
+    await emulator.stop(machine.runtime)
+
+
+def on_screen(name):
+    return lambda: ads_automator.find_state(should_print=False) == name
+
+
+def rewards_machine(runtime):
+    """
+    Args:
+    runtime (AsyncRuntime): Runs the blocking work and the waits.
+
+    Returns:
+    StateMachine: The reward flow as a table of states, forever collecting the free rewards and sleeping until the
+    next one is ready. Restarts Bluestacks when a step times out.
+    """
+    states = [
+        State("open_bluestacks", start_bluestacks, transitions=["load_game", "rewards_page"], progress=True),
+        State("load_game", start_game, transitions=["rewards_page"], progress=True),
+        State("rewards_page", rewards_page, transitions=["collect"], progress=True, detector=on_screen("home")),
+        State("collect", collect, transitions=["open_chest", "gems_ad", "gold_ad", "read_timers"], progress=True,
+              detector=on_screen("free_reward")),
+        State("gems_ad", gems_ad, transitions=["reward_done"], timeout=AD_TIMEOUT, on_timeout="reward_done"),
+        State("gold_ad", gold_ad, transitions=["open_chest"], timeout=AD_TIMEOUT, on_timeout="open_chest"),
+        State("open_chest", open_chest, transitions=["reward_done"], progress=True),
+        State("reward_done", reward_done, transitions=["collect"], progress=True),
+        State("read_timers", read_timers, transitions=["close"], progress=True),
+        State("close", close, transitions=["sleep"], progress=True),
+        State("sleep", sleep, transitions=["open_bluestacks"], progress=True),
+    ]
+    watchdog = Watchdog(STALL_TIMEOUT, [("restart", restart_bluestacks)])
+    return StateMachine('rewards', states, "open_bluestacks", runtime, final=(), watchdog=watchdog)
+
+
+async def main_async(runtime):
+    """
+    Collects the free rewards forever, sleeping until the next one is ready in between.
+
+    Runs on the given AsyncRuntime, so it can share the event loop and the thread pool of ad sessions (see
+    async_runtime.run_sessions, pass main_async(runtime) as a watcher with the same runtime).
+
+    If the schedule saved by an earlier run still has rewards in it, sleeps until the first one is ready instead of
+    starting Bluestacks to read the timers again.
+
+    Args:
+    runtime (AsyncRuntime): Runs the blocking work and the waits.
+    """
+    initial = None
+    if len(schedule):
+        print("Resuming the saved reward schedule")
+        initial = "sleep"
+    await rewards_machine(runtime).run(initial)
 
 
 def main():
-    while True:
-        open_bluestacks()
-        askip.ImageFinder.resize_bluestacks_window()
-        open_game()
-        load_game()
-        goto_rewards_page()
-        time.sleep(2)
-        click_ads()
-        s_time, left = iterate_sleep_function(4)
-        close_bluestacks()
-        wait_until_time(s_time, left)
+    """
+    Runs the reward flow on an event loop and a runtime of its own. Code that already runs a loop awaits main_async
+    instead.
+    """
+    runtime = AsyncRuntime()
+    try:
+        asyncio.run(main_async(runtime))
+    finally:
+        runtime.close()
 
 
 region = {'left': 0, 'top': 0, 'width': 500, 'height': 915}  # Adjust as needed
 
 ads_automator = askip.AdAutomator(4, region)
+timer_reader = TimerReader(process_image, digit_recognizer, metrics=askip.metrics)
 if __name__ == '__main__':
     resize_terminal(50, 10)  # Set console size to 100 columns width and 30 rows height
+    enable_ansi()
+    askip.capture_backend = MssBackend(region)
+    from recorder import record_from_env
+    record_from_env(region)
+    askip.export_from_env(askip.metrics)
+    askip.capture_service = CaptureService(askip.capture_backend, fps=10).start()  # Keeps grabbing in the background
     main()
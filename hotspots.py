@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+
+from atomic_file import atomic_write
+
+
+class HotspotIndex:
+    """
+    Remembers where on the screen each template has been found before, so it can be searched there first.
+
+    Every match found by a full screen search is recorded as a hotspot. The next search for that template only
+    looks at a padded box around each hotspot, which is a lot smaller than the whole 500x915 screen, and only
+    searches the full screen again if none of the boxes has a match. Hotspots are saved to a JSON file so they
+    survive restarts.
+    """
+
+    def __init__(self, path=None, padding=20, max_hotspots=8):
+        """
+        Args:
+        path (str): JSON file to load the hotspots from and save them to, None to keep them in memory only.
+        padding (int): How many pixels around a hotspot to search.
+        max_hotspots (int): The most hotspots to keep per template, the one hit longest ago makes room for a new one.
+        """
+        self.path = path
+        self.padding = padding
+        self.max_hotspots = max_hotspots
+        self._hotspots = {}  # key -> [[x, y, hits, last hit], ...], most hits first
+        self._hits = 0  # Counts every record, the last hit of a hotspot is the count when it was last hit
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(template, haystack_shape):
+        """
+        Builds the key a template's hotspots are stored under.
+
+        The folder is part of the key because some names exist in more than one folder (e.g. continue.png), and
+        the haystack size is part of it because positions only mean something for the same capture region.
+
+        Args:
+        template (Template): The template.
+        haystack_shape (tuple): Shape of the image that is searched.
+
+        Returns:
+        str: The key.
+        """
+        folder = os.path.basename(os.path.dirname(template.path))
+        return f"{folder}/{template.name}@{haystack_shape[1]}x{haystack_shape[0]}"
+
+    def regions(self, key, width, height, haystack_shape):
+        """
+        Returns the boxes to search for a template, one per hotspot, most hits first.
+
+        Args:
+        key (str): Key from HotspotIndex.key.
+        width (int): Width of the template.
+        height (int): Height of the template.
+        haystack_shape (tuple): Shape of the image that is searched.
+
+        Returns:
+        list: List of (left, top, right, bottom) boxes, empty if the template has no hotspots yet.
+        """
+        with self._lock:
+            hotspots = list(self._hotspots.get(key, []))
+        boxes = []
+        for x, y, *_ in hotspots:
+            left = max(x - width // 2 - self.padding, 0)
+            top = max(y - height // 2 - self.padding, 0)
+            right = min(x - width // 2 + width + self.padding, haystack_shape[1])
+            bottom = min(y - height // 2 + height + self.padding, haystack_shape[0])
+            if right - left >= width and bottom - top >= height:
+                boxes.append((left, top, right, bottom))
+        return boxes
+
+    def record(self, key, x, y):
+        """
+        Records a match. A match close to a known hotspot counts as a hit for it, anything else becomes a new one.
+
+        Args:
+        key (str): Key from HotspotIndex.key.
+        x (int): Center x of the match.
+        y (int): Center y of the match.
+        """
+        x, y = int(x), int(y)
+        with self._lock:
+            self._hits += 1
+            hotspots = self._hotspots.setdefault(key, [])
+            for hotspot in hotspots:
+                if abs(hotspot[0] - x) <= self.padding // 2 and abs(hotspot[1] - y) <= self.padding // 2:
+                    hotspot[2] += 1
+                    hotspot[3] = self._hits
+                    hotspots.sort(key=lambda h: -h[2])
+                    return
+            if len(hotspots) >= self.max_hotspots:
+                # Dropping the fewest hits would drop every new hotspot once the old ones have a few hits, so a
+                # button that moved for good would never be learned. The one hit longest ago goes instead
+                hotspots.remove(min(hotspots, key=lambda h: h[3]))
+            hotspots.append([x, y, 1, self._hits])
+            hotspots.sort(key=lambda h: -h[2])
+        # New hotspots are rare, so they are saved straight away
+        self.save()
+
+    def forget(self, key=None):
+        """
+        Drops the hotspots of one template, or of every template if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._hotspots.clear()
+            else:
+                self._hotspots.pop(key, None)
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        with self._lock:
+            # Files saved before hotspots had a last hit count them as hit before any other
+            self._hotspots = {key: [list(h) + [0] * (4 - len(h)) for h in hotspots] for key, hotspots in data.items()}
+            self._hits = max((h[3] for hotspots in self._hotspots.values() for h in hotspots), default=0)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock, atomic_write(self.path) as f:
+            json.dump(self._hotspots, f, indent=1, sort_keys=True)
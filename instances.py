@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import concurrent.futures
+
+import ad_skip_test as askip
+from async_runtime import run_sessions
+from capture import CaptureService, MssBackend, union_region
+
+# Size of one Bluestacks window, the same as the single instance region
+INSTANCE_WIDTH = 500
+INSTANCE_HEIGHT = 915
+
+
+def tile_regions(count, width=INSTANCE_WIDTH, height=INSTANCE_HEIGHT, left=0, top=0):
+    """
+    Lays out count emulator windows side by side.
+
+    Returns:
+    list: One capture region per window, left to right.
+    """
+    return [{'left': left + index * width, 'top': top, 'width': width, 'height': height} for index in range(count)]
+
+
+def run_instances(window_titles, start_no=8, regions=None, fps=10, use_asyncio=False):
+    """
+    Runs automate_ads for several emulator windows at the same time.
+
+    Every window gets its own AdAutomator with its own capture region and input target, all running on one worker
+    pool. They share a single CaptureService that grabs the area around all windows once per frame, and the same
+    template library, hotspots and detector cache, so N instances cost about one screen grab instead of N.
+
+    Args:
+    window_titles (list): The title of every emulator window.
+    start_no (int): Number of ads per chest, as given to AdAutomator.
+    regions (list): Capture region of every window, tile_regions if not given.
+    fps (float): How often the shared capture grabs the screen.
+    use_asyncio (bool): Run the instances as coroutines on one event loop (async_runtime) instead of one worker
+        thread each.
+
+    Returns:
+    dict: {instance name: exception it stopped with, or None if it finished}
+    """
+    if regions is None:
+        regions = tile_regions(len(window_titles))
+    if askip.capture_backend is None:
+        askip.capture_backend = MssBackend(union_region(regions))
+    askip.capture_service = CaptureService(askip.capture_backend, fps=fps).start()
+
+    automators = [askip.AdAutomator(start_no, region, window_title=title, name=f"instance{index}")
+                  for index, (title, region) in enumerate(zip(window_titles, regions))]
+    results = {}
+    try:
+        if use_asyncio:
+            outcomes = asyncio.run(run_sessions(automators))
+            for automator, outcome in zip(automators, outcomes):
+                results[automator.name] = outcome if isinstance(outcome, Exception) else None
+                print(f"{automator.name} ({automator.window_title}) "
+                      f"{'stopped: ' + repr(outcome) if results[automator.name] else 'finished'}")
+            return results
+
+        # One worker per instance, each automate_ads loop blocks its worker until the instance has no ads left
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(automators),
+                                                   thread_name_prefix="instance") as executor:
+            futures = {executor.submit(automator.automate_ads): automator for automator in automators}
+            for future in concurrent.futures.as_completed(futures):
+                automator = futures[future]
+                try:
+                    future.result()
+                    results[automator.name] = None
+                    print(f"{automator.name} ({automator.window_title}) finished")
+                except Exception as e:
+                    results[automator.name] = e
+                    print(f"{automator.name} ({automator.window_title}) stopped: {e!r}")
+    finally:
+        askip.capture_service.stop()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch ads in several Bluestacks windows at once")
+    parser.add_argument('windows', nargs='+', help="title of every Bluestacks window, e.g. \"BlueStacks App Player 1\"")
+    parser.add_argument('--start-no', type=int, default=8, help="ads per chest")
+    parser.add_argument('--fps', type=float, default=10, help="how often the shared capture grabs the screen")
+    parser.add_argument('--asyncio', action='store_true', help="run every instance on one event loop")
+    args = parser.parse_args()
+
+    askip.export_from_env(askip.metrics)
+    run_instances(args.windows, args.start_no, fps=args.fps, use_asyncio=args.asyncio)
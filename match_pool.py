@@ -0,0 +1,215 @@
+import atexit
+import concurrent.futures
+import os
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from fft_match import FftMatcher
+
+MODES = ("thread", "process", "fft")
+
+# Shared memory blocks this worker process has attached to, by name
+_attached = {}
+
+
+def _init_worker(hotspots_path):
+    """
+    Runs once in every worker process.
+
+    Workers start from the saved hotspots, but keep what they learn to themselves. hotspots.json belongs to the main
+    process, which records the matches the workers send back.
+    """
+    import ad_skip_test as askip
+    from hotspots import HotspotIndex
+
+    askip.hotspots = HotspotIndex(hotspots_path)
+    askip.hotspots.path = None
+
+
+def _attach(name):
+    block = _attached.get(name)
+    if block is None:
+        # Worker processes share the main process' resource tracker, which removes the block when the pool shuts down
+        block = shared_memory.SharedMemory(name=name)
+        _attached[name] = block
+    return block
+
+
+def _match_shared(name, shape, template_path, pyramid):
+    """
+    Runs in a worker process: matches a template against the grayscale frame in a shared memory block.
+
+    The worker's own TemplateLibrary keeps the decoded templates, so only the path is sent.
+
+    Returns:
+    tuple: (name, x, y, confidence) of the best match, or None.
+    """
+    import ad_skip_test as askip
+    from capture import Frame
+
+    gray = np.ndarray(shape, np.uint8, buffer=_attach(name).buf)
+    matches = askip.ImageFinder.template_matching(Frame(gray), template_path, pyramid=pyramid)
+    if not matches:
+        return None
+    match = matches[0]
+    return match.name, match.x, match.y, match.confidence
+
+
+class MatchPool:
+    """
+    A long lived pool that matches the templates of a folder against one frame.
+
+    Replaces the ThreadPoolExecutor find_1_of_folder and the StateClassifier used to start and stop on every call.
+    It has as many workers as there are cores, started on first use.
+
+    "thread" mode runs template_matching on a thread pool, which works well because matchTemplate releases the GIL.
+    "process" mode runs it in worker processes that keep their own decoded templates. The frame is copied once into
+    a shared memory block that the workers read in place, instead of being pickled for every template.
+    "fft" mode is thread mode with the full frame searches done by an FftMatcher, which transforms the frame once for
+    all templates. Pyramid searches are already coarse, they are done by template_matching as in thread mode.
+
+    When only the first match is wanted, the templates after the first one that matched are cancelled, and the
+    result does not wait for them. The first match is still the first in folder order, as before.
+    """
+
+    def __init__(self, mode="thread", workers=None):
+        """
+        Args:
+        mode (str): "thread", "process" or "fft".
+        workers (int): How many workers to run, the number of cores if None.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown match pool mode {mode!r}, use one of {MODES}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 4
+        self._executor = None
+        self.fft = FftMatcher() if mode == "fft" else None
+        self._free_blocks = []  # Shared memory blocks not used by a call right now
+        self._blocks = []
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.mode != "process":
+                    self._executor = concurrent.futures.ThreadPoolExecutor(self.workers,
+                                                                           thread_name_prefix="match")
+                else:
+                    import ad_skip_test as askip
+                    self._executor = concurrent.futures.ProcessPoolExecutor(
+                        self.workers, initializer=_init_worker, initargs=(askip.hotspots.path,))
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def _take_block(self, size):
+        with self._lock:
+            for block in self._free_blocks:
+                if block.size >= size:
+                    self._free_blocks.remove(block)
+                    return block
+        block = shared_memory.SharedMemory(create=True, size=size)
+        with self._lock:
+            self._blocks.append(block)
+        return block
+
+    def _give_back(self, block):
+        with self._lock:
+            self._free_blocks.append(block)
+
+    def match(self, frame, folder_templates, pyramid=False, first=False):
+        """
+        Matches every template against the frame.
+
+        Args:
+        frame (Frame): The frame to search.
+        folder_templates (list): The Templates to look for.
+        pyramid (bool): Use coarse to fine matching, see ImageFinder.template_matching.
+        first (bool): Only the first template in the list that matches is wanted.
+
+        Returns:
+        list: The best Match of every template, or None where it did not match (or was cancelled).
+        """
+        import ad_skip_test as askip
+
+        executor = self._get_executor()
+        block = None
+        if self.mode == "fft" and not pyramid:
+            self.fft.prepare(frame)  # Once here instead of by whichever worker gets there first
+            futures = [executor.submit(self._match_fft, frame, template) for template in folder_templates]
+        elif self.mode != "process":
+            futures = [executor.submit(self._match_in_thread, frame, template, pyramid)
+                       for template in folder_templates]
+        else:
+            gray = frame.gray
+            block = self._take_block(gray.nbytes)
+            np.ndarray(gray.shape, np.uint8, buffer=block.buf)[:] = gray
+            futures = [executor.submit(_match_shared, block.name, gray.shape, template.path, pyramid)
+                       for template in folder_templates]
+
+        results = [None] * len(futures)
+        try:
+            best = len(futures)
+            index_of = {future: index for index, future in enumerate(futures)}
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                index = index_of[future]
+                match = future.result()
+                if match is not None and block is not None:
+                    match = askip.Match(*match)
+                    # The workers can not save hotspots, remember them here
+                    template = folder_templates[index]
+                    askip.hotspots.record(askip.HotspotIndex.key(template, frame.gray.shape), match.x, match.y)
+                results[index] = match
+                if first and match is not None and index < best:
+                    best = index
+                    for later in futures[index + 1:]:
+                        later.cancel()
+                # Done once every template before the best match has been matched
+                if first and best < len(futures) and all(f.done() for f in futures[:best]):
+                    break
+        finally:
+            if block is not None:
+                self._release_when_done(futures, block)
+        return results
+
+    @staticmethod
+    def _match_in_thread(frame, template, pyramid):
+        import ad_skip_test as askip
+
+        matches = askip.ImageFinder.template_matching(frame, template, pyramid=pyramid)
+        return matches[0] if matches else None
+
+    def _match_fft(self, frame, template):
+        matches = self.fft.template_matching(frame, template)
+        return matches[0] if matches else None
+
+    def _release_when_done(self, futures, block):
+        # Workers may still be reading the block for templates that could not be cancelled any more
+        if not futures:
+            self._give_back(block)
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._give_back(block)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            blocks, self._blocks, self._free_blocks = self._blocks, [], []
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for block in blocks:
+            block.close()
+            block.unlink()
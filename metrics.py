@@ -0,0 +1,301 @@
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+from atomic_file import atomic_write
+
+# Upper bounds in seconds of the latency histogram buckets, from a hotspot match (sub millisecond) to a whole state
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Buckets for histograms that count attempts instead of timing something
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, like a Prometheus histogram, so it takes the same memory after a day as
+    after a minute. Percentiles are estimated from the buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one counts everything above the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimates a percentile by interpolating inside the bucket it falls in.
+
+        Args:
+        q (float): The percentile as a fraction, e.g. 0.9.
+
+        Returns:
+        float: The estimate, or None if nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Metrics:
+    """
+    Collects counters, histograms and gauges from the hot paths.
+
+    Every metric has a name and optional labels (e.g. the template name), each combination is kept separately.
+    Recording a sample only takes a lock and a few additions, so it is cheap enough for every template match.
+    """
+
+    def __init__(self, namespace="adskip"):
+        """
+        Args:
+        namespace (str): Prefix of every metric name in the Prometheus export.
+        """
+        self.namespace = namespace
+        self.started = time.time()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._gauges = {}  # name -> callable returning the current value
+        self._states = {}  # state machine name -> (state, time it was entered)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Adds to a counter, e.g. increment('clicks_total').
+        """
+        key = Metrics._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        """
+        Adds a sample to a histogram, e.g. observe('capture_seconds', 0.012, source='mss').
+        """
+        key = Metrics._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Times the code inside a with block and adds the duration in seconds to a histogram.
+
+        Yields a dict, labels added to it inside the block (e.g. whether something was found) are recorded too.
+        """
+        extra = {}
+        started = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            self.observe(name, time.perf_counter() - started, **dict(labels, **extra))
+
+    def gauge(self, name, function):
+        """
+        Registers a value that is worked out when the metrics are exported, e.g. ads per hour.
+        """
+        with self._lock:
+            self._gauges[name] = function
+
+    def transition(self, machine, state):
+        """
+        Tells the metrics a state machine is now in a state.
+
+        When the state differs from the previous one, the time spent in the previous state is added to the
+        state_seconds histogram and the transition is counted. Calling it again with the same state does nothing, so
+        it can be called on every loop iteration.
+
+        Args:
+        machine (str): Name of the state machine, e.g. "automate_ads".
+        state (str): The state it is in now.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            previous = self._states.get(machine)
+            if previous is not None and previous[0] == state:
+                return
+            self._states[machine] = (state, now)
+        if previous is not None:
+            self.observe('state_seconds', now - previous[1], machine=machine, state=previous[0])
+        source = previous[0] if previous is not None else "start"
+        self.increment('state_transitions_total', machine=machine, source=source, target=state)
+
+    def per_hour(self, name, **labels):
+        """
+        Returns how often a counter went up per hour since the metrics were created.
+        """
+        hours = max(time.time() - self.started, 1) / 3600
+        with self._lock:
+            return self._counters.get(Metrics._key(name, labels), 0) / hours
+
+    def snapshot(self):
+        """
+        Returns everything collected so far as plain data, ready for json.dumps.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [dict(histogram.snapshot(), name=name, labels=dict(labels))
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+            gauges = dict(self._gauges)
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'counters': counters,
+            'histograms': histograms,
+            'gauges': {name: function() for name, function in sorted(gauges.items())},
+        }
+
+    def prometheus_text(self):
+        """
+        Returns everything collected so far in the Prometheus text format, for the node exporter textfile collector.
+        """
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(key, value.replace('\\', '\\\\').replace('"', '\\"')) for key, value in pairs]
+            return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, histogram.snapshot()) for key, histogram in self._histograms.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            full_name = f"{self.namespace}_{name}"
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f"# TYPE {full_name} counter")
+            lines.append(f"{full_name}{label_text(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            full_name = f"{self.namespace}_{name}"
+            if full_name not in typed:
+                typed.add(full_name)
+                lines.append(f"# TYPE {full_name} histogram")
+            cumulative = 0
+            for bucket, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f"{full_name}_bucket{label_text(labels, [('le', bucket)])} {cumulative}")
+            lines.append(f"{full_name}_sum{label_text(labels)} {histogram['sum']}")
+            lines.append(f"{full_name}_count{label_text(labels)} {histogram['count']}")
+        for name, function in gauges:
+            full_name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {full_name} gauge")
+            lines.append(f"{full_name} {function()}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """
+    Writes the metrics to disk every few seconds from a background thread: a snapshot per line appended to a JSONL
+    file that is rotated when it gets too big, and a Prometheus textfile that is replaced each time.
+    """
+
+    def __init__(self, metrics, folder, interval=15, max_bytes=5 * 1024 * 1024, backups=3):
+        """
+        Args:
+        metrics (Metrics): The metrics to export.
+        folder (str): Where to write metrics.jsonl and metrics.prom.
+        interval (float): Seconds between exports.
+        max_bytes (int): Size at which metrics.jsonl is rotated to metrics.jsonl.1.
+        backups (int): How many rotated files to keep.
+        """
+        self.metrics = metrics
+        self.jsonl_path = os.path.join(folder, 'metrics.jsonl')
+        self.prometheus_path = os.path.join(folder, 'metrics.prom')
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(folder, exist_ok=True)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-exporter", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.export()  # Keep what happened since the last export
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.export()
+            except OSError as e:
+                print(f"Could not export metrics: {e}")
+
+    def export(self):
+        self._rotate()
+        with open(self.jsonl_path, 'a') as f:
+            f.write(json.dumps(self.metrics.snapshot()) + "\n")
+        # The collector never reads a half written file
+        with atomic_write(self.prometheus_path) as f:
+            f.write(self.metrics.prometheus_text())
+
+    def _rotate(self):
+        if not os.path.exists(self.jsonl_path) or os.path.getsize(self.jsonl_path) < self.max_bytes:
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.jsonl_path}.{index}"):
+                os.replace(f"{self.jsonl_path}.{index}", f"{self.jsonl_path}.{index + 1}")
+        os.replace(self.jsonl_path, f"{self.jsonl_path}.1")
+
+
+def export_from_env(metrics):
+    """
+    Starts exporting the metrics if the METRICS_DIR environment variable names a folder: timings and counters are
+    written to metrics.jsonl and metrics.prom in it every 15 seconds.
+
+    Args:
+    metrics (Metrics): The metrics to export.
+
+    Returns:
+    MetricsExporter: The running exporter, None if METRICS_DIR is not set.
+    """
+    if not os.environ.get('METRICS_DIR'):
+        return None
+    return MetricsExporter(metrics, os.environ['METRICS_DIR']).start()
@@ -0,0 +1,279 @@
+import atexit
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from capture import CaptureBackend, MssBackend
+
+# Every record in a session file starts with: kind (1 byte), timestamp (double), payload length (uint32)
+RECORD_HEADER = struct.Struct('<cdI')
+# Frame payloads start with: height, width, channels, left, top, then the zlib compressed pixels
+FRAME_HEADER = struct.Struct('<HHBii')
+
+KIND_KEYFRAME = b'K'  # Full frame
+KIND_DELTA = b'D'  # Frame XOR the previous frame, mostly zeros so it compresses very well
+KIND_ACTION = b'A'  # JSON encoded input action
+KIND_META = b'M'  # JSON encoded information about the session
+
+# A full frame is written every this many frames, so a damaged delta can not spoil the rest of the session
+KEYFRAME_INTERVAL = 100
+
+
+class SessionRecorder:
+    """
+    Writes every captured frame and every input action of a session to one append-only file.
+
+    Frames are stored as the XOR with the previous frame and zlib compressed, which makes a mostly static screen
+    cost only a few bytes per frame. Actions (mouse moves, clicks and key presses) are stored as JSON. Everything
+    carries its timestamp, so a session can be replayed with replay.py.
+    """
+
+    def __init__(self, path, meta=None):
+        """
+        Args:
+        path (str): The session file to write, overwritten if it exists.
+        meta (dict): Anything worth keeping about the session, e.g. the capture region.
+        """
+        self.path = path
+        self._file = open(path, 'wb')
+        self._lock = threading.Lock()
+        self._previous = None
+        self._frames_since_keyframe = 0
+        self.frames = 0
+        self.actions = 0
+        self._write(KIND_META, time.time(), json.dumps(meta or {}).encode())
+
+    def _write(self, kind, timestamp, payload):
+        self._file.write(RECORD_HEADER.pack(kind, timestamp, len(payload)))
+        self._file.write(payload)
+
+    def record_frame(self, image, region=None, timestamp=None):
+        """
+        Adds a frame to the session.
+
+        Args:
+        image (np.array): The screenshot.
+        region (dict): The screen region it was taken from.
+        timestamp (float): When it was taken, defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        left, top = (region['left'], region['top']) if region else (0, 0)
+        with self._lock:
+            previous = self._previous
+            if (previous is None or previous.shape != image.shape
+                    or self._frames_since_keyframe >= KEYFRAME_INTERVAL):
+                kind, pixels = KIND_KEYFRAME, image
+                self._frames_since_keyframe = 0
+            else:
+                kind, pixels = KIND_DELTA, np.bitwise_xor(image, previous)
+                self._frames_since_keyframe += 1
+            payload = FRAME_HEADER.pack(height, width, channels, left, top) + zlib.compress(pixels.tobytes(), 1)
+            self._write(kind, timestamp, payload)
+            self._previous = image.copy()
+            self.frames += 1
+
+    def record_action(self, kind, data, timestamp=None):
+        """
+        Adds an input action to the session. Has the same arguments as an ad_skip_test.action_listeners listener.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        payload = json.dumps(dict(data, kind=kind)).encode()
+        with self._lock:
+            self._write(KIND_ACTION, timestamp, payload)
+            self.actions += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RecordingBackend(CaptureBackend):
+    """
+    Wraps another capture backend and records every frame it grabs.
+    """
+
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+        self.region = backend.region
+
+    def open(self):
+        self.backend.open()
+        self.region = self.backend.region
+
+    def grab(self, region=None):
+        image = self.backend.grab(region)
+        self.recorder.record_frame(image, region or self.region)
+        return image
+
+    def close(self):
+        self.backend.close()
+
+
+class SessionFrames:
+    """
+    The frames of a session file, only decoded when they are asked for.
+
+    A session holds 10 frames a second of 1.8 MB each, far too much to decode into memory at once. Reading the file
+    only indexes where every frame is, and a frame is decoded from the keyframe before it. The last decoded frame is
+    kept, so going through the frames in order decodes every record once.
+
+    Behaves like a read only list of (timestamp, region, image). Close it (or use it as a context manager) when done.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+        path (str): The session file, indexed by read_session.
+        """
+        self.path = path
+        self.timestamps = []
+        self._records = []  # (kind, payload offset, payload length, shape) of every frame
+        self._regions = []
+        self._keyframes = []  # Index of the keyframe every frame is decoded from
+        self._last = None  # (index, image) of the last decoded frame
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+
+    def _index(self, kind, timestamp, offset, length, header):
+        height, width, channels, left, top = FRAME_HEADER.unpack(header)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        keyframe = len(self._records) if kind == KIND_KEYFRAME else self._keyframes[-1]
+        self.timestamps.append(timestamp)
+        self._records.append((kind, offset, length, shape))
+        self._regions.append({'left': left, 'top': top, 'width': width, 'height': height})
+        self._keyframes.append(keyframe)
+
+    def _decode(self, index, previous):
+        kind, offset, length, shape = self._records[index]
+        self._file.seek(offset + FRAME_HEADER.size)
+        pixels = np.frombuffer(zlib.decompress(self._file.read(length - FRAME_HEADER.size)), np.uint8).reshape(shape)
+        return pixels.copy() if kind == KIND_KEYFRAME else np.bitwise_xor(pixels, previous)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("session frame index out of range")
+        with self._lock:
+            start, image = self._keyframes[index], None
+            if self._last is not None and start <= self._last[0] <= index:
+                start, image = self._last[0] + 1, self._last[1]
+            for i in range(start, index + 1):
+                image = self._decode(i, image)
+            self._last = (index, image)
+        return self.timestamps[index], self._regions[index], image
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._last = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_session(path):
+    """
+    Reads a session file written by SessionRecorder. Only the actions are read into memory, the frames are indexed
+    and decoded when they are used.
+
+    Args:
+    path (str): The session file.
+
+    Returns:
+    tuple: (meta, frames, actions) where frames is a SessionFrames of (timestamp, region, image) and actions a list
+    of (timestamp, action dict), both in the order they were recorded.
+    """
+    meta = {}
+    frames = SessionFrames(path)
+    actions = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            kind, timestamp, length = RECORD_HEADER.unpack(header)
+            offset = f.tell()
+            if offset + length > size:
+                break  # The recording was cut off mid record
+            if kind in (KIND_KEYFRAME, KIND_DELTA):
+                # Only the frame header is read, the pixels are decoded when they are used
+                payload = f.read(FRAME_HEADER.size)
+                f.seek(offset + length)
+            else:
+                payload = f.read(length)
+            if kind == KIND_META:
+                meta = json.loads(payload)
+            elif kind == KIND_ACTION:
+                actions.append((timestamp, json.loads(payload)))
+            elif kind in (KIND_KEYFRAME, KIND_DELTA):
+                frames._index(kind, timestamp, offset, length, payload)
+    return meta, frames, actions
+
+
+def record_session(path, region, finder=None):
+    """
+    Starts recording the running session: every frame captured through ad_skip_test and every input action.
+
+    The capture_backend of ad_skip_test is wrapped in a RecordingBackend, so call this after setting it and before
+    starting a CaptureService.
+
+    Args:
+    path (str): The session file to write.
+    region (dict): The capture region, kept in the session's meta data.
+    finder (module): The ad_skip_test module, needed when it runs as __main__.
+
+    Returns:
+    SessionRecorder: The recorder, closed automatically when the script exits.
+    """
+    if finder is None:
+        import ad_skip_test as finder
+    recorder = SessionRecorder(path, {'region': region})
+    if finder.capture_backend is None:
+        finder.capture_backend = MssBackend(region)
+    finder.capture_backend = RecordingBackend(finder.capture_backend, recorder)
+    finder.action_listeners.append(recorder.record_action)
+    atexit.register(recorder.close)
+    print(f"Recording session to {path}")
+    return recorder
+
+
+def record_from_env(region, finder=None):
+    """
+    Starts recording the running session if the RECORD_SESSION environment variable names a file: every frame and
+    input is written to it, to replay it later with replay.py. See record_session.
+
+    Returns:
+    SessionRecorder: The recorder, None if RECORD_SESSION is not set.
+    """
+    if not os.environ.get('RECORD_SESSION'):
+        return None
+    return record_session(os.environ['RECORD_SESSION'], region, finder)
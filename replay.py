@@ -0,0 +1,342 @@
+import argparse
+import asyncio
+import bisect
+import datetime
+import math
+import sys
+import time
+import types
+
+import ad_skip_test as askip
+import capture
+from async_runtime import AsyncRuntime
+from capture import CaptureBackend, ChangeDetector
+from emulator import LocalProcess
+from hotspots import HotspotIndex
+from match_pool import MatchPool
+from recorder import read_session
+from reward_schedule import RewardSchedule
+from state_machine import StuckError
+from state_signatures import StateSignatures
+
+
+class ReplayFinished(Exception):
+    """
+    Raised by SessionBackend once the recorded frames have run out, which ends the replayed flow.
+    """
+
+
+class VirtualClock:
+    """
+    Stands in for the time module while replaying, so sleeps take no real time.
+
+    Time only moves forward when the code sleeps or grabs a frame, which makes a replay deterministic and lets it
+    run much faster than real time.
+    """
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+    def __getattr__(self, name):
+        # Anything else (strftime and friends) comes from the real time module
+        return getattr(time, name)
+
+
+def fake_datetime_module(clock):
+    """
+    Returns a stand in for the datetime module whose datetime.now() follows the virtual clock.
+    """
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.fromtimestamp(clock.now, tz)
+
+    return types.SimpleNamespace(datetime=VirtualDatetime, timedelta=datetime.timedelta)
+
+
+class SessionBackend(CaptureBackend):
+    """
+    Serves recorded frames according to the virtual clock: every grab returns the newest frame recorded at or before
+    the current virtual time.
+
+    Every grab also moves the clock forward by capture_cost, so code that polls without sleeping still moves
+    through the recording.
+    """
+
+    def __init__(self, frames, clock, capture_cost=0.05, tail=5.0):
+        """
+        Args:
+        frames (SessionFrames): The frames from read_session, decoded as they are served.
+        clock (VirtualClock): The virtual clock.
+        capture_cost (float): Virtual seconds every grab takes.
+        tail (float): How long after the last frame the replay keeps going before it ends.
+        """
+        self.frames = frames
+        self.timestamps = frames.timestamps
+        self.clock = clock
+        self.capture_cost = capture_cost
+        self.tail = tail
+        self.region = frames[0][1]
+        self.frames_served = 0
+
+    def grab(self, region=None):
+        self.clock.sleep(self.capture_cost)
+        if self.clock.now > self.timestamps[-1] + self.tail:
+            raise ReplayFinished()
+        index = max(bisect.bisect_right(self.timestamps, self.clock.now) - 1, 0)
+        _, frame_region, image = self.frames[index]
+        self.frames_served += 1
+        return capture.crop_region(image, frame_region, region)
+
+
+class FakeMouseController:
+    """
+    Replaces ad_skip_test.MouseController while replaying: actions are only reported, the real mouse is not touched.
+    """
+
+    @staticmethod
+    def left_click():
+        askip.notify_action('click')
+
+    @staticmethod
+    def mouse_pos(*args):
+        if len(args) == 1:
+            x, y = args[0]
+        elif len(args) == 2:
+            x, y = args
+        else:
+            raise ValueError("Expected either a tuple (x, y) or two separate arguments x and y.")
+        askip.notify_action('move', x=int(x), y=int(y))
+
+
+class FakeKeyboardController:
+    """
+    Replaces ad_skip_test.KeyboardController while replaying.
+    """
+
+    @staticmethod
+    def press(key):
+        askip.notify_action('key', key=key)
+
+
+class FakeEmulator(LocalProcess):
+    """
+    Replaces Bluestacks while replaying: a local Python process that only sleeps, so launching, suspending and
+    stopping it work for real on any OS. Every call is reported as an action.
+    """
+
+    def __init__(self):
+        super().__init__([sys.executable, "-c", "import time; time.sleep(24 * 3600)"])
+
+    def launch(self):
+        askip.notify_action('launch', command='emulator')
+        super().launch()
+
+    def stop(self):
+        askip.notify_action('launch', command='stop emulator')
+        super().stop()
+
+    def suspend(self):
+        askip.notify_action('launch', command='suspend emulator')
+        super().suspend()
+
+    def resume(self):
+        askip.notify_action('launch', command='resume emulator')
+        super().resume()
+
+
+class ReplayReport:
+    """
+    What happened during a replay, compared against what happened during the recording.
+    """
+
+    def __init__(self, recorded_actions, start):
+        self.start = start
+        self.recorded_actions = [(t - start, action) for t, action in recorded_actions]
+        self.replayed_actions = []
+        self.virtual_seconds = 0.0
+        self.real_seconds = 0.0
+        self.frames_served = 0
+        self.match_calls = 0
+        self.match_seconds = 0.0
+        self.error = None
+
+    @staticmethod
+    def clicks(actions):
+        """
+        Returns (time, x, y) of every click, using the position of the mouse move before it.
+        """
+        clicks = []
+        x = y = None
+        for t, action in actions:
+            if action['kind'] == 'move':
+                x, y = action['x'], action['y']
+            elif action['kind'] == 'click':
+                clicks.append((t, x, y))
+        return clicks
+
+    def cycle_times(self, actions=None):
+        """
+        Returns the time between one click and the next, the time the flow needs per step.
+        """
+        clicks = ReplayReport.clicks(self.replayed_actions if actions is None else actions)
+        return [b[0] - a[0] for a, b in zip(clicks, clicks[1:])]
+
+    def click_differences(self, tolerance=10):
+        """
+        Compares the replayed clicks with the recorded ones, in order.
+
+        Returns:
+        list: (index, recorded click, replayed click) for every click that is missing, extra or more than
+        tolerance pixels away from the recorded one.
+        """
+        recorded = ReplayReport.clicks(self.recorded_actions)
+        replayed = ReplayReport.clicks(self.replayed_actions)
+        differences = []
+        for index in range(max(len(recorded), len(replayed))):
+            a = recorded[index] if index < len(recorded) else None
+            b = replayed[index] if index < len(replayed) else None
+            if a is None or b is None or a[1] is None or b[1] is None \
+                    or math.hypot(a[1] - b[1], a[2] - b[2]) > tolerance:
+                differences.append((index, a, b))
+        return differences
+
+    def summary(self):
+        lines = [
+            f"Virtual time: {self.virtual_seconds:.1f}s in {self.real_seconds:.1f}s real "
+            f"({self.virtual_seconds / max(self.real_seconds, 1e-9):.1f}x)",
+            f"Frames served: {self.frames_served}",
+            f"Template matches: {self.match_calls} taking {self.match_seconds * 1000:.0f}ms "
+            f"({self.match_seconds * 1000 / max(self.match_calls, 1):.2f}ms each)",
+        ]
+        cycles = self.cycle_times()
+        if cycles:
+            cycles = sorted(cycles)
+            lines.append(f"Time between clicks: median {cycles[len(cycles) // 2]:.2f}s, max {cycles[-1]:.2f}s "
+                         f"over {len(cycles)} steps")
+        recorded_clicks = len(ReplayReport.clicks(self.recorded_actions))
+        replayed_clicks = len(ReplayReport.clicks(self.replayed_actions))
+        lines.append(f"Clicks: {replayed_clicks} replayed, {recorded_clicks} recorded, "
+                     f"{len(self.click_differences())} different")
+        if self.error:
+            lines.append(f"Stopped by: {self.error!r}")
+        return "\n".join(lines)
+
+
+def replay_session(path, flow="ads", start_no=8, capture_cost=0.05):
+    """
+    Replays a recorded session through AdAutomator.automate_ads or game_test.main_async, with virtual time and fake input.
+
+    Runs without a display or Windows, as fast as the matching allows.
+
+    Args:
+    path (str): Session file written by SessionRecorder.
+    flow (str): "ads" for AdAutomator.automate_ads, "rewards" for game_test.main_async.
+    start_no (int): Number of ads per chest, as given to AdAutomator.
+    capture_cost (float): Virtual seconds every grab takes.
+
+    Returns:
+    ReplayReport: What happened.
+    """
+    meta, frames, actions = read_session(path)
+    if not frames:
+        frames.close()
+        raise ValueError(f"No frames in session {path}")
+    region = meta.get('region') or frames[0][1]
+    clock = VirtualClock(frames[0][0])
+    backend = SessionBackend(frames, clock, capture_cost)
+    report = ReplayReport(actions, frames[0][0])
+
+    def listen(kind, data):
+        report.replayed_actions.append((clock.now - report.start, dict(data, kind=kind)))
+
+    original_matching = askip.ImageFinder.template_matching
+
+    def timed_matching(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original_matching(*args, **kwargs)
+        finally:
+            report.match_calls += 1
+            report.match_seconds += time.perf_counter() - started
+
+    # Swap everything that touches the desktop, the clock or files on disk
+    patches = [
+        (askip, 'capture_backend', backend),
+        (askip, 'capture_service', None),
+        (askip, 'time', clock),
+        (askip, 'MouseController', FakeMouseController),
+        (askip, 'KeyboardController', FakeKeyboardController),
+        (askip, 'hotspots', HotspotIndex()),
+        (askip, 'state_signatures', StateSignatures()),
+        (askip, 'change_detector', ChangeDetector()),
+        (askip.ImageFinder, 'template_matching', staticmethod(timed_matching)),
+        (askip, 'match_pool', MatchPool('thread')),  # So every match goes through the timed template_matching
+        (capture, 'time', clock),
+    ]
+    if flow == "rewards":
+        import game_test
+        emulator = FakeEmulator()
+        patches += [
+            (game_test, 'datetime', fake_datetime_module(clock)),
+            (game_test.emulator, 'process', emulator),
+            (game_test.emulator, 'parked', None),
+            (game_test, 'clear_console', lambda: None),
+            (game_test, 'schedule', RewardSchedule()),
+            (game_test.timer_reader, 'clock', clock),
+            (game_test, 'region', region),
+            (game_test, 'ads_automator', askip.AdAutomator(4, region)),
+        ]
+    saved = [(target, name, target.__dict__.get(name)) for target, name, _ in patches]
+    for target, name, value in patches:
+        setattr(target, name, value)
+    askip.action_listeners.append(listen)
+
+    started = time.perf_counter()
+    try:
+        if flow == "rewards":
+            import game_test
+            runtime = AsyncRuntime(clock=clock)
+            try:
+                asyncio.run(game_test.main_async(runtime))
+            finally:
+                runtime.close()
+        else:
+            askip.AdAutomator(start_no, region).automate_ads()
+    except ReplayFinished:
+        pass
+    except (TimeoutError, StuckError) as e:
+        report.error = e
+    finally:
+        report.real_seconds = time.perf_counter() - started
+        report.virtual_seconds = clock.now - report.start
+        report.frames_served = backend.frames_served
+        frames.close()
+        askip.action_listeners.remove(listen)
+        if flow == "rewards":
+            emulator.stop()  # Not reported any more, the replay is over
+        for target, name, value in saved:
+            setattr(target, name, value)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded session without Bluestacks")
+    parser.add_argument('session', help="session file written while RECORD_SESSION was set")
+    parser.add_argument('flow', nargs='?', default="ads", choices=["ads", "rewards"])
+    parser.add_argument('--start-no', type=int, default=8, help="ads per chest")
+    parser.add_argument('--capture-cost', type=float, default=0.05, help="virtual seconds per screenshot")
+    args = parser.parse_args()
+    print(replay_session(args.session, args.flow, args.start_no, args.capture_cost).summary())
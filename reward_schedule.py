@@ -0,0 +1,90 @@
+import datetime
+import heapq
+import json
+import os
+import threading
+
+from atomic_file import atomic_write
+
+
+class RewardSchedule:
+    """
+    Remembers when every free reward (Silver Chest, Gems, Gold Chest) is ready, soonest first.
+
+    The ready times are kept in a priority queue, so the next one is always at the front, and saved to a JSON file
+    so they survive restarts. After a restart the script can sleep until the next reward straight away, instead of
+    starting Bluestacks just to read the timers again.
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+        path (str): JSON file to load the schedule from and save it to, None to keep it in memory only.
+        """
+        self.path = path
+        self._queue = []  # heap of (ready time, reward)
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def next(self):
+        """
+        Returns:
+        tuple: (ready time, reward) of the reward that is ready first, None if the schedule is empty.
+        """
+        with self._lock:
+            return self._queue[0] if self._queue else None
+
+    def entries(self):
+        """
+        Returns:
+        list: (ready time, reward) of every reward, soonest first.
+        """
+        with self._lock:
+            return sorted(self._queue)
+
+    def set(self, reward, ready):
+        """
+        Sets when one reward is ready, replacing the time it had before.
+
+        Args:
+        reward (str): Name of the reward, e.g. "Gems".
+        ready (datetime.datetime): When it is ready.
+        """
+        with self._lock:
+            self._queue = [entry for entry in self._queue if entry[1] != reward]
+            self._queue.append((ready, reward))
+            heapq.heapify(self._queue)
+        self.save()
+
+    def replace(self, ready_times):
+        """
+        Replaces the whole schedule, e.g. after reading every timer again.
+
+        Args:
+        ready_times (dict): {reward: when it is ready}
+        """
+        with self._lock:
+            self._queue = [(ready, reward) for reward, ready in ready_times.items()]
+            heapq.heapify(self._queue)
+        self.save()
+
+    def clear(self):
+        self.replace({})
+
+    def load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        queue = [(datetime.datetime.fromisoformat(ready), reward) for reward, ready in data.items()]
+        heapq.heapify(queue)
+        with self._lock:
+            self._queue = queue
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock, atomic_write(self.path) as f:
+            json.dump({reward: ready.isoformat() for ready, reward in self._queue}, f, indent=1, sort_keys=True)
@@ -0,0 +1,178 @@
+import ad_skip_test as askip
+from metrics import COUNT_BUCKETS
+
+
+class StuckError(Exception):
+    """
+    Raised when a state machine made no progress and every recovery of its watchdog has been tried.
+    """
+
+
+class State:
+    """
+    One state of a StateMachine, declared up front instead of written as a while loop.
+    """
+
+    def __init__(self, name, action, transitions=(), timeout=None, on_timeout=None, progress=False, detector=None):
+        """
+        Args:
+        name (str): The state's name.
+        action (callable): Coroutine function taking the StateMachine. Does one short step and returns the name of
+            the next state, its own name to take another step.
+        transitions (iterable): The states the action may go to besides its own. Anything else is unexpected and
+            makes the machine go to its fallback state.
+        timeout (float): The longest time in seconds to keep taking steps in this state, None for no limit.
+        on_timeout (str): The state to go to when the timeout runs out.
+        progress (bool): Finishing a step in this state means the flow got somewhere, which resets the watchdog.
+        detector (callable): Blocking function that says whether the screen shows this state, used to find out
+            where the game is after a recovery. None if the state has no screen of its own.
+        """
+        self.name = name
+        self.action = action
+        self.transitions = set(transitions)
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        self.progress = progress
+        self.detector = detector
+
+
+class Watchdog:
+    """
+    Gets a state machine going again when it has not reached a progress state for a while.
+
+    Every time it stalls the next recovery is tried (e.g. press Esc, then close whatever is open, then restart the
+    game), and the machine carries on from the state the screen shows, or its fallback state. A step in a progress
+    state starts again from the first recovery. When every recovery has been tried, StuckError is raised.
+    """
+
+    def __init__(self, stall_timeout, recoveries=()):
+        """
+        Args:
+        stall_timeout (float): Seconds without progress after which the machine counts as stuck.
+        recoveries (list): (name, coroutine function taking the StateMachine), tried in order, one per stall.
+        """
+        self.stall_timeout = stall_timeout
+        self.recoveries = list(recoveries)
+        self.level = 0
+        self.last_progress = None
+
+    def progress(self, now):
+        self.last_progress = now
+        self.level = 0
+
+    def stalled(self, now):
+        return self.last_progress is not None and now - self.last_progress >= self.stall_timeout
+
+    async def recover(self, machine, reason):
+        """
+        Runs the next recovery.
+
+        Returns:
+        str: The state to continue from.
+        """
+        if self.level >= len(self.recoveries):
+            raise StuckError(f"{machine.name} is stuck in {machine.state} ({reason}), every recovery has been tried")
+        name, recovery = self.recoveries[self.level]
+        self.level += 1
+        print(f"{machine.name} stuck in {machine.state} ({reason}), recovering: {name}")
+        askip.metrics.increment('recoveries_total', machine=machine.name, recovery=name)
+        await recovery(machine)
+        # Give the recovery as long as the machine had before trying the next one
+        self.last_progress = machine.runtime.monotonic()
+        return await machine.identify() or machine.fallback
+
+
+class StateMachine:
+    """
+    Runs a table of States on an AsyncRuntime.
+
+    Steps are never cancelled halfway, a blocking step on the thread pool could not be stopped anyway. Every step is
+    short and bounded, so the state timeouts and the watchdog are checked between steps.
+    """
+
+    def __init__(self, name, states, initial, runtime, fallback=None, final=("done",), watchdog=None):
+        """
+        Args:
+        name (str): Name of the machine in the metrics and messages.
+        states (list): The States.
+        initial (str): The state to start in.
+        runtime (AsyncRuntime): Runs the blocking work and the waits.
+        fallback (str): Where to go after an unexpected transition or a recovery, initial if None.
+        final (iterable): States that end the machine.
+        watchdog (Watchdog): Recovers the machine when it stops making progress, optional.
+        """
+        self.name = name
+        self.states = {state.name: state for state in states}
+        self.initial = initial
+        self.runtime = runtime
+        self.fallback = fallback or initial
+        self.final = set(final)
+        self.watchdog = watchdog
+        self.state = None
+        self.entered = None
+        self.steps = 0  # Steps taken in the current state
+
+    def _enter(self, state):
+        if self.state is not None:
+            # How many steps the state took, e.g. screenshots to get rid of an ad
+            askip.metrics.observe('state_steps', self.steps, buckets=COUNT_BUCKETS, machine=self.name,
+                                  state=self.state)
+        askip.metrics.transition(self.name, state)
+        self.state, self.entered, self.steps = state, self.runtime.monotonic(), 0
+
+    async def run(self, state=None):
+        """
+        Runs the machine until it reaches a final state.
+
+        Args:
+        state (str): The state to start in, initial if None.
+
+        Returns:
+        str: The final state.
+        """
+        if self.watchdog is not None:
+            self.watchdog.progress(self.runtime.monotonic())
+        self._enter(state or self.initial)
+        while self.state not in self.final:
+            spec = self.states[self.state]
+            try:
+                next_state = await spec.action(self)
+            except TimeoutError as e:
+                # A wait inside the step gave up, that is a stall too
+                if self.watchdog is None:
+                    raise
+                # Entered again even if the recovery lands on the same state, so its timeout starts over
+                self._enter(await self.watchdog.recover(self, str(e)))
+                continue
+            else:
+                self.steps += 1
+                now = self.runtime.monotonic()
+                if spec.progress and self.watchdog is not None:
+                    self.watchdog.progress(now)
+                if next_state != self.state and next_state not in spec.transitions:
+                    print(f"{self.name}: unexpected {next_state!r} after {self.state}, going to {self.fallback}")
+                    askip.metrics.increment('unexpected_transitions_total', machine=self.name, source=self.state,
+                                            target=next_state)
+                    next_state = self.fallback
+                elif next_state == self.state and spec.timeout is not None and now - self.entered >= spec.timeout:
+                    askip.metrics.increment('state_timeouts_total', machine=self.name, state=self.state)
+                    next_state = spec.on_timeout
+
+            if next_state != self.state:
+                self._enter(next_state)
+            if self.watchdog is not None and self.watchdog.stalled(self.runtime.monotonic()):
+                self._enter(await self.watchdog.recover(self, "no progress"))
+        self._enter(self.state)  # Counts the steps of the last state
+        return self.state
+
+    async def identify(self):
+        """
+        Asks the detector of every state, in the order they were declared, whether the screen shows it.
+
+        Returns:
+        str: The first state whose detector says yes, None if none does.
+        """
+        for state in self.states.values():
+            if state.detector is not None and await self.runtime.run(state.detector):
+                return state.name
+        return None
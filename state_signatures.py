@@ -0,0 +1,218 @@
+import argparse
+import collections
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from atomic_file import atomic_write
+
+# Every screen is shrunk to this many pixels (width, height) before comparing, whatever size the window is
+THUMBNAIL_SIZE = (16, 28)
+
+
+def thumbnail(frame):
+    """
+    Shrinks a frame to a tiny grayscale thumbnail, the signature of the screen it shows.
+
+    Starts from Frame.signature, which the change detector has usually worked out for the frame already, so this only
+    resizes a 31x57 image.
+
+    Args:
+    frame (Frame): The frame.
+
+    Returns:
+    np.array: The THUMBNAIL_SIZE thumbnail as one flat float32 vector.
+    """
+    small = cv2.resize(frame.signature(), THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32).ravel()
+
+
+class StateSignatures:
+    """
+    Recognises the game's screens from tiny thumbnails, without any template matching.
+
+    The state screens (Home, Shop, Chest, OpenChest, ...) look very different from each other even at 16x28 pixels,
+    so every state is remembered as a few thumbnails (prototypes) of frames that were classified as that state. A new
+    frame is compared to all prototypes at once, one numpy subtraction, which takes microseconds. Prototypes are
+    saved to a file so they survive restarts, and can be learned from recorded sessions (run this file).
+    """
+
+    def __init__(self, path=None, max_distance=25, sure_distance=6, min_margin=10, merge_distance=8,
+                 max_prototypes=8):
+        """
+        Args:
+        path (str): .npz file to load the prototypes from and save them to, None to keep them in memory only.
+        max_distance (float): Mean difference per pixel up to which a prototype counts as a candidate.
+        sure_distance (float): Mean difference up to which the nearest state is trusted without a template match.
+        min_margin (float): How much nearer than every other state the nearest state has to be to be trusted.
+        merge_distance (float): A learned frame this close to a prototype of its state is averaged into it, farther
+            away it becomes a new prototype.
+        max_prototypes (int): The most prototypes to keep per state, the ones matched least often are dropped.
+        """
+        self.path = path
+        self.max_distance = max_distance
+        self.sure_distance = sure_distance
+        self.min_margin = min_margin
+        self.merge_distance = merge_distance
+        self.max_prototypes = max_prototypes
+        size = THUMBNAIL_SIZE[0] * THUMBNAIL_SIZE[1]
+        self._prototypes = np.zeros((0, size), np.float32)
+        self._states = []  # The state of every prototype row
+        self._hits = np.zeros(0, np.int64)  # How often every prototype was learned
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._states)
+
+    def nearest(self, frame):
+        """
+        Compares a frame to every prototype.
+
+        Args:
+        frame (Frame): The frame.
+
+        Returns:
+        list: (state, distance) for every known state, the distance to its nearest prototype, nearest first.
+        """
+        signature = thumbnail(frame)
+        with self._lock:
+            if not self._states:
+                return []
+            distances = np.abs(self._prototypes - signature).mean(axis=1)
+            states = list(self._states)
+        nearest = {}
+        for index in np.argsort(distances):
+            nearest.setdefault(states[index], float(distances[index]))
+        return list(nearest.items())
+
+    def candidates(self, frame):
+        """
+        Works out which states the frame could show.
+
+        Args:
+        frame (Frame): The frame.
+
+        Returns:
+        tuple: (states, sure) where states are the states within max_distance, nearest first, and sure is True if
+        the first one is within sure_distance and min_margin nearer than any other state.
+        """
+        nearest = self.nearest(frame)
+        states = [state for state, distance in nearest if distance <= self.max_distance]
+        sure = bool(states) and nearest[0][1] <= self.sure_distance and (
+            len(nearest) == 1 or nearest[1][1] - nearest[0][1] >= self.min_margin)
+        return states, sure
+
+    def learn(self, frame, state):
+        """
+        Remembers that a frame shows a state, confirmed some other way (e.g. a template match).
+
+        Args:
+        frame (Frame): The frame.
+        state (str): The state it shows.
+        """
+        signature = thumbnail(frame)
+        with self._lock:
+            rows = [index for index, known in enumerate(self._states) if known == state]
+            if rows:
+                distances = np.abs(self._prototypes[rows] - signature).mean(axis=1)
+                closest = rows[int(np.argmin(distances))]
+                if distances.min() <= self.merge_distance:
+                    # Running average, capped so the prototype keeps following slow changes to the screen
+                    self._hits[closest] += 1
+                    weight = 1 / min(self._hits[closest], 20)
+                    self._prototypes[closest] += (signature - self._prototypes[closest]) * weight
+                    return
+                if len(rows) >= self.max_prototypes:
+                    self._drop(min(rows, key=lambda row: self._hits[row]))
+            self._prototypes = np.vstack([self._prototypes, signature[None]])
+            self._states.append(state)
+            self._hits = np.append(self._hits, 1)
+        self.save()
+
+    def _drop(self, row):
+        self._prototypes = np.delete(self._prototypes, row, axis=0)
+        self._hits = np.delete(self._hits, row)
+        del self._states[row]
+
+    def forget(self, state=None):
+        """
+        Drops the prototypes of one state, or of every state if state is None.
+        """
+        with self._lock:
+            for row in reversed(range(len(self._states))):
+                if state is None or self._states[row] == state:
+                    self._drop(row)
+
+    def load(self):
+        with np.load(self.path) as data:
+            prototypes = data['prototypes'].astype(np.float32)
+            states = [str(state) for state in data['states']]
+            hits = data['hits'].astype(np.int64)
+        if prototypes.shape[1:] != self._prototypes.shape[1:]:
+            print(f"{self.path} was made with another thumbnail size, starting over")
+            return
+        with self._lock:
+            self._prototypes, self._states, self._hits = prototypes, states, hits
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock, atomic_write(self.path, "wb") as f:
+            np.savez(f, prototypes=self._prototypes, states=np.array(self._states, dtype=str), hits=self._hits)
+
+
+def learn_from_sessions(paths, signatures, folder):
+    """
+    Teaches signatures every state seen in recorded sessions, classifying the frames with the state templates.
+
+    Args:
+    paths (list): Session files written while RECORD_SESSION was set.
+    signatures (StateSignatures): Where to learn the states.
+    folder (str): The folder containing the state templates.
+
+    Returns:
+    collections.Counter: How many frames were learned per state.
+    """
+    import ad_skip_test as askip
+    from capture import Frame, signatures_differ
+    from recorder import read_session
+
+    classifier = askip.StateClassifier(folder)
+    learned = collections.Counter()
+    saved, askip.state_signatures = askip.state_signatures, None  # Only trust the templates while learning
+    try:
+        for path in paths:
+            _, frames, _ = read_session(path)
+            with frames:
+                previous = None
+                for timestamp, region, image in frames:
+                    frame = Frame(image, region, timestamp)
+                    # Most frames in a row are the same screen, classify only the ones that changed
+                    if previous is not None and not signatures_differ(previous, frame.signature()):
+                        continue
+                    previous = frame.signature()
+                    name = classifier.classify(frame)
+                    if name:
+                        signatures.learn(frame, name.lower())
+                        learned[name.lower()] += 1
+    finally:
+        askip.state_signatures = saved
+    signatures.save()
+    return learned
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Learn the state signatures from recorded sessions")
+    parser.add_argument('sessions', nargs='+', help="session files written while RECORD_SESSION was set")
+    args = parser.parse_args()
+
+    import ad_skip_test
+    counts = learn_from_sessions(args.sessions, ad_skip_test.state_signatures,
+                                 os.path.join(ad_skip_test.script_directory, 'snip_images', 'states'))
+    for learned_state, count in counts.most_common():
+        print(f"{learned_state}: {count} frames")
+    print(f"{len(ad_skip_test.state_signatures)} prototypes saved to {ad_skip_test.state_signatures.path}")
@@ -0,0 +1,426 @@
+import collections
+import datetime
+import hashlib
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Tesseract is only needed for timers the DigitRecognizer can not read yet
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:
+    pytesseract = Image = None
+
+# Size every glyph is scaled to before it is compared, the line height maps to GLYPH_HEIGHT
+GLYPH_WIDTH = 16
+GLYPH_HEIGHT = 20
+# Components smaller than this many pixels are noise, not part of a glyph
+MIN_GLYPH_AREA = 4
+# Lowest correlation at which a glyph counts as a stored character. A digit that has not been learned yet matches
+# no stored glyph this well, so a timer containing one is not read as the closest learned digit
+MIN_CONFIDENCE = 0.85
+
+# Glyphs are stored as <name>.png, ':' can not be part of a file name on Windows
+GLYPH_FILE_NAMES = {':': 'colon'}
+
+TIMER_PATTERN = re.compile(r'^\d\d:\d\d:\d\d$')
+# White rows between the timers tiled into one image for Tesseract
+TILE_GAP = 12
+TESSERACT_CONFIG = '--psm 6 --oem 3 -c tessedit_char_whitelist=0123456789:'
+
+
+class DigitRecognizer:
+    """
+    Reads the reward timers (HH:MM:SS) without starting Tesseract.
+
+    The output of game_test.process_image is split into glyphs using connected components, and every glyph is
+    compared against stored glyphs of the game's timer font in a single matrix multiplication. The stored glyphs are
+    learned from timers Tesseract read and a second reading confirmed, so after the first few cycles Tesseract is
+    hardly needed anymore.
+    """
+
+    def __init__(self, folder=None):
+        """
+        Args:
+        folder (str): Where the learned glyphs are stored as PNG files, None to keep them in memory only.
+        """
+        self.folder = folder
+        self._glyphs = {}  # character -> normalized glyph vector
+        self._matrix = None  # Every stored glyph as one row, rebuilt when a glyph is learned
+        self._characters = []  # The character of every row of _matrix
+        self._lock = threading.Lock()
+        if folder and os.path.isdir(folder):
+            self.load()
+
+    @staticmethod
+    def segment(binary):
+        """
+        Splits a processed timer image into glyph images, left to right.
+
+        Ink is black on white, as returned by process_image. Components that overlap horizontally (the two dots of a
+        colon) are merged into one glyph.
+
+        Args:
+        binary (np.array): The processed timer image.
+
+        Returns:
+        list: One GLYPH_HEIGHT x GLYPH_WIDTH float image per glyph.
+        """
+        ink = (binary == 0).astype(np.uint8)
+        count, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+        boxes = [stats[index] for index in range(1, count) if stats[index, cv2.CC_STAT_AREA] >= MIN_GLYPH_AREA]
+        if not boxes:
+            return []
+
+        # Merge components whose columns overlap, left to right
+        boxes.sort(key=lambda box: box[cv2.CC_STAT_LEFT])
+        columns = []
+        for box in boxes:
+            left, right = box[cv2.CC_STAT_LEFT], box[cv2.CC_STAT_LEFT] + box[cv2.CC_STAT_WIDTH]
+            if columns and left < columns[-1][1]:
+                columns[-1][1] = max(columns[-1][1], right)
+            else:
+                columns.append([left, right])
+
+        # Scale by the height of the whole line, so a colon stays smaller than a digit
+        top = min(box[cv2.CC_STAT_TOP] for box in boxes)
+        bottom = max(box[cv2.CC_STAT_TOP] + box[cv2.CC_STAT_HEIGHT] for box in boxes)
+        scale = GLYPH_HEIGHT / (bottom - top)
+
+        glyphs = []
+        for left, right in columns:
+            crop = ink[top:bottom, left:right].astype(np.float32)
+            width = min(max(int(round((right - left) * scale)), 1), GLYPH_WIDTH)
+            glyph = np.zeros((GLYPH_HEIGHT, GLYPH_WIDTH), np.float32)
+            offset = (GLYPH_WIDTH - width) // 2
+            glyph[:, offset:offset + width] = cv2.resize(crop, (width, GLYPH_HEIGHT), interpolation=cv2.INTER_AREA)
+            glyphs.append(glyph)
+        return glyphs
+
+    @staticmethod
+    def _normalize(glyphs):
+        # Zero mean and unit length, so the dot product of two glyphs is their correlation
+        vectors = np.asarray(glyphs, np.float32).reshape(len(glyphs), -1)
+        vectors = vectors - vectors.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-6)
+
+    def read(self, binary, min_confidence=MIN_CONFIDENCE):
+        """
+        Reads a timer.
+
+        Args:
+        binary (np.array): The processed timer image, see process_image.
+        min_confidence (float): The correlation every glyph needs with its best stored glyph.
+
+        Returns:
+        tuple: (text, confidence) where confidence is the correlation of the least certain glyph, between -1 and 1.
+        (None, 0.0) if the image does not look like HH:MM:SS, (None, confidence) if a glyph matches no stored glyph
+        well enough, e.g. a digit that has not been learned yet.
+        """
+        with self._lock:
+            matrix, characters = self._matrix, self._characters
+        glyphs = DigitRecognizer.segment(binary)
+        if matrix is None or len(glyphs) != 8:
+            return None, 0.0
+        scores = DigitRecognizer._normalize(glyphs) @ matrix.T
+        best = scores.argmax(axis=1)
+        confidence = float(scores[np.arange(len(best)), best].min())
+        if confidence < min_confidence:
+            return None, confidence
+        text = "".join(characters[index] for index in best)
+        if text[2] != ':' or text[5] != ':' or ':' in text[:2] + text[3:5] + text[6:]:
+            return None, 0.0
+        return text, confidence
+
+    def learn(self, binary, text):
+        """
+        Stores the glyphs of a timer whose text is known to be right, e.g. read by Tesseract and confirmed by a second
+        reading.
+
+        A stored glyph that does not look like the new glyph of its character is replaced, and a stored glyph of
+        another character that looks just like it is dropped, so a glyph learned from a misread does not stay wrong.
+
+        Args:
+        binary (np.array): The processed timer image.
+        text (str): What the timer says, e.g. "01:23:45".
+
+        Returns:
+        int: How many glyphs were stored or replaced.
+        """
+        glyphs = DigitRecognizer.segment(binary)
+        # Only learn from a well formed timer whose glyphs line up with its characters
+        if len(glyphs) != len(text) or len(text) != 8 or text[2] + text[5] != '::':
+            return 0
+        vectors = DigitRecognizer._normalize(glyphs)
+        learned = 0
+        with self._lock:
+            for character, glyph, vector in zip(text, glyphs, vectors):
+                if self._matrix is not None:
+                    scores = self._matrix @ vector
+                    best = int(scores.argmax())
+                    other = self._characters[best]
+                    if other not in text and scores[best] >= MIN_CONFIDENCE:
+                        # The glyph stored for other is really this character
+                        self._forget(other)
+                        self._rebuild()
+                stored = self._glyphs.get(character)
+                if stored is not None and float(DigitRecognizer._normalize([stored])[0] @ vector) >= MIN_CONFIDENCE:
+                    continue
+                self._glyphs[character] = glyph
+                learned += 1
+                if self.folder:
+                    os.makedirs(self.folder, exist_ok=True)
+                    cv2.imwrite(self._glyph_path(character), (glyph * 255).astype(np.uint8))
+                self._rebuild()
+        return learned
+
+    def _glyph_path(self, character):
+        return os.path.join(self.folder, f"{GLYPH_FILE_NAMES.get(character, character)}.png")
+
+    def _forget(self, character):
+        # Called with the lock held
+        del self._glyphs[character]
+        if self.folder and os.path.exists(self._glyph_path(character)):
+            os.remove(self._glyph_path(character))
+
+    def load(self):
+        names = {name: character for character, name in GLYPH_FILE_NAMES.items()}
+        with self._lock:
+            for filename in sorted(os.listdir(self.folder)):
+                name, extension = os.path.splitext(filename)
+                if extension != ".png":
+                    continue
+                image = cv2.imread(os.path.join(self.folder, filename), cv2.IMREAD_GRAYSCALE)
+                if image is None or image.shape != (GLYPH_HEIGHT, GLYPH_WIDTH):
+                    continue
+                self._glyphs[names.get(name, name)] = image.astype(np.float32) / 255
+            self._rebuild()
+
+    def _rebuild(self):
+        # Called with the lock held
+        if not self._glyphs:
+            self._matrix, self._characters = None, []
+            return
+        self._characters = sorted(self._glyphs)
+        self._matrix = DigitRecognizer._normalize([self._glyphs[c] for c in self._characters])
+
+
+def parse_timer(text):
+    """
+    Turns "HH:MM:SS" into a timedelta.
+
+    Returns:
+    timedelta: The duration, or None if text is not a timer.
+    """
+    if text is None or not TIMER_PATTERN.match(text):
+        return None
+    hours, minutes, seconds = map(int, text.split(':'))
+    if minutes > 59 or seconds > 59:
+        return None
+    return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+
+
+class TimerReader:
+    """
+    Reads several reward timers at once, as cheaply as possible.
+
+    Every timer crop is binarized and looked up in a cache keyed by a hash of its pixels, then given to the
+    DigitRecognizer. Only the timers neither of them can read go to Tesseract, tiled into a single image so there is
+    one Tesseract call per read instead of one per timer. read_consistent takes two readings a known time apart and
+    only trusts timers that counted down by that time. The DigitRecognizer only learns from Tesseract readings that
+    passed that check, and timers that did not pass it are given to Tesseract next time, so a wrong glyph gets
+    replaced.
+    """
+
+    def __init__(self, preprocess, recognizer=None, cache_size=256, metrics=None):
+        """
+        Args:
+        preprocess (callable): Turns a timer crop into black ink on white, e.g. game_test.process_image.
+        recognizer (DigitRecognizer): Tried before Tesseract, None to always use Tesseract.
+        cache_size (int): How many crops to remember the text of.
+        metrics (Metrics): Where OCR timings and cache hits are counted, optional.
+        """
+        self.preprocess = preprocess
+        self.recognizer = recognizer
+        self.cache_size = cache_size
+        self.metrics = metrics
+        self.clock = time  # Swapped for a virtual clock when replaying
+        self._cache = collections.OrderedDict()  # crop hash -> text or None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _crop_key(binary):
+        return hashlib.blake2b(binary.tobytes(), digest_size=16, key=repr(binary.shape).encode()).digest()
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return True, self._cache[key]
+        return False, None
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        """
+        Forgets every cached timer text.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def _count(self, source):
+        if self.metrics is not None:
+            self.metrics.increment('timer_reads_total', source=source)
+
+    def read_texts(self, images):
+        """
+        Reads the text of several timer crops.
+
+        Args:
+        images (list): The timer crops, as captured.
+
+        Returns:
+        list: "HH:MM:SS" for every crop, or None for a crop that could not be read.
+        """
+        return self._read_texts(images)[0]
+
+    def _read_texts(self, images, tesseract_only=()):
+        """
+        Returns:
+        tuple: (texts, binaries, read by Tesseract) with one entry per crop. Crops whose index is in tesseract_only
+        skip the cache and the DigitRecognizer.
+        """
+        binaries = [self.preprocess(image) for image in images]
+        texts = [None] * len(binaries)
+        by_tesseract = [False] * len(binaries)
+        pending = []
+        for index, binary in enumerate(binaries):
+            key = TimerReader._crop_key(binary)
+            if index in tesseract_only:
+                pending.append((index, key, binary))
+                continue
+            hit, text = self._cached(key)
+            if hit:
+                texts[index] = text
+                self._count('cache')
+                continue
+            if self.recognizer is not None:
+                text, _ = self.recognizer.read(binary)
+                if text is not None:
+                    texts[index] = text
+                    self._remember(key, text)
+                    self._count('glyphs')
+                    continue
+            pending.append((index, key, binary))
+
+        if pending:
+            for (index, key, binary), text in zip(pending, self._tesseract([p[2] for p in pending])):
+                texts[index] = text
+                by_tesseract[index] = True
+                if text is not None:
+                    self._remember(key, text)
+                self._count('tesseract' if text is not None else 'unreadable')
+        return texts, binaries, by_tesseract
+
+    def _tesseract(self, binaries):
+        # One Tesseract call for every crop, stacked on top of each other with white gaps in between
+        if pytesseract is None:
+            return [None] * len(binaries)
+        width = max(binary.shape[1] for binary in binaries)
+        rows = [np.full((TILE_GAP, width), 255, np.uint8)]
+        for binary in binaries:
+            rows.append(cv2.copyMakeBorder(binary, 0, 0, 0, width - binary.shape[1], cv2.BORDER_CONSTANT, value=255))
+            rows.append(np.full((TILE_GAP, width), 255, np.uint8))
+        started = time.perf_counter()
+        output = pytesseract.image_to_string(Image.fromarray(np.vstack(rows)), lang='eng', config=TESSERACT_CONFIG)
+        if self.metrics is not None:
+            self.metrics.observe('ocr_seconds', time.perf_counter() - started, engine='tesseract',
+                                 timers=len(binaries))
+        lines = [line.replace(' ', '') for line in output.splitlines() if line.strip()]
+        if len(lines) != len(binaries):
+            # A timer was skipped or split, so lines can not be matched to timers
+            return [None] * len(binaries)
+        return [line if TIMER_PATTERN.match(line) else None for line in lines]
+
+    def read(self, frame, regions):
+        """
+        Reads the timers in the given regions of a frame.
+
+        Returns:
+        list: A timedelta for every region, or None where the timer could not be read.
+        """
+        return self._read(frame, regions)[0]
+
+    def _read(self, frame, regions, tesseract_only=()):
+        texts, binaries, by_tesseract = self._read_texts([frame.crop(region).image for region in regions],
+                                                         tesseract_only)
+        return [parse_timer(text) for text in texts], texts, binaries, by_tesseract
+
+    def _learn(self, text, binary):
+        if self.recognizer is not None and self.recognizer.learn(binary, text):
+            print(f"Learned the timer digits in {text}")
+
+    def read_consistent(self, capture, regions, interval=2.0, attempts=3, frame=None):
+        """
+        Reads the timers twice, interval seconds apart, and only keeps timers that counted down by about that much.
+
+        A misread digit almost never misreads the same way in the next sample, so this catches OCR mistakes that
+        still look like valid timers. Timers that disagree are read again by Tesseract, up to attempts times, and
+        Tesseract readings that agree are learned by the DigitRecognizer.
+
+        Args:
+        capture (callable): Returns a new Frame of the screen.
+        regions (list): The timer regions, see find_timer_regions.
+        interval (float): Seconds between the two readings, at least 1 so the seconds have ticked.
+        attempts (int): How many more readings to take for timers that do not agree.
+        frame (Frame): An already captured frame to use as the first reading.
+
+        Returns:
+        list: The timedelta of every timer from the last reading, None for timers that never agreed.
+        """
+        previous = self._read(frame if frame is not None else capture(), regions)
+        previous_time = self.clock.monotonic()
+        results = [None] * len(regions)
+        agreed_at = [None] * len(regions)
+        disagreed = set()
+        now = previous_time
+        for _ in range(attempts):
+            self.clock.sleep(interval)
+            # A timer that disagreed may have been misread by a wrong glyph, Tesseract reads it this time
+            current = self._read(capture(), regions, disagreed)
+            now = self.clock.monotonic()
+            elapsed = now - previous_time
+            for index, (before, after) in enumerate(zip(previous[0], current[0])):
+                if results[index] is not None:
+                    continue
+                if before is None or after is None:
+                    disagreed.add(index)
+                    continue
+                drop = (before - after).total_seconds()
+                # The display truncates to whole seconds, so the drop can be a second off either way
+                if abs(drop - elapsed) <= 1.5 or (before.total_seconds() == 0 and after.total_seconds() == 0):
+                    results[index], agreed_at[index] = after, now
+                    for reading in (previous, current):
+                        if reading[3][index]:
+                            self._learn(reading[1][index], reading[2][index])
+                else:
+                    disagreed.add(index)
+            if all(result is not None for result in results):
+                break
+            previous, previous_time = current, now
+        if self.metrics is not None:
+            self.metrics.increment('timer_disagreements_total', sum(result is None for result in results))
+        # Timers that agreed early have kept counting down since
+        return [None if result is None else max(result - datetime.timedelta(seconds=now - at), datetime.timedelta())
+                for result, at in zip(results, agreed_at)]